@@ -5,7 +5,8 @@ from banal import ensure_list
 from datetime import datetime, timedelta
 from werkzeug.exceptions import Unauthorized
 
-from aleph.core import db, cache, settings
+from aleph.core import db, kv, cache, settings
+from aleph.cache import LocalCache
 from aleph.model import Collection, Role, Permission
 
 log = logging.getLogger(__name__)
@@ -20,6 +21,8 @@ class Authz(object):
     READ = 'read'
     WRITE = 'write'
     PREFIX = 'aauthz'
+    LOCAL = LocalCache(kv, expires=settings.CACHE_LOCAL_EXPIRE,
+                       scope=PREFIX)
 
     def __init__(self, role_id, roles, is_admin=False, is_blocked=False):
         self.id = role_id
@@ -36,9 +39,14 @@ class Authz(object):
         if action in self._collections:
             return self._collections.get(action)
         key = cache.key(action, self.id)
-        collections = cache.kv.hget(self.PREFIX, key)
+        collections = self.LOCAL.get(key)
+        if collections is not None:
+            self._collections[action] = collections
+            return collections
+        collections = cache.kv.hget(self.hash_key(), key)
         if collections:
             collections = json.loads(collections)
+            self.LOCAL.set(key, collections)
             self._collections[action] = collections
             log.debug("[C] Authz: %s (%s): %d collections",
                       self, action, len(collections))
@@ -59,7 +67,12 @@ class Authz(object):
         collections = [c for (c,) in q.all()]
         log.debug("Authz: %s (%s): %d collections",
                   self, action, len(collections))
-        cache.kv.hset(self.PREFIX, key, json.dumps(collections))
+        hash_key = self.hash_key()
+        pipe = cache.kv.pipeline(transaction=False)
+        pipe.hset(hash_key, key, json.dumps(collections))
+        pipe.expire(hash_key, cache.EXPIRE)
+        pipe.execute()
+        self.LOCAL.set(key, collections)
         self._collections[action] = collections
         return collections
 
@@ -172,11 +185,19 @@ class Authz(object):
         except (jwt.DecodeError, TypeError):
             return
 
+    @classmethod
+    def hash_key(cls):
+        # The hash belongs to the current cache generation, so that it
+        # expires as a whole once the cache has been invalidated:
+        return cache.key(cls.PREFIX)
+
     @classmethod
     def flush(cls):
-        cache.kv.delete(cls.PREFIX)
+        cache.kv.delete(cls.hash_key())
+        LocalCache.bump(cache.kv, cls.PREFIX)
 
     @classmethod
     def flush_role(cls, role_id):
         keys = [cache.key(a, role_id) for a in (cls.READ, cls.WRITE)]
-        cache.kv.hdel(cls.PREFIX, *keys)
+        cache.kv.hdel(cls.hash_key(), *keys)
+        LocalCache.bump(cache.kv, cls.PREFIX)
@@ -1,73 +1,364 @@
 import json
+import zlib
+import base64
 import logging
+import threading
+from time import time
+from copy import copy
+from collections import OrderedDict, defaultdict
+from flask import g, has_request_context
 from servicelayer import settings
 from servicelayer.cache import make_key
 
-from aleph.util import JSONEncoder
+from aleph.util import dump_json
 
 log = logging.getLogger(__name__)
 
 
 class Cache(object):
+    """Redis-backed object cache. Complex values are stored as compact
+    JSON, compressed above a size threshold. Recently used values are
+    also kept, still encoded, in a short-lived in-process tier which is
+    bounded by the size of the encoded values.
+
+    Cache keys include a generation number, so the whole cache - or all
+    keys of one object of a SCOPED class - can be invalidated by bumping
+    a counter. Old keys are left to expire. Use `state_key` for data that
+    must survive this, like counters or locks."""
     EXPIRE = settings.REDIS_EXPIRE
+    # Redis connections decode responses, so compressed data is stored
+    # as base64 behind this marker:
+    COMPRESSED = '\x00z'
+    SCOPED = ('Collection',)
+    # Generations looked up outside of a request are remembered for a
+    # second, for up to this many scopes:
+    GENERATIONS_SIZE = 10000
 
-    def __init__(self, kv, expires=None, prefix=None):
+    def __init__(self, kv, expires=None, prefix=None, local_size=0,
+                 local_bytes=None, local_expires=5, compress=4096):
         self.kv = kv
         self.expires = expires
         self.prefix = prefix
+        self.compress = compress
+        self.local = None
+        if local_size > 0:
+            self.local = LocalCache(kv, size=local_size,
+                                    max_bytes=local_bytes,
+                                    expires=local_expires)
+        self.stats_lock = threading.Lock()
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.generations = {}
 
-    def key(self, *parts):
+    def state_key(self, *parts):
+        """A key which is not affected by cache invalidation."""
         return make_key(self.prefix, *parts)
 
+    def _generations_memo(self):
+        if has_request_context():
+            if 'cache_generations' not in g:
+                g.cache_generations = {}
+            return g.cache_generations
+        return None
+
+    def _remember_generations(self, values):
+        memo = self._generations_memo()
+        if memo is not None:
+            memo.update(values)
+            return
+        if len(self.generations) + len(values) > self.GENERATIONS_SIZE:
+            self.generations.clear()
+        now = time()
+        for key, value in values.items():
+            self.generations[key] = (now, value)
+
+    def _known_generation(self, key):
+        """Return (known, value) for a generation key from the memo."""
+        memo = self._generations_memo()
+        if memo is not None:
+            return key in memo, memo.get(key)
+        checked_at, value = self.generations.get(key, (0, None))
+        return time() - checked_at <= 1, value
+
+    def prefetch_generations(self, *scopes):
+        """Look up the generations of several scopes in one round trip,
+        e.g. before building the object keys of a batch."""
+        keys = [self.state_key('gen', *scope) for scope in scopes]
+        keys = [k for k in set(keys) if not self._known_generation(k)[0]]
+        if len(keys):
+            self._remember_generations(dict(zip(keys, self.kv.mget(keys))))
+
+    def generation(self, *scope):
+        """Current generation of the global cache namespace, or of the
+        given scope. Looked up once per request, or once per second
+        outside of one."""
+        key = self.state_key('gen', *scope)
+        known, value = self._known_generation(key)
+        if not known:
+            value = self.kv.get(key)
+            self._remember_generations({key: value})
+        return 'g%s' % int(value or 0)
+
+    def bump(self, *scope):
+        """Invalidate all keys in the global namespace, or in a scope."""
+        key = self.state_key('gen', *scope)
+        self.kv.incr(key)
+        self.generations.pop(key, None)
+        if has_request_context() and 'cache_generations' in g:
+            g.cache_generations.pop(key, None)
+
+    def key(self, *parts):
+        return make_key(self.prefix, self.generation(), *parts)
+
     def object_key(self, clazz, key, *parts):
-        return self.key(clazz.__name__, key, *parts)
+        name = clazz.__name__
+        if name in self.SCOPED:
+            return self.key(name, key, self.generation(name, key), *parts)
+        return self.key(name, key, *parts)
+
+    def object_keys(self, clazz, keys, *parts):
+        """Object keys for a batch of objects, with the generations of
+        all their scopes fetched at once."""
+        name = clazz.__name__
+        if name in self.SCOPED:
+            self.prefetch_generations((), *[(name, k) for k in keys])
+        return [self.object_key(clazz, k, *parts) for k in keys]
+
+    def _count(self, key, metric, value=1):
+        # Keys look like `prefix:gen:Class:id`, count by object class:
+        parts = key.split(':')
+        section = parts[2] if len(parts) > 3 else parts[-1]
+        with self.stats_lock:
+            self.stats[section][metric] += value
+
+    def encode(self, value):
+        data = dump_json(value)
+        if self.compress and len(data) > self.compress:
+            data = zlib.compress(data.encode('utf-8'))
+            data = self.COMPRESSED + base64.b64encode(data).decode('ascii')
+        return data
+
+    def decode(self, data):
+        if data.startswith(self.COMPRESSED):
+            data = base64.b64decode(data[len(self.COMPRESSED):])
+            data = zlib.decompress(data).decode('utf-8')
+        return json.loads(data)
 
     def set(self, key, value, expires=None):
-        expires = expires or self.expires
+        # Everything expires, so that invalidated generations go away:
+        expires = expires or self.expires or self.EXPIRE
         self.kv.set(key, value, ex=expires)
 
     def set_complex(self, key, value, expires=None):
-        value = json.dumps(value, cls=JSONEncoder)
-        return self.set(key, value, expires=expires)
+        data = self.encode(value)
+        self._count(key, 'bytes_written', len(data))
+        if self.local is not None:
+            self.local.set(key, data)
+        return self.set(key, data, expires=expires)
+
+    def set_many_complex(self, items, expires=None):
+        """Store a batch of (key, value) pairs in one round trip."""
+        expires = expires or self.expires or self.EXPIRE
+        pipe = self.kv.pipeline(transaction=False)
+        for key, value in items:
+            data = self.encode(value)
+            self._count(key, 'bytes_written', len(data))
+            if self.local is not None:
+                self.local.set(key, data)
+            pipe.set(key, data, ex=expires)
+        pipe.execute()
 
     def set_list(self, key, values, expires=None):
         self.kv.delete(key)
         if len(values):
             self.kv.rpush(key, *values)
-            if expires is not None:
-                self.kv.expire(key, expires)
+            self.kv.expire(key, expires or self.expires or self.EXPIRE)
 
     def get(self, key):
         return self.kv.get(key)
 
-    def get_complex(self, key):
-        value = self.get(key)
-        if value is not None:
-            return json.loads(value)
+    def _get_local(self, key):
+        if self.local is None:
+            return
+        data = self.local.get(key)
+        if data is not None:
+            self._count(key, 'local_hits')
+        return data
+
+    def _loaded(self, key, data):
+        if data is None:
+            self._count(key, 'misses')
+            return
+        self._count(key, 'hits')
+        self._count(key, 'bytes_read', len(data))
+        if self.local is not None:
+            self.local.set(key, data)
+        return self.decode(data)
+
+    def get_complex(self, key, local=True):
+        """Get a value, and keep it in the local tier unless `local` is
+        false (e.g. for large values which are rarely read twice)."""
+        if not local:
+            data = self.get(key)
+            self._count(key, 'hits' if data is not None else 'misses')
+            return self.decode(data) if data is not None else None
+        data = self._get_local(key)
+        if data is not None:
+            return self.decode(data)
+        return self._loaded(key, self.get(key))
 
     def get_many_complex(self, keys):
         if not len(keys):
             return
-        values = self.kv.mget(keys)
-        for key, value in zip(keys, values):
-            if value is not None:
-                value = json.loads(value)
-            yield key, value
+        remote = []
+        for key in keys:
+            data = self._get_local(key)
+            if data is not None:
+                yield key, self.decode(data)
+            else:
+                remote.append(key)
+        if not len(remote):
+            return
+        values = self.kv.mget(remote)
+        for key, data in zip(remote, values):
+            yield key, self._loaded(key, data)
 
     def get_list(self, key):
         return self.kv.lrange(key, 0, -1)
 
+    def delete(self, *keys):
+        """Delete keys from redis and from the local tier of this process.
+        Other processes may serve the old values from their local tier
+        until these expire; use `bump` to invalidate them everywhere."""
+        if self.local is not None:
+            for key in keys:
+                self.local.delete(key)
+        if len(keys):
+            self.kv.delete(*keys)
+
     def lock(self, key, timeout=120):
         return self.kv.lock(key, timeout=timeout)
 
-    def flush(self, prefix=None):
-        prefix = prefix or self.prefix
-        keys = []
-        for key in self.kv.scan_iter(match='%s*' % prefix):
-            log.info("Flush: %s", key.decode('utf-8'))
-            keys.append(key)
-            if len(keys) > 0 and len(keys) % 1000 == 0:
-                self.kv.delete(*keys)
-                keys = []
-        if len(keys) > 0:
-            self.kv.delete(*keys)
+    def flush(self):
+        """Invalidate the whole cache in O(1), see `bump`."""
+        self.bump()
+        LocalCache.bump(self.kv)
+
+
+class LocalCache(object):
+    """A bounded, in-process LRU cache. Its entries are only valid while
+    a generation counter in redis stays the same: calling `bump` drops
+    the contents of all local caches, in all processes, or only those of
+    the given `scope`. The counters are read at most once per request,
+    or once per second outside of one. Values are returned as shallow
+    copies, since serializers modify the objects they're given.
+
+    With `max_bytes`, values must be strings and their total length is
+    bounded as well; values longer than a fraction of it aren't kept."""
+    GENERATION = 'local:generation'
+    # The largest value kept is this share of `max_bytes`:
+    MAX_VALUE_SHARE = 64
+
+    def __init__(self, kv, size=2048, max_bytes=None, expires=None,
+                 scope=None):
+        self.kv = kv
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.expires = expires
+        self.scope = scope
+        self.keys = [self.GENERATION]
+        if scope is not None:
+            self.keys.append(self.scope_key(scope))
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.current = None
+        self.checked_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def scope_key(cls, scope):
+        return '%s:%s' % (cls.GENERATION, scope)
+
+    def _load_generation(self):
+        generation = self.kv.mget(self.keys)
+        if generation[0] is None:
+            # Start from a unique value, so that a flushed redis doesn't
+            # revalidate entries cached before the flush:
+            self.kv.setnx(self.GENERATION, int(time() * 1000))
+            generation = self.kv.mget(self.keys)
+        return tuple(generation)
+
+    def generation(self):
+        if not has_request_context():
+            # Only count the time since the counters were last read, so
+            # that a busy worker still sees a bump within a second:
+            if time() - self.checked_at > 1:
+                self.checked_at = time()
+                return self._load_generation()
+            return self.current
+        if 'local_generations' not in g:
+            g.local_generations = {}
+        if self.scope not in g.local_generations:
+            g.local_generations[self.scope] = self._load_generation()
+        return g.local_generations[self.scope]
+
+    def _validate(self):
+        generation = self.generation()
+        if generation != self.current:
+            self.data.clear()
+            self.bytes = 0
+            self.current = generation
+
+    def _weight(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def _pop(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.bytes -= self._weight(entry[1])
+
+    def get(self, key):
+        with self.lock:
+            self._validate()
+            entry = self.data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time():
+                    self.hits += 1
+                    self.data.move_to_end(key)
+                    return copy(value)
+                self._pop(key)
+            self.misses += 1
+
+    def set(self, key, value):
+        expires_at = None
+        if self.expires is not None:
+            expires_at = time() + self.expires
+        weight = self._weight(value)
+        with self.lock:
+            self._validate()
+            self._pop(key)
+            if self.max_bytes is not None and \
+                    weight > self.max_bytes // self.MAX_VALUE_SHARE:
+                return
+            self.data[key] = (expires_at, copy(value))
+            self.bytes += weight
+            while len(self.data) > self.size or \
+                    (self.max_bytes is not None and
+                     self.bytes > self.max_bytes):
+                self._pop(next(iter(self.data)))
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    @classmethod
+    def bump(cls, kv, scope=None):
+        """Invalidate all local caches, or those of one scope."""
+        if scope is None:
+            kv.incr(cls.GENERATION)
+        else:
+            kv.incr(cls.scope_key(scope))
+        if has_request_context():
+            g.pop('local_generations', None)
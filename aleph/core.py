@@ -138,7 +138,12 @@ def get_archive():
 
 def get_cache():
     if not hasattr(settings, '_cache') or settings._cache is None:
-        settings._cache = Cache(get_redis(), prefix=settings.APP_NAME)
+        settings._cache = Cache(get_redis(),
+                                prefix=settings.APP_NAME,
+                                local_size=settings.CACHE_LOCAL_SIZE,
+                                local_bytes=settings.CACHE_LOCAL_BYTES,
+                                local_expires=settings.CACHE_LOCAL_EXPIRE,
+                                compress=settings.CACHE_COMPRESS)
     return settings._cache
 
 
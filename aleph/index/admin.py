@@ -2,7 +2,7 @@ import logging
 from pprint import pprint, pformat  # noqa
 
 from aleph.core import es
-from aleph.index.indexes import entities_read_index, configure_entities
+from aleph.index.indexes import entities_index_list, configure_entities
 from aleph.index.collections import collections_index, configure_collections
 from aleph.index.notifications import notifications_index, configure_notifications  # noqa
 from aleph.index.xref import xref_index, configure_xref  # noqa
@@ -19,12 +19,10 @@ def upgrade_search():
 
 
 def all_indexes():
-    return ','.join((
-        collections_index(),
-        notifications_index(),
-        xref_index(),
-        entities_read_index()
-    ))
+    # Deleting via an alias is not supported, so list concrete indexes:
+    indexes = [collections_index(), notifications_index(), xref_index()]
+    indexes.extend(entities_index_list())
+    return ','.join(indexes)
 
 
 def delete_index():
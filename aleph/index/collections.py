@@ -1,4 +1,5 @@
 import logging
+from time import time
 from pprint import pprint  # noqa
 from normality import normalize
 
@@ -7,10 +8,13 @@ from aleph.model import Entity, Collection
 from aleph.index.indexes import entities_read_index
 from aleph.index.util import index_name, index_settings, configure_index
 from aleph.index.util import query_delete, index_safe, refresh_sync
+from aleph.index.util import collection_routing
 from aleph.index.util import KEYWORD_COPY, KEYWORD
 
 STATS_FACETS = ['schema', 'names', 'addresses', 'phones', 'emails',
                 'countries', 'languages', 'ibans']
+# Marks a counts hash as complete, rather than created by an increment:
+COUNTS_SEEDED = '$'
 log = logging.getLogger(__name__)
 
 
@@ -102,67 +106,243 @@ def get_collection(collection_id):
     """Fetch a collection from the index."""
     if collection_id is None:
         return
-    key = cache.object_key(Collection, collection_id)
-    data = cache.get_complex(key)
-    if data is not None:
-        return data
+    return get_collections([collection_id]).get(collection_id)
 
-    collection = Collection.by_id(collection_id)
-    if collection is None:
-        return
 
-    data = collection.to_dict()
-    schemata = get_facet_values(collection.id, 'schema')
-    schemata = schemata.get('values', {})
-    data['count'] = sum(schemata.values())
-    data['schemata'] = schemata
-    cache.set_complex(key, data, expires=cache.EXPIRE)
-    return data
+def get_collections(collection_ids):
+    """Fetch a set of collections, using one cache lookup, one database
+    query and one lookup of entity counts for all of them. Returns a
+    dict keyed by the given IDs."""
+    collection_ids = list(collection_ids)
+    keys = cache.object_keys(Collection, collection_ids)
+    keys = dict(zip(keys, collection_ids))
+    collections = {}
+    for key, data in cache.get_many_complex(list(keys.keys())):
+        if data is not None:
+            collections[keys[key]] = data
+    missing = {str(c): c for c in collection_ids if c not in collections}
+    if len(missing):
+        items = []
+        for collection in Collection.all_by_ids(list(missing.keys())):
+            collection_id = missing[str(collection.id)]
+            data = collection.to_dict()
+            items.append((cache.object_key(Collection, collection_id), data))
+            collections[collection_id] = data
+        cache.set_many_complex(items, expires=cache.EXPIRE)
 
+    counts = get_entity_counts_many(list(collections.keys()))
+    for collection_id, data in collections.items():
+        schemata = counts.get(collection_id, {})
+        data['count'] = sum(schemata.values())
+        data['schemata'] = schemata
+    return collections
 
-def get_collection_stats(collection_id, refresh=False):
-    """Retrieve statistics on the content of a collection."""
-    return {f: get_facet_values(collection_id, f) for f in STATS_FACETS}
 
+def _counts_key(collection_id):
+    return cache.state_key(Collection.__name__, collection_id, 'counts')
 
-def update_collection_stats(collection_id):
-    for facet in STATS_FACETS:
-        get_facet_values(collection_id, facet, refresh=True)
+
+def _changed_key(*parts):
+    return cache.state_key(Collection.__name__, 'changed', *parts)
+
+
+def _reseed_key(*parts):
+    return cache.state_key(Collection.__name__, 'reseed', *parts)
+
+
+def updated_key(collection_id):
+    """Time of the last change to the given collection."""
+    return cache.state_key(Collection.__name__, collection_id, 'updated')
+
+
+def _touch(pipe, collection_id):
+    now = time()
+    pipe.sadd(_changed_key(), collection_id)
+    pipe.set(updated_key(collection_id), now, ex=cache.EXPIRE)
+
+
+def get_entity_counts(collection_id):
+    """Number of entities in a collection, by schema. These are kept up
+    to date while indexing, and seeded from the index in the background."""
+    return get_entity_counts_many([collection_id]).get(collection_id, {})
+
+
+def get_entity_counts_many(collection_ids):
+    """Entity counts for a set of collections. This never queries the
+    index: counts which have not been seeded yet are returned as they
+    were counted so far, and queued to be seeded by the worker."""
+    pipe = cache.kv.pipeline(transaction=False)
+    for collection_id in collection_ids:
+        pipe.hgetall(_counts_key(collection_id))
+    results = {}
+    unseeded = []
+    for collection_id, counts in zip(collection_ids, pipe.execute()):
+        counts = {k: int(v) for k, v in counts.items()}
+        if counts.pop(COUNTS_SEEDED, None) is None:
+            unseeded.append(collection_id)
+        results[collection_id] = counts
+    if len(unseeded):
+        cache.kv.sadd(_reseed_key(), *unseeded)
+    return {c: {k: v for k, v in counts.items() if v > 0}
+            for c, counts in results.items()}
+
+
+def get_indexed_schemata(collection_id):
+    """Schemata a collection has (or had) entities of, as counted while
+    indexing, or None if its counts have not been seeded."""
+    counts = cache.kv.hgetall(_counts_key(collection_id))
+    if counts.pop(COUNTS_SEEDED, None) is None:
+        return None
+    return list(counts.keys())
+
+
+def seed_entity_counts(collection_id, counts):
+    """Replace the entity counts of a collection."""
+    key = _counts_key(collection_id)
+    pipe = cache.kv.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, COUNTS_SEEDED, 1)
+    for schema, count in counts.items():
+        pipe.hset(key, schema, count)
+    pipe.execute()
+
+
+def reset_entity_counts(collection_id):
+    """Have the entity counts of a collection computed from the index
+    again by the next background update. The current counts are used
+    until then."""
+    pipe = cache.kv.pipeline(transaction=False)
+    pipe.sadd(_reseed_key(), collection_id)
+    _touch(pipe, collection_id)
+    pipe.execute()
+
+
+def update_entity_counts(changes):
+    """Apply a batch of changes to the entity counts, given as a mapping
+    of (collection_id, schema) to the number of entities added. All the
+    affected collections are marked as changed."""
+    pipe = cache.kv.pipeline(transaction=False)
+    for (collection_id, schema), delta in changes.items():
+        if delta != 0:
+            pipe.hincrby(_counts_key(collection_id), schema, delta)
+        _touch(pipe, collection_id)
+    pipe.execute()
+
+
+def mark_changed(collection_id):
+    pipe = cache.kv.pipeline(transaction=False)
+    _touch(pipe, collection_id)
+    pipe.execute()
 
 
-def get_facet_values(collection_id, facet, refresh=False):
+def _take_set(key):
+    # Move the members aside, together with any left over by a previous
+    # run which failed, so that new members are not lost:
+    pending = '%s:pending' % key
+    pipe = cache.kv.pipeline()
+    pipe.sunionstore(pending, [pending, key])
+    pipe.delete(key)
+    pipe.smembers(pending)
+    _, _, members = pipe.execute()
+    return set(int(m) for m in members)
+
+
+def take_changed():
+    """IDs of the collections that have changed, and of those whose entity
+    counts need to be reseeded. Both stay pending until they are passed
+    to `done_changed`."""
+    return _take_set(_changed_key()), _take_set(_reseed_key())
+
+
+def done_changed(collection_ids):
+    """Mark collections as processed after `take_changed`."""
+    collection_ids = list(collection_ids)
+    if len(collection_ids):
+        pipe = cache.kv.pipeline(transaction=False)
+        pipe.srem('%s:pending' % _changed_key(), *collection_ids)
+        pipe.srem('%s:pending' % _reseed_key(), *collection_ids)
+        pipe.execute()
+
+
+def _facets_key(collection_id):
+    # Not affected by cache flushes, so the last statistics can be shown
+    # until they have been computed again:
+    return cache.state_key(Collection.__name__, collection_id, 'facets')
+
+
+def get_collection_stats(collection_id):
+    """Retrieve statistics on the content of a collection, as last computed
+    by the worker. If there are none, they are queued to be computed."""
+    data = cache.get_complex(_facets_key(collection_id), local=False)
+    if data is None:
+        mark_changed(collection_id)
+        return {}
+    return data
+
+
+def get_facet_values(collection_id, facet):
     """Compute some statistics on the content of a collection."""
-    key = cache.object_key(Collection, collection_id, facet)
-    data = cache.get_complex(key)
-    if not refresh and data is not None:
-        return data
+    data = get_collection_stats(collection_id)
+    return data.get(facet, {'values': {}, 'total': 0})
 
+
+def _stats_query(collection_id):
+    aggs = {}
+    for facet in STATS_FACETS:
+        aggs['%s.values' % facet] = {'terms': {'field': facet, 'size': 300}}
+        aggs['%s.total' % facet] = {'cardinality': {'field': facet}}
     query = {'term': {'collection_id': collection_id}}
-    query = {
+    return {
         'size': 0,
+        'timeout': '20m',
         'query': {'bool': {'filter': [query]}},
-        'aggs': {
-            'values': {'terms': {'field': facet, 'size': 300}},
-            'total': {'cardinality': {'field': facet}}
-        }
+        'aggs': aggs
     }
-    index = entities_read_index(schema=Entity.THING)
-    result = es.search(index=index,
-                       body=query,
-                       request_timeout=3600,
-                       timeout='20m')
-    aggregations = result.get('aggregations')
-    values = {}
-    for bucket in aggregations.get('values').get('buckets', []):
-        values[bucket['key']] = bucket['doc_count']
-    data = {
-        'values': values,
-        'total': aggregations.get('total').get('value', 0)
-    }
-    cache.set_complex(key, data, expires=cache.EXPIRE)
+
+
+def _stats_result(result):
+    aggregations = result.get('aggregations', {})
+    data = {}
+    for facet in STATS_FACETS:
+        values = {}
+        buckets = aggregations.get('%s.values' % facet, {})
+        for bucket in buckets.get('buckets', []):
+            values[bucket['key']] = bucket['doc_count']
+        total = aggregations.get('%s.total' % facet, {})
+        data[facet] = {
+            'values': values,
+            'total': total.get('value', 0)
+        }
     return data
 
 
+def update_collection_stats(collection_ids):
+    """Compute all facets for a set of collections in one round trip
+    to the index and cache them as one document per collection. Only
+    the collections whose statistics could be computed are returned."""
+    index = entities_read_index(schema=Entity.THING)
+    body = []
+    for collection_id in collection_ids:
+        header = {'index': index}
+        routing = collection_routing(collection_id)
+        if routing is not None:
+            header['routing'] = routing
+        body.append(header)
+        body.append(_stats_query(collection_id))
+    result = es.msearch(body=body, request_timeout=3600)
+    stats = {}
+    for collection_id, res in zip(collection_ids, result.get('responses')):
+        if 'error' in res:
+            log.warning("Stats query error [%s]: %r",
+                        collection_id, res.get('error'))
+            continue
+        data = _stats_result(res)
+        cache.set(_facets_key(collection_id), cache.encode(data),
+                  expires=cache.EXPIRE)
+        stats[collection_id] = data
+    return stats
+
+
 def delete_collection(collection_id, sync=False):
     """Delete all documents from a particular collection."""
     es.delete(collections_index(),
@@ -171,10 +351,19 @@ def delete_collection(collection_id, sync=False):
               ignore=[404])
 
 
-def delete_entities(collection_id, mapping_id=None, schema=None, sync=False):
-    """Delete entities from a collection."""
+def delete_entities(collection_id, mapping_id=None, schema=None, sync=False,
+                    all_shards=False):
+    """Delete entities from a collection. Set `all_shards` to also catch
+    entities indexed before shard routing was enabled."""
     filters = [{'term': {'collection_id': collection_id}}]
     if mapping_id is not None:
         filters.append({'term': {'mapping_id': mapping_id}})
     query = {'bool': {'filter': filters}}
-    query_delete(entities_read_index(schema), query, sync=sync)
+    routing = None if all_shards else collection_routing(collection_id)
+    query_delete(entities_read_index(schema), query,
+                 sync=sync, routing=routing)
+    if mapping_id is None and schema is None:
+        seed_entity_counts(collection_id, {})
+        mark_changed(collection_id)
+    else:
+        reset_entity_counts(collection_id)
@@ -1,5 +1,9 @@
 import logging
 import fingerprints
+from time import time
+from datetime import datetime
+from functools import lru_cache
+from collections import Counter
 from pprint import pprint, pformat  # noqa
 from banal import ensure_list
 from followthemoney import model
@@ -7,11 +11,15 @@ from followthemoney.types import registry
 from elasticsearch.helpers import scan
 
 from aleph.core import es, cache
-from aleph.model import Entity
+from aleph.model import Entity, Permission
 from aleph.index.indexes import entities_write_index, entities_read_index
-from aleph.index.util import unpack_result, refresh_sync
-from aleph.index.util import authz_query, bulk_actions
-from aleph.index.util import MAX_PAGE, NUMERIC_TYPES
+from aleph.index.indexes import entities_index_list
+from aleph.index.collections import update_entity_counts
+from aleph.index.collections import get_indexed_schemata, mark_changed
+from aleph.index.util import unpack_result
+from aleph.index.util import bulk_actions, collection_routing
+from aleph.index.util import scan_sliced, entities_authz_query
+from aleph.index.util import BULK_PAGE, MAX_PAGE, NUMERIC_TYPES, ACL_FIELD
 from aleph.index.util import MAX_REQUEST_TIMEOUT, MAX_TIMEOUT
 
 
@@ -19,6 +27,9 @@ log = logging.getLogger(__name__)
 PROXY_INCLUDES = ['schema', 'properties']
 EXCLUDE_DEFAULT = ['text', 'fingerprints', 'names', 'phones', 'emails',
                    'identifiers', 'addresses', 'numeric.*']
+# Names and dates repeat heavily in tabular imports, memoize their
+# fingerprints and numeric casts in a bounded cache:
+MEMO_SIZE = 2 ** 16
 
 
 def _source_spec(includes, excludes):
@@ -29,16 +40,16 @@ def _source_spec(includes, excludes):
     return {'includes': includes, 'excludes': excludes}
 
 
-def _cache_entity(entity):
+def _cache_entities(entities):
     # Cache entities only briefly to avoid filling up redis
-    key = cache.object_key(Entity, entity.get('id'))
-    cache.set_complex(key, entity, expires=60 * 60 * 2)
+    items = [(cache.object_key(Entity, e.get('id')), e) for e in entities]
+    cache.set_many_complex(items, expires=60 * 60 * 2)
 
 
 def _entities_query(filters, authz, collection_id, schemata):
     filters = filters or []
     if authz is not None:
-        filters.append(authz_query(authz))
+        filters.append(entities_authz_query(authz))
     if collection_id is not None:
         filters.append({'term': {'collection_id': collection_id}})
     if ensure_list(schemata):
@@ -57,21 +68,78 @@ def get_field_type(field):
 
 
 def iter_entities(authz=None, collection_id=None, schemata=None,
-                  includes=None, excludes=None, filters=None, cached=False):
-    """Scan all entities matching the given criteria."""
+                  includes=None, excludes=None, filters=None, cached=False,
+                  slices=None):
+    """Scan all entities matching the given criteria. With more than one
+    slice, entities are read concurrently and yielded in no fixed order."""
     query = {
         'query': _entities_query(filters, authz, collection_id, schemata),
         '_source': _source_spec(includes, excludes)
     }
     index = entities_read_index(schema=schemata)
-    for res in scan(es, index=index, query=query,
+    batch = []
+    for res in scan_sliced(query, slices=slices, index=index,
+                           routing=collection_routing(collection_id),
+                           timeout=MAX_TIMEOUT,
+                           request_timeout=MAX_REQUEST_TIMEOUT):
+        entity = unpack_result(res)
+        if entity is None:
+            continue
+        if not cached:
+            yield entity
+            continue
+        # Cache before yielding, callers may modify the entities:
+        batch.append(entity)
+        if len(batch) >= BULK_PAGE:
+            _cache_entities(batch)
+            yield from batch
+            batch = []
+    if len(batch):
+        _cache_entities(batch)
+        yield from batch
+
+
+def has_unsorted_entities(authz=None, collection_id=None, schemata=None):
+    """Check if any of the matching entities lack the `id` field which
+    `iter_entities_sorted` sorts on, i.e. were indexed before it was
+    added and need to be re-indexed."""
+    filters = [{'bool': {'must_not': {'exists': {'field': 'id'}}}}]
+    query = _entities_query(filters, authz, collection_id, schemata)
+    result = es.search(index=entities_read_index(schema=schemata),
+                       routing=collection_routing(collection_id),
+                       body={'query': query, 'size': 0,
+                             'terminate_after': 1},
+                       request_timeout=MAX_REQUEST_TIMEOUT)
+    return result.get('hits', {}).get('total', {}).get('value', 0) > 0
+
+
+def iter_entities_sorted(authz=None, collection_id=None, schemata=None,
+                         includes=None, excludes=None, filters=None,
+                         after=None):
+    """Scroll through all matching entities in ID order. Yields `(sort,
+    entity)` pairs; passing the last `sort` value back in as `after`
+    continues a read that was interrupted. The scroll is sorted once, on
+    the `id` keyword field, and resumes with a range filter on it. Use
+    `has_unsorted_entities` to check that no entity lacks that field."""
+    filters = list(filters or [])
+    if after is not None:
+        filters.append({'range': {'id': {'gt': after[0]}}})
+    query = {
+        'query': _entities_query(filters, authz, collection_id, schemata),
+        '_source': _source_spec(includes, excludes),
+        'sort': [{'id': 'asc'}]
+    }
+    index = entities_read_index(schema=schemata)
+    for res in scan(es, query=query, index=index,
+                    preserve_order=True,
+                    size=BULK_PAGE,
+                    routing=collection_routing(collection_id),
                     timeout=MAX_TIMEOUT,
                     request_timeout=MAX_REQUEST_TIMEOUT):
+        sort = res.get('sort')
         entity = unpack_result(res)
         if entity is not None:
-            if cached:
-                _cache_entity(entity)
-            yield entity
+            yield sort, entity
 
 
 def iter_proxies(**kw):
@@ -91,27 +159,74 @@ def iter_adjacent(entity):
 
 
 def entities_by_ids(ids, schemata=None, cached=False,
-                    includes=None, excludes=None):
+                    includes=None, excludes=None, collection_id=None):
     """Iterate over unpacked entities based on a search for the given
     entity IDs."""
     ids = ensure_list(ids)
     if not len(ids):
         return
     index = entities_read_index(schema=schemata)
+    query = {'ids': {'values': ids}}
+    if collection_id is not None:
+        filters = [query, {'term': {'collection_id': collection_id}}]
+        query = {'bool': {'filter': filters}}
     query = {
-        'query': {'ids': {'values': ids}},
+        'query': query,
         '_source': _source_spec(includes, excludes),
         'size': MAX_PAGE
     }
-    result = es.search(index=index, body=query)
+    result = es.search(index=index, body=query,
+                       routing=collection_routing(collection_id))
+    entities = []
     for doc in result.get('hits', {}).get('hits', []):
         entity = unpack_result(doc)
         if entity is not None:
-            if cached:
-                _cache_entity(entity)
+            entities.append(entity)
+    if cached:
+        _cache_entities(entities)
+    yield from entities
+
+
+def _mget_entities(docs, includes=None, excludes=None):
+    """Fetch documents given as `(entity_id, index, collection_id)` tuples
+    in one multi-get. Gets are realtime, so this also sees documents which
+    have not been refreshed yet."""
+    source = _source_spec(includes, excludes)
+    body = []
+    for (entity_id, index, collection_id) in docs:
+        doc = {'_index': index, '_id': entity_id, '_source': source}
+        routing = collection_routing(collection_id)
+        if routing is not None:
+            doc['routing'] = routing
+        body.append(doc)
+    if not len(body):
+        return
+    result = es.mget(body={'docs': body})
+    for doc in result.get('docs', []):
+        if 'error' in doc:
+            log.warning("Entity fetch error [%s]: %r",
+                        doc.get('_id'), doc.get('error'))
+            continue
+        entity = unpack_result(doc)
+        if entity is not None:
             yield entity
 
 
+def entities_by_keys(keys, includes=None, excludes=None):
+    """Fetch entities whose schema and collection are already known, given
+    as `(entity_id, schema, collection_id)` tuples, in one multi-get from
+    the index of each schema. Returns a dict keyed by entity ID."""
+    docs = set()
+    for (entity_id, schema, collection_id) in keys:
+        schema = model.get(schema)
+        if entity_id is None or schema is None or schema.abstract:
+            continue
+        for index in entities_index_list(schema, expand=False):
+            docs.add((entity_id, index, collection_id))
+    entities = _mget_entities(docs, includes=includes, excludes=excludes)
+    return {e.get('id'): e for e in entities}
+
+
 def get_entity(entity_id, **kwargs):
     """Fetch an entity from the index."""
     if entity_id is None:
@@ -135,22 +250,153 @@ def index_entity(entity, sync=False):
 
 
 def index_proxy(collection, proxy, sync=False):
-    delete_entity(proxy.id, exclude=proxy.schema, sync=False)
     return index_bulk(collection, [proxy], {}, sync=sync)
 
 
 def index_bulk(collection, entities, extra, sync=False):
     """Index a set of entities."""
-    entities = (format_proxy(p, collection, extra) for p in entities)
-    bulk_actions(entities, sync=sync)
+    extra = dict(extra)
+    extra[ACL_FIELD] = Permission.read_roles(collection.id)
+
+    def _flush(batch):
+        return _delete_stale(format_proxies(batch, collection, extra))
+
+    def _generate():
+        batch = []
+        for proxy in entities:
+            batch.append(proxy)
+            if len(batch) >= BULK_PAGE:
+                yield from _flush(batch)
+                batch = []
+        yield from _flush(batch)
+    bulk_actions(_generate(), sync=sync)
+    # Stamp the change again once it has been written, see `Query.search`:
+    mark_changed(collection.id)
+
+
+def _delete_action(entity):
+    action = {
+        '_op_type': 'delete',
+        '_id': entity.get('id'),
+        '_index': entity.get('_index'),
+    }
+    routing = collection_routing(entity.get('collection_id'))
+    if routing is not None:
+        action['_routing'] = routing
+    return action
+
+
+def _existing_copies(actions):
+    """Indexed copies of the entities about to be written. For collections
+    whose schemata are known from the entity counts, the indexes of those
+    schemata are read with a realtime multi-get, which also sees documents
+    that have not been refreshed yet (e.g. during a bulk load). Otherwise,
+    the copies are searched for in all indexes."""
+    docs = set()
+    searched = []
+    indexes = {}
+    for action in actions:
+        collection_id = action['_source'].get('collection_id')
+        if collection_id not in indexes:
+            schemata = get_indexed_schemata(collection_id)
+            if schemata is not None and len(schemata):
+                schemata = list(entities_index_list(schemata, expand=False))
+            indexes[collection_id] = schemata
+        if indexes[collection_id] is None:
+            searched.append(action['_id'])
+            continue
+        docs.add((action['_id'], action['_index'], collection_id))
+        for index in indexes[collection_id]:
+            docs.add((action['_id'], index, collection_id))
+    includes = ['collection_id', 'schema']
+    yield from _mget_entities(docs, includes=includes)
+    yield from entities_by_ids(searched, includes=includes)
+
+
+def _delete_stale(actions):
+    """Emit the given index actions, preceded by deletes for copies of the
+    same entities in other indexes, e.g. after a change of schema. This
+    needs only one lookup for the whole batch, which is also used to keep
+    the entity counts of the collections up to date."""
+    if not len(actions):
+        return
+    targets = {a['_id']: a for a in actions}
+    created = set(targets.keys())
+    changes = Counter()
+    for entity in _existing_copies(actions):
+        action = targets.get(entity.get('id'))
+        if entity.get('_index') == action['_index']:
+            # An existing entity is being updated:
+            created.discard(entity.get('id'))
+        else:
+            changes[(entity.get('collection_id'), entity.get('schema'))] -= 1
+            yield _delete_action(entity)
+    for action in actions:
+        source = action['_source']
+        key = (source.get('collection_id'), source.get('schema'))
+        # Updates don't change the counts, but mark the collection changed:
+        changes[key] = changes.get(key, 0) + int(action['_id'] in created)
+    update_entity_counts(changes)
+    yield from actions
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _fingerprint(name):
+    return fingerprints.generate(name)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _to_number(type_, value):
+    return type_.to_number(value)
+
+
+@lru_cache(maxsize=None)
+def _numeric_props(schema):
+    """Properties of the given schema which are also indexed as numbers."""
+    props = schema.properties.values()
+    return {p.name: p.type for p in props if p.type in NUMERIC_TYPES}
 
 
 def _numeric_values(type_, values):
-    values = [type_.to_number(v) for v in ensure_list(values)]
+    values = [_to_number(type_, v) for v in ensure_list(values)]
     return [v for v in values if v is not None]
 
 
-def format_proxy(proxy, collection, extra):
+def _format_stats_key():
+    return cache.state_key('index', 'format')
+
+
+def format_stats():
+    """Number of entities formatted for the index, and the time spent on
+    them, summed over all workers."""
+    stats = cache.kv.hgetall(_format_stats_key())
+    return {
+        'entities': int(stats.get('entities', 0)),
+        'seconds': float(stats.get('seconds', 0.0))
+    }
+
+
+def format_proxies(proxies, collection, extra):
+    """Apply final denormalisations to a batch of entities. Values which
+    are the same for the whole batch are only computed once."""
+    start_time = time()
+    extra = dict(extra)
+    # Unlike `updated_at`, this is when the entity was written to the index:
+    extra['indexed_at'] = datetime.utcnow()
+    routing = collection_routing(collection.id)
+    actions = [format_proxy(p, collection, extra, routing) for p in proxies]
+    duration = time() - start_time
+    if len(actions):
+        pipe = cache.kv.pipeline()
+        pipe.hincrby(_format_stats_key(), 'entities', len(actions))
+        pipe.hincrbyfloat(_format_stats_key(), 'seconds', duration)
+        pipe.execute()
+        log.debug("Formatted %d entities: %.2fms/entity",
+                  len(actions), (duration * 1000) / len(actions))
+    return actions
+
+
+def format_proxy(proxy, collection, extra, routing):
     """Apply final denormalisations to the index."""
     proxy.context = {}
     proxy = collection.ns.apply(proxy)
@@ -161,7 +407,7 @@ def format_proxy(proxy, collection, extra):
     data['collection_id'] = collection.id
 
     names = ensure_list(data.get('names'))
-    fps = set([fingerprints.generate(name) for name in names])
+    fps = set([_fingerprint(name) for name in names])
     fps.update(names)
     data['fingerprints'] = [fp for fp in fps if fp is not None]
 
@@ -178,10 +424,9 @@ def format_proxy(proxy, collection, extra):
 
     # integer casting
     numeric = {}
-    for prop, values in properties.items():
-        prop = proxy.schema.get(prop)
-        if prop.type in NUMERIC_TYPES:
-            numeric[prop.name] = _numeric_values(prop.type, values)
+    for prop, type_ in _numeric_props(proxy.schema).items():
+        if prop in properties:
+            numeric[prop] = _numeric_values(type_, properties[prop])
     # also cast group field for dates
     numeric['dates'] = _numeric_values(registry.date, data.get('dates'))
     data['numeric'] = numeric
@@ -190,21 +435,25 @@ def format_proxy(proxy, collection, extra):
     data.update(extra)
 
     # log.info("%s", pformat(data))
-    entity_id = data.pop('id')
-    return {
+    # The ID is also kept as a field, with doc values to sort on:
+    entity_id = data.get('id')
+    action = {
         '_id': entity_id,
         '_index': entities_write_index(data.get('schema')),
         '_source': data
     }
-
-
-def delete_entity(entity_id, exclude=None, sync=False):
-    """Delete an entity from the index."""
-    if exclude is not None:
-        exclude = entities_write_index(exclude)
-    for entity in entities_by_ids(entity_id, excludes='*'):
-        index = entity.get('_index')
-        if index == exclude:
-            continue
-        es.delete(index=index, id=entity_id, ignore=[404],
-                  refresh=refresh_sync(sync))
+    if routing is not None:
+        action['_routing'] = routing
+    return action
+
+
+def delete_entity(entity_id, sync=False):
+    """Delete an entity from all indexes it is stored in."""
+    entities = entities_by_ids(entity_id, includes=['collection_id', 'schema'])
+    entities = list(entities)
+    changes = Counter()
+    for entity in entities:
+        changes[(entity.get('collection_id'), entity.get('schema'))] -= 1
+    if len(entities):
+        bulk_actions([_delete_action(e) for e in entities], sync=sync)
+        update_entity_counts(changes)
@@ -8,7 +8,7 @@ from aleph.core import settings
 from aleph.index.util import index_name
 from aleph.index.util import index_settings, configure_index, get_shard_weight
 from aleph.index.util import NUMERIC_TYPES, PARTIAL_DATE, KEYWORD
-from aleph.index.util import LATIN_TEXT, NUMERIC
+from aleph.index.util import LATIN_TEXT, NUMERIC, ACL_FIELD
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +19,12 @@ TYPE_MAPPINGS = {
     registry.date: PARTIAL_DATE,
 }
 
+# Sets of schemata which are frequently queried together are exposed as
+# aliases spanning the indexes of all their (non-abstract) descendants,
+# e.g. `aleph-entities-legalentity-v1`. This keeps the index list sent
+# to ES short for broad queries.
+SCHEMA_GROUPS = ('Thing', 'Document', 'LegalEntity', 'Interval', 'Record')
+
 
 def schema_index(schema, version):
     """Convert a schema object to an index name."""
@@ -28,6 +34,19 @@ def schema_index(schema, version):
     return index_name(name, version=version)
 
 
+def group_alias(group, version):
+    """Name of the alias that spans all indexes of a schema group."""
+    name = 'entities-%s' % model.get(group).name.lower()
+    return index_name(name, version=version)
+
+
+def schema_groups(schema):
+    """All schema groups the given schema is a member of."""
+    for group in SCHEMA_GROUPS:
+        if schema in schema_scope(group):
+            yield group
+
+
 def schema_scope(schema, expand=True):
     schemata = set()
     names = ensure_list(schema) or model.schemata.values()
@@ -50,7 +69,28 @@ def entities_index_list(schema=None, expand=True):
 
 
 def entities_read_index(schema=None, expand=True):
-    indexes = entities_index_list(schema=schema, expand=expand)
+    """Generate the narrowest index expression for the given schemata,
+    using a group alias wherever all members of a group are queried."""
+    schemata = set(schema_scope(schema, expand=expand))
+    groups = []
+    for group in SCHEMA_GROUPS:
+        members = set(schema_scope(group))
+        if not members.issubset(schemata):
+            continue
+        # Skip groups which are fully contained in a larger group:
+        if any(members.issubset(set(schema_scope(g))) for g in groups):
+            continue
+        groups.append(group)
+    covered = set()
+    for group in groups:
+        covered.update(schema_scope(group))
+    indexes = []
+    for version in settings.INDEX_READ:
+        for group in groups:
+            indexes.append(group_alias(group, version))
+        remaining = schemata.difference(covered)
+        for schema in sorted(remaining, key=lambda s: s.name):
+            indexes.append(schema_index(schema, version))
     return ','.join(indexes)
 
 
@@ -60,6 +100,12 @@ def entities_write_index(schema):
     return schema_index(schema, settings.INDEX_WRITE)
 
 
+def entities_write_list():
+    """All indexes that new entities can be written to."""
+    for schema in schema_scope(None):
+        yield schema_index(schema, settings.INDEX_WRITE)
+
+
 def configure_entities():
     for schema in model.schemata.values():
         if not schema.abstract:
@@ -92,10 +138,12 @@ def configure_schema(schema, version):
                 "boost": 3.0,
                 "copy_to": "text"
             },
+            "id": KEYWORD,
             "schema": KEYWORD,
             "schemata": KEYWORD,
             "foreign_id": KEYWORD,
             "collection_id": KEYWORD,
+            ACL_FIELD: KEYWORD,
             "job_id": KEYWORD,
             "mapping_id": KEYWORD,
             "keywords": KEYWORD,
@@ -142,8 +190,11 @@ def configure_schema(schema, version):
                 "properties": numeric_mapping
             },
             "updated_at": {"type": "date"},
+            "indexed_at": {"type": "date"},
         }
     }
-    index = schema_index(model.get(schema), version)
+    schema = model.get(schema)
+    index = schema_index(schema, version)
+    aliases = [group_alias(g, version) for g in schema_groups(schema)]
     settings = index_settings(shards=get_shard_weight(schema))
-    return configure_index(index, mapping, settings)
+    return configure_index(index, mapping, settings, aliases=aliases)
@@ -1,18 +1,28 @@
+import json
 import logging
+import threading
+from time import time
+from queue import Queue, Full
 from pprint import pprint  # noqa
 from banal import ensure_list
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from redis.exceptions import WatchError
 from elasticsearch import TransportError
-from elasticsearch.helpers import streaming_bulk
+from elasticsearch.helpers import expand_action, scan
 from followthemoney.types import registry
 from servicelayer.util import backoff, service_retries
 
-from aleph.core import es, settings
+from aleph.core import es, kv, cache, settings
 
 log = logging.getLogger(__name__)
 
 BULK_PAGE = 500
+BULK_PAGE_MIN = 10
+BULK_LOAD_KEY = 'bulkload'
+BULK_LOAD_EXPIRE = 86400
 # cf. https://www.elastic.co/guide/en/elasticsearch/reference/current/search-request-from-size.html  # noqa
 MAX_PAGE = 9999
+ACL_FIELD = 'roles'
 NUMERIC_TYPES = (registry.number, registry.date,)
 MAX_TIMEOUT = '700m'
 MAX_REQUEST_TIMEOUT = 84600
@@ -64,6 +74,17 @@ def index_name(name, version):
     return '-'.join((settings.INDEX_PREFIX, name, version))
 
 
+def collection_routing(collection_ids):
+    """Shard routing value for entities in the given collection(s). This
+    is `None` unless routing is enabled, so it can always be passed on."""
+    if not settings.INDEX_ROUTING:
+        return None
+    collection_ids = [str(c) for c in ensure_list(collection_ids)]
+    if not len(collection_ids):
+        return None
+    return ','.join(sorted(set(collection_ids)))
+
+
 def unpack_result(res):
     """Turn a document hit from ES into a more traditional JSON object."""
     error = res.get('error')
@@ -98,6 +119,71 @@ def authz_query(authz, field='collection_id'):
     return {'terms': {field: collections}}
 
 
+def entities_authz_query(authz, field='collection_id'):
+    """Generate a search filter for the entity indexes. With INDEX_ACL,
+    this matches the user's roles against those stamped on each entity.
+    The xref index uses the same stamps, for the collection given in
+    `field`."""
+    if authz.is_admin or not settings.INDEX_ACL:
+        return authz_query(authz, field=field)
+    query = {'terms': {ACL_FIELD: sorted(authz.roles)}}
+    pending = acl_pending()
+    if not len(pending):
+        return query
+    # Collections with a permission change that has not yet been stamped
+    # onto their entities are checked by their ID instead:
+    pending = sorted(pending)
+    readable = authz.collections(authz.READ)
+    readable = [c for c in pending if c in readable]
+    stamped = {'bool': {
+        'filter': [query],
+        'must_not': [{'terms': {field: pending}}]
+    }}
+    return {'bool': {
+        'should': [stamped, {'terms': {field: readable}}],
+        'minimum_should_match': 1
+    }}
+
+
+def _acl_pending_key():
+    return cache.state_key('acl', 'pending', 'gen')
+
+
+def acl_pending():
+    """IDs of collections whose entities need to be re-stamped."""
+    return set(int(c) for c in kv.hkeys(_acl_pending_key()))
+
+
+def acl_mark_pending(collection_id):
+    """Flag a permission change. Each change bumps a generation, so that
+    a re-stamping run which began before it doesn't clear the flag."""
+    kv.hincrby(_acl_pending_key(), collection_id, 1)
+
+
+def acl_generation(collection_id):
+    """Current generation of the pending flag of a collection, to be read
+    before re-stamping it and passed to `acl_mark_done`."""
+    return kv.hget(_acl_pending_key(), collection_id)
+
+
+def acl_mark_done(collection_id, generation):
+    """Clear the pending flag of a collection, unless it has been set
+    again since `generation` was read."""
+    if generation is None:
+        return
+    key = _acl_pending_key()
+    with kv.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.hget(key, collection_id) != generation:
+                return
+            pipe.multi()
+            pipe.hdel(key, collection_id)
+            pipe.execute()
+        except WatchError:
+            log.info("ACL changed while re-stamping: %s", collection_id)
+
+
 def bool_query():
     return {
         'bool': {
@@ -153,24 +239,293 @@ def query_delete(index, query, sync=False, **kwargs):
             backoff(failures=attempt)
 
 
+def query_update(index, query, script, sync=False, **kwargs):
+    "Apply a script to all documents matching the given query."
+    for attempt in service_retries():
+        try:
+            es.update_by_query(index=index,
+                               body={'query': query, 'script': script},
+                               conflicts='proceed',
+                               wait_for_completion=sync,
+                               refresh=refresh_sync(sync),
+                               request_timeout=MAX_REQUEST_TIMEOUT,
+                               timeout=MAX_TIMEOUT,
+                               **kwargs)
+            return
+        except TransportError as exc:
+            if int(exc.status_code) in (400, 403):
+                raise
+            log.warning("Query update failed: %s", exc)
+            backoff(failures=attempt)
+
+
+class BulkIndexer(object):
+    """Write a stream of actions to the index. Requests are cut into
+    chunks bounded both by the number of actions and by their serialized
+    size, and several chunks can be in flight at once. When the cluster
+    rejects writes (HTTP 429), the chunk size is halved and then slowly
+    grows back towards its configured maximum."""
+
+    def __init__(self, chunk_size=BULK_PAGE, max_bytes=None, threads=None,
+                 sync=False):
+        self.max_size = chunk_size
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes or settings.INDEX_BULK_BYTES
+        self.threads = max(1, threads or settings.INDEX_BULK_THREADS)
+        self.refresh = refresh_sync(sync)
+        self.lock = threading.Lock()
+        self.docs = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def serialize(self, action):
+        meta, source = expand_action(action)
+        lines = [es.transport.serializer.dumps(meta)]
+        if source is not None:
+            lines.append(es.transport.serializer.dumps(source))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+    def chunks(self, actions):
+        chunk, size = [], 0
+        for action in actions:
+            data = self.serialize(action)
+            full = len(chunk) >= self.chunk_size
+            if len(chunk) and (full or size + len(data) > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(data)
+            size += len(data)
+        if len(chunk):
+            yield chunk
+
+    def throttle(self):
+        with self.lock:
+            self.chunk_size = max(BULK_PAGE_MIN, self.chunk_size // 2)
+        log.warning("Bulk write rejected, chunk size: %d", self.chunk_size)
+
+    def recover(self):
+        with self.lock:
+            size = self.chunk_size + max(1, self.chunk_size // 10)
+            self.chunk_size = min(self.max_size, size)
+
+    def send(self, chunk):
+        """Submit a chunk of serialized actions, retrying the requests or
+        individual items that were rejected by the cluster."""
+        for attempt in service_retries():
+            try:
+                res = es.bulk(body=b''.join(chunk),
+                              refresh=self.refresh,
+                              request_timeout=MAX_REQUEST_TIMEOUT,
+                              timeout=MAX_TIMEOUT)
+            except TransportError as exc:
+                if exc.status_code in (400, 403):
+                    raise
+                if exc.status_code == 429:
+                    self.throttle()
+                else:
+                    log.warning("Bulk write failed: %s", exc)
+                backoff(failures=attempt)
+                continue
+            rejected = []
+            for data, item in zip(chunk, res.get('items', [])):
+                op_type, details = item.popitem()
+                status = details.get('status', 500)
+                if status == 429:
+                    rejected.append(data)
+                elif op_type == 'delete' and status == 404:
+                    continue
+                elif status > 299:
+                    log.warning("Error during index: %r", details)
+                    with self.lock:
+                        self.errors += 1
+            size = sum(len(d) for d in chunk) - sum(len(d) for d in rejected)
+            with self.lock:
+                self.docs += len(chunk) - len(rejected)
+                self.bytes += size
+            if not len(rejected):
+                self.recover()
+                return
+            self.throttle()
+            chunk = rejected
+            backoff(failures=attempt)
+        log.error("Bulk write gave up on %d actions.", len(chunk))
+        with self.lock:
+            self.errors += len(chunk)
+
+    def write(self, actions):
+        start_time = time()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = set()
+            for chunk in self.chunks(actions):
+                pending.add(executor.submit(self.send, chunk))
+                # Don't serialize the whole stream ahead of the cluster:
+                if len(pending) >= self.threads * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+        duration = max(0.001, time() - start_time)
+        level = logging.INFO if self.docs > self.max_size else logging.DEBUG
+        log.log(level, "Bulk write: %d docs, %.1f docs/s, %.1f KB/s, %d err",
+                self.docs, self.docs / duration,
+                self.bytes / duration / 1024, self.errors)
+
+
+def _scan_put(queue, stop, item):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _scan_slice(queue, stop, query, slice_id, slices, kwargs):
+    query = dict(query)
+    query['slice'] = {'id': slice_id, 'max': slices}
+    try:
+        for res in scan(es, query=query, **kwargs):
+            if not _scan_put(queue, stop, res):
+                return
+    except Exception as exc:
+        _scan_put(queue, stop, exc)
+    finally:
+        _scan_put(queue, stop, None)
+
+
+def scan_sliced(query, slices=None, **kwargs):
+    """Scroll through all results of a query. If more than one slice is
+    requested, the scroll is split into independent slices which are read
+    concurrently. Results are then yielded in no particular order."""
+    slices = slices or settings.INDEX_SCAN_SLICES
+    if slices <= 1:
+        yield from scan(es, query=query, **kwargs)
+        return
+    queue = Queue(maxsize=slices * 1000)
+    stop = threading.Event()
+    threads = []
+    for slice_id in range(slices):
+        args = (queue, stop, query, slice_id, slices, kwargs)
+        thread = threading.Thread(target=_scan_slice, args=args, daemon=True)
+        thread.start()
+        threads.append(thread)
+    try:
+        active = slices
+        while active > 0:
+            res = queue.get()
+            if res is None:
+                active -= 1
+            elif isinstance(res, Exception):
+                raise res
+            else:
+                yield res
+    finally:
+        stop.set()
+
+
 def bulk_actions(actions, chunk_size=BULK_PAGE, sync=False):
     """Bulk indexing with timeouts, bells and whistles."""
-    # start_time = time()
-    stream = streaming_bulk(es, actions,
-                            chunk_size=chunk_size,
-                            max_retries=10,
-                            initial_backoff=2,
-                            yield_ok=False,
-                            raise_on_error=False,
-                            refresh=refresh_sync(sync),
-                            request_timeout=MAX_REQUEST_TIMEOUT,
-                            timeout=MAX_TIMEOUT)
-    for _, details in stream:
-        if details.get('delete', {}).get('status') == 404:
-            continue
-        log.warning("Error during index: %r", details)
-    # duration = (time() - start_time)
-    # log.debug("Bulk write: %.4fs", duration)
+    indexer = BulkIndexer(chunk_size=chunk_size, sync=sync)
+    indexer.write(actions)
+    return indexer
+
+
+def bulk_load_refreshed_key():
+    """Time at which the last bulk load window was closed, and the writes
+    made during it became visible."""
+    return cache.state_key(BULK_LOAD_KEY, 'refreshed')
+
+
+def _bulk_load_restore(indexes):
+    stored = kv.hgetall(cache.state_key(BULK_LOAD_KEY, 'settings'))
+    for index, config in stored.items():
+        log.info("Bulk load finished: %s", index)
+        es.indices.put_settings(index=index,
+                                body={'index': json.loads(config)},
+                                ignore=[404])
+    kv.delete(cache.state_key(BULK_LOAD_KEY, 'settings'))
+    if len(stored):
+        es.indices.refresh(index=','.join(indexes), ignore_unavailable=True)
+        kv.set(bulk_load_refreshed_key(), time())
+
+
+def bulk_load_open(job_id, indexes):
+    """Open a bulk load window for a job. While any window is open, the
+    given indexes are not refreshed and have fewer replicas. Windows are
+    reference-counted across jobs and processes via redis."""
+    if not settings.INDEX_BULK_LOAD:
+        return
+    indexes = list(indexes)
+    key = cache.state_key(BULK_LOAD_KEY, 'jobs')
+    with cache.lock(cache.state_key(BULK_LOAD_KEY, 'lock')):
+        now = time()
+        kv.zremrangebyscore(key, 0, now - BULK_LOAD_EXPIRE)
+        if kv.zadd(key, {job_id: now}) == 0 or kv.zcard(key) > 1:
+            return
+        log.info("Bulk load started [%s]: %d indexes", job_id, len(indexes))
+        indexes = ','.join(indexes)
+        stored_key = cache.state_key(BULK_LOAD_KEY, 'settings')
+        # Keep the original settings if an expired window never restored
+        # them, rather than storing the bulk load settings instead:
+        if not kv.exists(stored_key):
+            current = es.indices.get_settings(index=indexes,
+                                              ignore_unavailable=True)
+            for index, config in current.items():
+                config = config.get('settings', {}).get('index', {})
+                kv.hset(stored_key, index, json.dumps({
+                    'refresh_interval': config.get('refresh_interval'),
+                    'number_of_replicas': config.get('number_of_replicas'),
+                }))
+        body = {
+            'index': {
+                'refresh_interval': '-1',
+                'number_of_replicas': settings.INDEX_BULK_REPLICAS
+            }
+        }
+        es.indices.put_settings(index=indexes, body=body,
+                                ignore_unavailable=True)
+
+
+def bulk_load_active():
+    """Whether a bulk load window is open, in which case searches may not
+    see all the entities that have been written."""
+    if not settings.INDEX_BULK_LOAD:
+        return False
+    key = cache.state_key(BULK_LOAD_KEY, 'jobs')
+    return kv.zcount(key, time() - BULK_LOAD_EXPIRE, '+inf') > 0
+
+
+def bulk_load_started():
+    """Time at which the oldest open bulk load window was opened, or None.
+    Writes made since may not be visible to searches yet."""
+    if not settings.INDEX_BULK_LOAD:
+        return None
+    key = cache.state_key(BULK_LOAD_KEY, 'jobs')
+    jobs = kv.zrangebyscore(key, time() - BULK_LOAD_EXPIRE, '+inf',
+                            start=0, num=1, withscores=True)
+    for (_, started) in jobs:
+        return started
+
+
+def bulk_load_close(job_id, indexes):
+    """Release the bulk load window of a job. Once no more jobs hold one,
+    the index settings are restored and the indexes are refreshed. Pass
+    a `job_id` of `None` to only release windows that have expired."""
+    if not settings.INDEX_BULK_LOAD:
+        return
+    key = cache.state_key(BULK_LOAD_KEY, 'jobs')
+    if job_id is not None and kv.zscore(key, job_id) is None:
+        # The job never opened a window:
+        return
+    with cache.lock(cache.state_key(BULK_LOAD_KEY, 'lock')):
+        if job_id is not None:
+            kv.zrem(key, job_id)
+        kv.zremrangebyscore(key, 0, time() - BULK_LOAD_EXPIRE)
+        if kv.zcard(key) == 0:
+            _bulk_load_restore(indexes)
 
 
 def index_safe(index, id, body, **kwargs):
@@ -227,11 +582,12 @@ def check_settings_changed(updated, existing):
     return False
 
 
-def configure_index(index, mapping, settings):
+def configure_index(index, mapping, settings, aliases=None):
     """Create or update a search index with the given mapping and
     settings. This will try to make a new index, or update an
     existing mapping with new properties.
     """
+    aliases = ensure_list(aliases)
     if es.indices.exists(index=index):
         log.info("Configuring index: %s...", index)
         options = {
@@ -251,12 +607,15 @@ def configure_index(index, mapping, settings):
             if not _check_response(index, res):
                 return False
             res = es.indices.open(**options)
+        for alias in aliases:
+            es.indices.put_alias(index=index, name=alias)
         return True
     else:
         log.info("Creating index: %s...", index)
         body = {
             'settings': settings,
-            'mappings': mapping
+            'mappings': mapping,
+            'aliases': {alias: {} for alias in aliases}
         }
         res = es.indices.create(index, body=body, ignore=[400])
         return True
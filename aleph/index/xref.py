@@ -5,11 +5,12 @@ from datetime import datetime
 from followthemoney.types import registry
 from elasticsearch.helpers import scan
 
-from aleph.core import settings, es
+from aleph.core import settings, es, cache
 from aleph.index.util import index_name, index_settings, configure_index
+from aleph.model import Permission
 from aleph.index.util import query_delete, bulk_actions, unpack_result
-from aleph.index.util import authz_query
-from aleph.index.util import KEYWORD, SHARDS_HEAVY
+from aleph.index.util import query_update, entities_authz_query
+from aleph.index.util import KEYWORD, SHARDS_HEAVY, ACL_FIELD
 
 log = logging.getLogger(__name__)
 
@@ -28,8 +29,12 @@ def configure_xref():
             'collection_id': KEYWORD,
             'match_id': KEYWORD,
             'match_collection_id': KEYWORD,
+            # Roles which can read the collection of the match:
+            ACL_FIELD: KEYWORD,
+            'against_collection_ids': KEYWORD,
             registry.country.group: KEYWORD,
             'schema': KEYWORD,
+            'entity_schema': KEYWORD,
             'text': {'type': 'text', 'analyzer': 'latin_index'},
             'created_at': {'type': 'date'},
         }
@@ -38,15 +43,65 @@ def configure_xref():
     return configure_index(xref_index(), mapping, settings)
 
 
-def index_matches(collection, matches, sync=False):
-    """Index cross-referencing matches."""
+def xref_id(collection_id, entity_id, match_id):
+    return hash_data((entity_id, collection_id, match_id))
+
+
+def _watermark_key(collection_id):
+    return cache.state_key('xref', collection_id, 'watermark')
+
+
+def get_watermark(collection_id):
+    """Start time of the last complete cross-referencing run of the
+    collection, or None if there has not been one."""
+    return cache.kv.get(_watermark_key(collection_id))
+
+
+def _pending_watermark_key(job_id):
+    return cache.state_key('xref', 'watermark', job_id)
+
+
+def set_pending_watermark(job_id, timestamp):
+    """Remember the start time of a run, to become the watermark of the
+    collection once all tasks of the job are done."""
+    key = _pending_watermark_key(job_id)
+    cache.kv.set(key, timestamp.isoformat(), ex=cache.EXPIRE)
+
+
+def discard_watermark(job_id):
+    """Don't advance the watermark for a job which failed or was
+    cancelled, so that the next run covers its changes again."""
+    cache.kv.delete(_pending_watermark_key(job_id))
+
+
+def commit_watermark(collection_id, job_id):
+    """Advance the watermark of the collection to the start of a finished
+    run, if the job was one. An older run finishing late doesn't move it
+    backwards."""
+    timestamp = cache.kv.get(_pending_watermark_key(job_id))
+    if timestamp is None:
+        return
+    current = get_watermark(collection_id)
+    if current is None or current < timestamp:
+        cache.kv.set(_watermark_key(collection_id), timestamp)
+    discard_watermark(job_id)
+
+
+def index_matches(collection, matches, sync=False,
+                  against_collection_ids=None):
+    """Index cross-referencing matches. Matches from a run limited to some
+    target collections are tagged with their IDs."""
+    against = [str(c) for c in ensure_list(against_collection_ids)]
+    roles = {}
     actions = []
     for (score, entity, match_collection_id, match) in matches:
-        xref_id = hash_data((entity.id, collection.id, match.id))
+        if match_collection_id not in roles:
+            read_roles = Permission.read_roles(match_collection_id)
+            roles[match_collection_id] = read_roles
         text = ensure_list(entity.get_type_values(registry.name))
         text.extend(match.get_type_values(registry.name))
         actions.append({
-            '_id': xref_id,
+            '_id': xref_id(collection.id, entity.id, match.id),
             '_index': xref_index(),
             '_source': {
                 'score': score,
@@ -54,8 +109,11 @@ def index_matches(collection, matches, sync=False):
                 'collection_id': collection.id,
                 'match_id': match.id,
                 'match_collection_id': match_collection_id,
+                ACL_FIELD: roles[match_collection_id],
+                'against_collection_ids': against,
                 'countries': match.get_type_values(registry.country),
                 'schema': match.schema.name,
+                'entity_schema': entity.schema.name,
                 'text': text,
                 'created_at': datetime.utcnow(),
             }
@@ -69,12 +127,23 @@ def index_matches(collection, matches, sync=False):
 def iter_matches(collection, authz):
     """Scan all matching xref results, does not support sorting."""
     filters = [{'term': {'collection_id': collection.id}},
-               authz_query(authz, field='match_collection_id')]
+               entities_authz_query(authz, field='match_collection_id')]
     query = {'query': {'bool': {'filter': filters}}}
     for res in scan(es, index=xref_index(), query=query):
         yield unpack_result(res)
 
 
+def restamp_xref(collection_id, sync=False):
+    """Update the roles stamped on matches with entities of the given
+    collection, after its permissions have changed."""
+    query = {'term': {'match_collection_id': collection_id}}
+    script = {
+        'source': 'ctx._source.%s = params.roles' % ACL_FIELD,
+        'params': {'roles': Permission.read_roles(collection_id)}
+    }
+    query_update(xref_index(), query, script, sync=sync)
+
+
 def get_xref(xref_id, collection_id=None):
     """Get an xref match combo by its ID."""
     filters = [{'ids': {'values': [xref_id]}}]
@@ -86,8 +155,22 @@ def get_xref(xref_id, collection_id=None):
         return unpack_result(doc)
 
 
-def delete_xref(collection, entity_id=None, sync=False):
-    """Delete xref matches of an entity or a collection."""
+def delete_xref(collection, entity_id=None, against_collection_ids=None,
+                sync=False):
+    """Delete xref matches of an entity or a collection. If target
+    collections are given, only the matches of the collection with those
+    are deleted."""
+    against = ensure_list(against_collection_ids)
+    if entity_id is None and not len(against):
+        # Without its matches, the next run has to start from scratch:
+        cache.kv.delete(_watermark_key(collection.id))
+    if entity_id is None and len(against):
+        filters = [
+            {'term': {'collection_id': collection.id}},
+            {'terms': {'match_collection_id': against}},
+        ]
+        query_delete(xref_index(), {'bool': {'filter': filters}}, sync=sync)
+        return
     shoulds = [
         {'term': {'collection_id': collection.id}},
         {'term': {'match_collection_id': collection.id}},
@@ -104,3 +187,30 @@ def delete_xref(collection, entity_id=None, sync=False):
         }
     }
     query_delete(xref_index(), query, sync=sync)
+
+
+def delete_stale_xref(collection, entity_ids=None, match_ids=None, keep=None,
+                      sync=False):
+    """Delete the matches of a collection found for the given entities of
+    the collection, or with the given candidates from other collections,
+    except for those with an xref ID in `keep`."""
+    shoulds = []
+    entity_ids = ensure_list(entity_ids)
+    if len(entity_ids):
+        shoulds.append({'terms': {'entity_id': entity_ids}})
+    match_ids = ensure_list(match_ids)
+    if len(match_ids):
+        shoulds.append({'terms': {'match_id': match_ids}})
+    if not len(shoulds):
+        return
+    query = {
+        'bool': {
+            'filter': [{'term': {'collection_id': collection.id}}],
+            'should': shoulds,
+            'minimum_should_match': 1
+        }
+    }
+    keep = ensure_list(keep)
+    if len(keep):
+        query['bool']['must_not'] = [{'ids': {'values': keep}}]
+    query_delete(xref_index(), query, sync=sync)
@@ -6,7 +6,7 @@ from aleph.authz import Authz
 from aleph.core import db, es
 from aleph.model import Alert, Events, Entity
 from aleph.index.indexes import entities_read_index
-from aleph.index.util import unpack_result, authz_query
+from aleph.index.util import unpack_result, entities_authz_query
 from aleph.logic.notifications import publish
 
 log = logging.getLogger(__name__)
@@ -18,6 +18,12 @@ def get_alert(alert_id):
         return alert.to_dict()
 
 
+def get_alerts(alert_ids):
+    ids = {str(a): a for a in alert_ids}
+    alerts = Alert.all_by_ids(list(ids.keys()), deleted=True)
+    return {ids[str(a.id)]: a.to_dict() for a in alerts}
+
+
 def check_alerts():
     """Go through all alerts."""
     for alert_id in list(Alert.all_ids()):
@@ -74,7 +80,7 @@ def alert_query(alert, authz):
             'minimum_should_match': '90%'
         }
     }]
-    filters = [authz_query(authz)]
+    filters = [entities_authz_query(authz)]
     if alert.notified_at is not None:
         notified_at = alert.notified_at.isoformat()
         filters.append({'range': {'updated_at': {'gt': notified_at}}})
@@ -0,0 +1,164 @@
+# Cross-referencing of one collection against a set of others without
+# running a search for each entity. Both sides are read once and reduced to
+# blocking keys (name tokens, identifiers, IBANs, emails, phone numbers).
+# Keys are spilled to an SQLite file and joined there to find the pairs of
+# entities which share at least one of them, which are then scored in
+# batches.
+import json
+import shutil
+import sqlite3
+import logging
+import fingerprints
+from time import time
+from tempfile import mkdtemp
+from normality import normalize
+from servicelayer.archive.util import ensure_path
+from followthemoney import model
+from followthemoney.types import registry
+
+from aleph.index.entities import iter_proxies
+from aleph.logic.scoring import score_pairs
+
+log = logging.getLogger(__name__)
+KEY_TYPES = [registry.identifier, registry.iban, registry.email,
+             registry.phone]
+# Keys shared by more entities than this on either side (e.g. common
+# first names) are too unspecific to produce useful candidates:
+MAX_KEY_FREQUENCY = 100
+MIN_TOKEN_LENGTH = 3
+BATCH_SIZE = 1000
+LEFT = 0
+RIGHT = 1
+
+
+def blocking_keys(proxy):
+    """Generate the blocking keys for an entity."""
+    keys = set()
+    for name in proxy.names:
+        fp = fingerprints.generate(name)
+        for token in (fp or '').split():
+            if len(token) >= MIN_TOKEN_LENGTH:
+                keys.add('name:%s' % token)
+    for type_ in KEY_TYPES:
+        for value in proxy.get_type_values(type_):
+            value = normalize(value, ascii=True)
+            if value is not None:
+                value = value.replace(' ', '')
+                keys.add('%s:%s' % (type_.name, value))
+    return keys
+
+
+class BlockingIndex(object):
+    """Blocking keys and entity data for both sides of a comparison, kept
+    in an SQLite database in a temporary directory."""
+
+    def __init__(self):
+        self.path = ensure_path(mkdtemp(prefix='aleph.xref.'))
+        self.conn = sqlite3.connect(str(self.path.joinpath('xref.sqlite3')))
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('CREATE TABLE entities (side INTEGER, '
+                          'id TEXT, collection_id TEXT, data TEXT, '
+                          'PRIMARY KEY (side, id))')
+        self.conn.execute('CREATE TABLE keys (key TEXT, side INTEGER, '
+                          'id TEXT)')
+
+    def load(self, side, collection_id, proxies):
+        entities = 0
+        for proxy in proxies:
+            data = json.dumps(proxy.to_dict())
+            self.conn.execute('INSERT OR IGNORE INTO entities '
+                              'VALUES (?, ?, ?, ?)',
+                              (side, proxy.id, str(collection_id), data))
+            keys = [(k, side, proxy.id) for k in blocking_keys(proxy)]
+            self.conn.executemany('INSERT INTO keys VALUES (?, ?, ?)', keys)
+            entities += 1
+        self.conn.commit()
+        return entities
+
+    def candidates(self):
+        """Pairs of entity IDs which share a blocking key, ordered by the
+        left-hand entity."""
+        self.conn.execute('CREATE INDEX keys_key ON keys (key, side)')
+        self.conn.execute('CREATE TABLE usable AS SELECT key FROM keys '
+                          'GROUP BY key HAVING '
+                          'SUM(side = 0) BETWEEN 1 AND ? AND '
+                          'SUM(side = 1) BETWEEN 1 AND ?',
+                          (MAX_KEY_FREQUENCY, MAX_KEY_FREQUENCY))
+        cursor = self.conn.execute('SELECT DISTINCT l.id, r.id '
+                                   'FROM usable u '
+                                   'JOIN keys l ON l.key = u.key '
+                                   'JOIN keys r ON r.key = u.key '
+                                   'WHERE l.side = 0 AND r.side = 1 '
+                                   'AND l.id != r.id '
+                                   'ORDER BY l.id')
+        yield from cursor
+
+    def get(self, side, entity_id):
+        row = self.conn.execute('SELECT collection_id, data FROM entities '
+                                'WHERE side = ? AND id = ?',
+                                (side, entity_id)).fetchone()
+        if row is not None:
+            return row[0], model.get_proxy(json.loads(row[1]))
+
+    def close(self):
+        self.conn.close()
+        shutil.rmtree(self.path)
+
+
+def _score_batch(index, batch, proxies, cutoff):
+    pairs = []
+    collection_ids = []
+    rights = {}
+    for (left_id, right_id) in batch:
+        if left_id not in proxies:
+            proxies.clear()
+            proxies[left_id] = index.get(LEFT, left_id)
+        if right_id not in rights:
+            rights[right_id] = index.get(RIGHT, right_id)
+        _, left = proxies[left_id]
+        collection_id, right = rights[right_id]
+        pairs.append((left, right))
+        collection_ids.append(collection_id)
+    scores = score_pairs(pairs)
+    for (left, right), collection_id, score in zip(pairs, collection_ids,
+                                                   scores):
+        if score >= cutoff:
+            yield score, left, collection_id, right
+
+
+def xref_blocking(collection, against_collection_ids, schemata, cutoff):
+    """Generate scored matches between the entities of `collection` with
+    the given schemata and those in the target collections."""
+    index = BlockingIndex()
+    try:
+        begin = time()
+        entities = iter_proxies(collection_id=collection.id,
+                                schemata=schemata)
+        count = index.load(LEFT, collection.id, entities)
+        for collection_id in against_collection_ids:
+            entities = iter_proxies(collection_id=collection_id,
+                                    schemata=schemata)
+            count += index.load(RIGHT, collection_id, entities)
+        log.info("Xref [%s]: loaded %d entities (%.1fs)",
+                 collection.foreign_id, count, time() - begin)
+
+        begin = time()
+        pairs = 0
+        batch = []
+        # Pairs are sorted by their left-hand entity, which is only read
+        # once for all of its candidates:
+        proxies = {}
+        for pair in index.candidates():
+            batch.append(pair)
+            if len(batch) >= BATCH_SIZE:
+                yield from _score_batch(index, batch, proxies, cutoff)
+                pairs += len(batch)
+                batch = []
+        yield from _score_batch(index, batch, proxies, cutoff)
+        pairs += len(batch)
+        took = max(time() - begin, 0.001)
+        log.info("Xref [%s]: scored %d candidates (%.1f candidates/s)",
+                 collection.foreign_id, pairs, pairs / took)
+    finally:
+        index.close()
@@ -9,16 +9,22 @@ from aleph.model import Collection, Entity, Document, Diagram, Mapping
 from aleph.model import Permission, Events, Linkage
 from aleph.index import collections as index
 from aleph.index import xref as xref_index
+from aleph.index.util import acl_generation, acl_mark_done
+from aleph.index.util import bulk_load_active
 from aleph.logic.notifications import publish, flush_notifications
 from aleph.logic.aggregator import get_aggregator, drop_aggregator
 
 log = logging.getLogger(__name__)
+# Number of collections to compute statistics for in one request:
+STATS_BATCH = 20
 
 
 def create_collection(data, authz, sync=False):
     now = datetime.utcnow()
     collection = Collection.create(data, authz, created_at=now)
     if collection.created_at == now:
+        # A new collection has no entities to count yet:
+        index.seed_entity_counts(collection.id, {})
         publish(Events.CREATE_COLLECTION,
                 params={'collection': collection},
                 channels=[collection, authz.role],
@@ -39,41 +45,79 @@ def refresh_collection(collection_id, sync=True):
     domain object. This will refresh stats and flush cache."""
     if collection_id is None:
         return
-    keys = [
-        cache.object_key(Collection, collection_id),
-        cache.object_key(Collection, collection_id, 'stats')
-    ]
     if sync:
-        keys.append(cache.object_key(Collection, collection_id, 'schema'))
-    cache.kv.delete(*keys)
-
-
-def compute_collections():
+        # Drop all cached data derived from the collection at once:
+        cache.bump(Collection.__name__, collection_id)
+    else:
+        # Keep the facets, they are re-computed in the background:
+        cache.delete(cache.object_key(Collection, collection_id),
+                     cache.object_key(Collection, collection_id, 'stats'))
+    index.mark_changed(collection_id)
+
+
+def compute_collections(reconcile=False):
+    """Re-compute the statistics of the collections which have changed
+    since the last run, fetching them from the index in batches. Entity
+    counts which have been reset are seeded from the index again. With
+    `reconcile`, all collections are re-computed and their entity counts
+    are reset from the index, to correct any drift."""
+    changed, reseed = index.take_changed()
+    pending = changed.union(reseed)
+    batch = []
     for collection in Collection.all():
-        compute_collection(collection, sync=False)
+        pending.discard(collection.id)
+        if not reconcile and collection.id not in changed.union(reseed):
+            continue
+        batch.append(collection)
+        if len(batch) >= STATS_BATCH:
+            _compute_batch(batch, reconcile=reconcile, reseed=reseed)
+            batch = []
+    _compute_batch(batch, reconcile=reconcile, reseed=reseed)
+    # Collections which have been deleted since they changed:
+    index.done_changed(pending)
+
+
+def _compute_batch(collections, reconcile=False, reseed=(), sync=False):
+    if not len(collections):
+        return
+    for collection in collections:
+        log.info("Collection [%s] changed, computing...", collection.id)
+    stats = index.update_collection_stats([c.id for c in collections])
+    seed = not bulk_load_active()
+    done = []
+    for collection in collections:
+        if collection.id not in stats:
+            continue
+        key = cache.object_key(Collection, collection.id, 'stats')
+        cache.set(key, 'computed', expires=cache.EXPIRE - 60)
+        if seed and (reconcile or collection.id in reseed):
+            counts = stats[collection.id]['schema']['values']
+            index.seed_entity_counts(collection.id, counts)
+        index.index_collection(collection, sync=sync)
+        if seed or collection.id not in reseed:
+            done.append(collection.id)
+    index.done_changed(done)
 
 
 def compute_collection(collection, sync=False):
     key = cache.object_key(Collection, collection.id, 'stats')
     if cache.get(key) and not sync:
         return
-    cache.set(key, 'computed', expires=cache.EXPIRE - 60)
-    log.info("Collection [%s] changed, computing...", collection.id)
-    index.update_collection_stats(collection.id)
-    index.index_collection(collection, sync=sync)
+    _compute_batch([collection], reconcile=sync, sync=sync)
+
+
+def _collection_proxies(collection):
+    for entity in Entity.by_collection(collection.id).yield_per(5000):
+        yield entity.to_proxy()
+    for document in Document.by_collection(collection.id).yield_per(5000):
+        yield document.to_proxy()
 
 
 def process_collection(stage, collection, ingest=True, sync=False):
     """Trigger a full re-parse of all documents and re-build the
     search index from the aggregator."""
-    def _proxies(collection):
-        for entity in Entity.by_collection(collection.id).yield_per(5000):
-            yield entity.to_proxy()
-        for document in Document.by_collection(collection.id).yield_per(5000):
-            yield document.to_proxy()
-
     aggregator = get_aggregator(collection)
-    for proxy in _proxies(collection):
+    for proxy in _collection_proxies(collection):
         if ingest and proxy.schema.is_a(Document.SCHEMA):
             ingest_entity(collection, proxy,
                           job_id=stage.job.id,
@@ -87,6 +131,29 @@ def process_collection(stage, collection, ingest=True, sync=False):
     aggregator.close()
 
 
+def reindex_collection(stage, collection, flush=False, sync=False):
+    """Re-build the search index of a collection from the database and
+    the aggregator, without re-ingesting documents. If `flush` is set,
+    existing index entries are deleted first; this is needed to apply a
+    change to the shard routing. This also re-stamps the entities with
+    the roles that can read the collection, also on the cross-referencing
+    matches with its entities."""
+    from aleph.logic.processing import index_aggregate
+    # Read before the roles are, see `acl_mark_done`:
+    generation = acl_generation(collection.id)
+    if flush:
+        index.delete_entities(collection.id, sync=True, all_shards=True)
+    aggregator = get_aggregator(collection)
+    for proxy in _collection_proxies(collection):
+        aggregator.put(proxy, fragment='db')
+    aggregator.close()
+    index_aggregate(stage, collection, sync=sync)
+    # Wait for the matches to be updated before the collection is no
+    # longer checked by its ID:
+    xref_index.restamp_xref(collection.id, sync=True)
+    acl_mark_done(collection.id, generation)
+
+
 def reset_collection(collection, sync=False):
     """Reset the collection by deleting any derived data."""
     drop_aggregator(collection)
@@ -12,6 +12,12 @@ def get_diagram(diagram_id):
     return Diagram.by_id(diagram_id)
 
 
+def get_diagrams(diagram_ids):
+    ids = {str(d): d for d in diagram_ids}
+    diagrams = Diagram.all_by_ids(list(ids.keys()))
+    return {ids[str(d.id)]: d for d in diagrams}
+
+
 def create_diagram(collection, data, authz):
     """Create a network diagram. This will create or update any entities
     that already exist in the diagram and sign their IDs into the collection.
@@ -1,51 +1,205 @@
 import os
+import shutil
 import logging
 import requests
-import zipstream
+from tempfile import mkdtemp
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from flask import render_template
+from flask_babel import gettext
+from werkzeug.datastructures import MultiDict
+from servicelayer.archive.util import ensure_path
 from followthemoney import model
+from followthemoney.export.csv import CSVExporter
 from followthemoney.export.excel import ExcelExporter
 
-from aleph.core import archive
-from aleph.logic import resolver
-from aleph.model import Collection
-from aleph.logic.util import entity_url
+from aleph.core import es, archive, settings, url_external
+from aleph.authz import Authz
+from aleph.mail import email_role
+from aleph.model import Role
+from aleph.queues import queue_export
+from aleph.search import EntitiesQuery, SearchQueryParser
+from aleph.index.util import unpack_result, BULK_PAGE
+from aleph.index.util import MAX_TIMEOUT, MAX_REQUEST_TIMEOUT
+from aleph.index.collections import get_collection
+from aleph.logic.util import entity_url, archive_claim_token
 
 log = logging.getLogger(__name__)
 EXTRA_HEADERS = ['url', 'collection']
+FORMAT_XLSX = 'xlsx'
+FORMAT_CSV = 'csv'
+FORMATS = (FORMAT_XLSX, FORMAT_CSV)
+EXPORT_FILE = 'Query_export.zip'
+EXPORT_MIME = 'application/zip'
+ARCHIVE_PATH = '/api/2/archive'
+CHUNK_SIZE = 1024 * 1024
 
 
-def write_document(zip_archive, collection, entity):
-    if not entity.has('contentHash', quiet=True):
-        return
-    name = entity.first('fileName') or entity.caption
-    name = "{0}-{1}".format(entity.id, name)
-    path = os.path.join(collection.get('label'), name)
-    content_hash = entity.first('contentHash')
-    url = archive.generate_url(content_hash)
-    if url is not None:
-        stream = requests.get(url, stream=True)
-        zip_archive.write_iter(path, stream.iter_content())
+def queue_search_export(authz, args, format=FORMAT_XLSX):
+    """Schedule an export of the results of a search, which is sent to the
+    user by email when done."""
+    payload = {
+        'role_id': authz.id,
+        'args': list(args.items(multi=True)),
+        'format': format
+    }
+    queue_export(payload)
+
+
+def iter_search_entities(parser):
+    """Page through the results of a search in the order of the search
+    (by relevance, unless sorted otherwise), up to EXPORT_MAX_RESULTS,
+    without loading them into memory all at once."""
+    query = EntitiesQuery(parser)
+    body = {
+        'query': {
+            'bool': {
+                'must': [query.get_query()],
+                'filter': [query.get_post_filters()]
+            }
+        },
+        'sort': (query.get_sort() or ['_score']) + query.SORT_TIEBREAK,
+        '_source': query.get_source()
+    }
+    index = query.get_index()
+    routing = query.get_routing()
+    count = 0
+    while count < settings.EXPORT_MAX_RESULTS:
+        body['size'] = min(BULK_PAGE, settings.EXPORT_MAX_RESULTS - count)
+        result = es.search(index=index,
+                           routing=routing,
+                           body=body,
+                           timeout=MAX_TIMEOUT,
+                           request_timeout=MAX_REQUEST_TIMEOUT)
+        hits = result.get('hits', {}).get('hits', [])
+        for hit in hits:
+            entity = unpack_result(hit)
+            if entity is not None:
+                yield entity
+        count += len(hits)
+        if len(hits) < body['size']:
+            return
+        body['search_after'] = hits[-1].get('sort')
+
+
+def write_entities(work_path, entities, format=FORMAT_XLSX):
+    """Write entities to an Excel workbook or a set of CSV files in the
+    working directory. Returns the table files and a mapping of content
+    hashes to the paths the matching documents should be stored as."""
+    if format == FORMAT_CSV:
+        table_path = work_path.joinpath('tables')
+        exporter = CSVExporter(table_path, extra=EXTRA_HEADERS)
+    else:
+        table_path = work_path.joinpath('Export.xlsx')
+        exporter = ExcelExporter(str(table_path), extra=EXTRA_HEADERS)
+    collections = {}
+    documents = {}
+    for data in entities:
+        collection_id = data.get('collection_id')
+        if collection_id not in collections:
+            collections[collection_id] = get_collection(collection_id) or {}
+        label = collections[collection_id].get('label')
+        proxy = model.get_proxy(data)
+        exporter.write(proxy, extra=[entity_url(proxy.id), label])
+        if proxy.has('contentHash', quiet=True):
+            name = proxy.first('fileName') or proxy.caption
+            name = '{0}-{1}'.format(proxy.id, name)
+            path = os.path.join(label or collection_id, name)
+            content_hash = proxy.first('contentHash')
+            documents.setdefault(content_hash, []).append(path)
+    exporter.finalize()
+    if table_path.is_dir():
+        tables = sorted(table_path.glob('*.csv'))
     else:
-        local_path = archive.load_file(content_hash)
-        if local_path is not None:
-            zip_archive.write(local_path, arcname=path)
-
-
-def export_entities(request, result):
-    entities = []
-    for entity in result.results:
-        resolver.queue(result, Collection, entity.get('collection_id'))
-        entities.append(model.get_proxy(entity))
-    resolver.resolve(result)
-    zip_archive = zipstream.ZipFile()
-    exporter = ExcelExporter(None, extra=EXTRA_HEADERS)
-    for entity in entities:
-        collection_id = entity.context.get('collection_id')
-        collection = resolver.get(result, Collection, collection_id)
-        extra = [entity_url(entity.id), collection.get('label')]
-        exporter.write(entity, extra=extra)
-        write_document(zip_archive, collection, entity)
-    content = exporter.get_bytesio()
-    zip_archive.write_iter('Export.xlsx', content)
-    for chunk in zip_archive:
-        yield chunk
+        tables = [table_path]
+    return tables, documents
+
+
+def _fetch_document(session, work_path, content_hash):
+    url = archive.generate_url(content_hash)
+    if url is None:
+        return archive.load_file(content_hash, temp_path=work_path), False
+    file_path = work_path.joinpath(content_hash)
+    with session.get(url, stream=True) as res:
+        res.raise_for_status()
+        with open(file_path, 'wb') as fh:
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                fh.write(chunk)
+    return file_path, True
+
+
+def write_documents(zip_file, work_path, documents):
+    """Download the given archive blobs concurrently and add them to the
+    zip file as they arrive."""
+    threads = max(1, settings.EXPORT_FETCH_THREADS)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {}
+        for content_hash in documents.keys():
+            future = executor.submit(_fetch_document, session,
+                                     work_path, content_hash)
+            futures[future] = content_hash
+        for future in as_completed(futures):
+            content_hash = futures[future]
+            try:
+                file_path, downloaded = future.result()
+            except Exception as exc:
+                log.warning("Cannot export file [%s]: %s", content_hash, exc)
+                continue
+            if file_path is not None:
+                for path in documents[content_hash]:
+                    zip_file.write(file_path, arcname=path,
+                                   compress_type=ZIP_STORED)
+            if downloaded:
+                os.unlink(file_path)
+            else:
+                archive.cleanup_file(content_hash, temp_path=work_path)
+    session.close()
+
+
+def export_entities(role_id=None, args=None, format=FORMAT_XLSX):
+    """Build the zip file for a search export in the archive and send a
+    download link to the user who asked for it."""
+    role = Role.by_id(role_id)
+    if role is None:
+        log.error("Export role not found: %s", role_id)
+        return
+    authz = Authz.from_role(role)
+    parser = SearchQueryParser(MultiDict(args or []), authz)
+    work_path = ensure_path(mkdtemp(prefix='aleph.export.'))
+    try:
+        zip_path = work_path.joinpath(EXPORT_FILE)
+        with ZipFile(zip_path, 'w', ZIP_DEFLATED, allowZip64=True) as zf:
+            entities = iter_search_entities(parser)
+            tables, documents = write_entities(work_path, entities,
+                                               format=format)
+            for table in tables:
+                zf.write(table, arcname=table.name)
+            write_documents(zf, work_path, documents)
+        content_hash = archive.archive_file(zip_path, mime_type=EXPORT_MIME)
+    finally:
+        shutil.rmtree(work_path)
+    log.info("Export [%r]: %s (%s documents)", role, content_hash,
+             len(documents))
+    notify_export(role, authz, content_hash)
+
+
+def notify_export(role, authz, content_hash):
+    # The link is followed outside the application, so it carries its own
+    # API token, scoped to the archive endpoint:
+    claim = archive_claim_token(role.id, content_hash,
+                                file_name=EXPORT_FILE,
+                                mime_type=EXPORT_MIME)
+    token = authz.to_token(scope=ARCHIVE_PATH).decode('utf-8')
+    url = url_external(ARCHIVE_PATH, [('claim', claim), ('api_key', token)])
+    params = dict(url=url,
+                  role=role,
+                  ui_url=settings.APP_UI_URL,
+                  app_title=settings.APP_TITLE)
+    plain = render_template('email/export.txt', **params)
+    html = render_template('email/export.html', **params)
+    email_role(role, gettext('Your export is ready'), html=html, plain=plain)
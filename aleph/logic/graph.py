@@ -9,7 +9,8 @@ from aleph.model import Entity
 from aleph.logic import resolver
 from aleph.index.entities import _source_spec, PROXY_INCLUDES
 from aleph.index.indexes import entities_read_index
-from aleph.index.util import field_filter_query, authz_query, unpack_result
+from aleph.index.util import field_filter_query, unpack_result
+from aleph.index.util import entities_authz_query
 
 log = logging.getLogger(__name__)
 
@@ -48,7 +49,7 @@ class GraphQuery(object):
         self.patterns = []
         self.filters = []
         if authz is not None:
-            self.filters.append(authz_query(authz))
+            self.filters.append(entities_authz_query(authz))
         if collection_ids is not None:
             filter_ = field_filter_query('collection_id', collection_ids)
             self.filters.append(filter_)
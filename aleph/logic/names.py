@@ -3,11 +3,11 @@ import logging
 from functools import reduce
 from banal import ensure_list
 from normality import normalize
-from elasticsearch.helpers import scan
 
-from aleph.core import es, kv
+from aleph.core import kv
 from aleph.model import Entity
 from aleph.index.indexes import entities_read_index
+from aleph.index.util import scan_sliced
 
 log = logging.getLogger(__name__)
 TOKEN_KEY = 'namefreq:tokens'
@@ -22,13 +22,14 @@ def name_tokens(name):
     return [n for n in name.split(' ') if len(n) > 1]
 
 
-def iter_tokens(limit=1000000000):
+def iter_tokens(limit=1000000000, slices=None):
     """Go through all the names in the index."""
     query = {'_source': {'include': 'names'}}
     index = entities_read_index(schema=Entity.LEGAL_ENTITY)
     seen = 0
     try:
-        for res in scan(es, index=index, query=query, scroll='1440m'):
+        for res in scan_sliced(query, slices=slices, index=index,
+                               scroll='1440m'):
             names = ensure_list(res.get('_source', {}).get('names'))
             tokens = set()
             for name in names:
@@ -44,14 +45,14 @@ def iter_tokens(limit=1000000000):
         log.warning("Token iterator aborted: %s", ex)
 
 
-def compute_name_frequencies():
+def compute_name_frequencies(slices=None):
     """Compute a numeric distribution of name frequencies."""
     # Count how often each name part (i.e. token) shows up across
     # the whole of the dataset or a sample.
     pipe = kv.pipeline(transaction=False)
     pipe.delete(TOKEN_KEY)
     names_count = 0
-    for idx, token in enumerate(iter_tokens()):
+    for idx, token in enumerate(iter_tokens(slices=slices)):
         pipe.hincrby(TOKEN_KEY, token, 1)
         names_count += 1
         if idx > 0 and idx % 10000 == 0:
@@ -2,6 +2,8 @@ import logging
 
 from aleph.core import db
 from aleph.model import Permission, Events, Role
+from aleph.queues import queue_task, OP_REINDEX
+from aleph.index.util import acl_mark_pending
 from aleph.logic.notifications import GLOBAL, publish
 from aleph.logic.roles import refresh_role
 
@@ -11,6 +13,8 @@ log = logging.getLogger(__name__)
 def update_permission(role, collection, read, write, editor_id=None):
     """Update a roles permission to access a given collection."""
     pre = Permission.by_collection_role(collection, role)
+    # Grant updates the same object, keep the previous read flag:
+    was_read = pre is not None and pre.deleted_at is None and pre.read
     post = Permission.grant(collection, role, read, write)
     params = {'role': role, 'collection': collection}
     if (pre is None or not pre.read) and post.read:
@@ -26,4 +30,8 @@ def update_permission(role, collection, read, write, editor_id=None):
                     channels=[role])
     db.session.commit()
     refresh_role(role)
+    if was_read != post.read:
+        # Entities carry the roles that can read them, re-stamp them:
+        acl_mark_pending(collection.id)
+        queue_task(collection, OP_REINDEX)
     return post
@@ -5,22 +5,23 @@
 #
 import logging
 from normality import stringify
-from collections import defaultdict
+from collections import defaultdict, Counter
 
 from aleph.core import cache
 from aleph.model import Role, Collection, Alert, Entity, Diagram
-from aleph.logic.roles import get_role
-from aleph.logic.alerts import get_alert
-from aleph.logic.diagrams import get_diagram
-from aleph.index.collections import get_collection
+from aleph.logic.roles import get_roles
+from aleph.logic.alerts import get_alerts
+from aleph.logic.diagrams import get_diagrams
+from aleph.index.collections import get_collections
 from aleph.index.entities import entities_by_ids
 
 log = logging.getLogger(__name__)
+# Each loader fetches a batch of objects and returns them keyed by ID:
 LOADERS = {
-    Role: get_role,
-    Collection: get_collection,
-    Alert: get_alert,
-    Diagram: get_diagram
+    Role: get_roles,
+    Collection: get_collections,
+    Alert: get_alerts,
+    Diagram: get_diagrams
 }
 
 
@@ -29,6 +30,8 @@ def _instrument_stub(stub):
         stub._rx_queue = set()
     if not hasattr(stub, '_rx_cache'):
         stub._rx_cache = {}
+    if not hasattr(stub, '_rx_trace'):
+        stub._rx_trace = Counter()
 
 
 def queue(stub, clazz, key, schema=None):
@@ -44,34 +47,49 @@ def queue(stub, clazz, key, schema=None):
 
 def resolve(stub):
     _instrument_stub(stub)
-    cache_keys = {}
-    schemata = {}
+    pending = defaultdict(dict)
     for clazz, key, schema in stub._rx_queue:
-        if (clazz, key) in stub._rx_cache:
+        if (clazz, key) not in stub._rx_cache:
+            pending[clazz][key] = schema
+
+    entities = pending.pop(Entity, {})
+    if len(entities):
+        _resolve_entities(stub, entities)
+
+    for clazz, keys in pending.items():
+        loader = LOADERS.get(clazz)
+        if loader is None:
             continue
+        stub._rx_trace[clazz.__name__] += 1
+        loaded = loader(list(keys.keys()))
+        for key in keys.keys():
+            stub._rx_cache[(clazz, key)] = loaded.get(key)
+    log.debug("Resolver loads: %s", dict(stub._rx_trace))
 
-        cid = cache.object_key(clazz, key)
-        cache_keys[cid] = (clazz, key)
-        schemata[cid] = schema
 
-    keys = list(cache_keys.keys())
+def _resolve_entities(stub, entities):
+    keys = {cache.object_key(Entity, k): k for k in entities.keys()}
+    stub._rx_trace['cache'] += 1
     queries = defaultdict(list)
-    for cid, value in cache.get_many_complex(keys):
-        clazz, key = cache_keys.get(cid)
+    for cid, value in cache.get_many_complex(list(keys.keys())):
+        key = keys.get(cid)
+        stub._rx_cache[(Entity, key)] = value
         if value is None:
-            # log.info("MISS [%s]: %s", clazz.__name__, key)
-            if clazz == Entity:
-                queries[schemata.get(cid)].append(key)
-            loader = LOADERS.get(clazz)
-            if loader is not None:
-                value = loader(key)
-        stub._rx_cache[(clazz, key)] = value
+            queries[entities.get(key)].append(key)
 
     for schema, ids in queries.items():
+        stub._rx_trace['index'] += 1
         for entity in entities_by_ids(ids, schemata=schema, cached=True):
             stub._rx_cache[(Entity, entity.get('id'))] = entity
 
 
+def trace(stub):
+    """Number of batch loads the resolver made for the given stub, by
+    object class (or cache and index for entities)."""
+    _instrument_stub(stub)
+    return dict(stub._rx_trace)
+
+
 def get(stub, clazz, key):
     """Retrieve an object that has been loaded (or None)."""
     _instrument_stub(stub)
@@ -2,28 +2,55 @@ import logging
 from flask_babel import gettext
 from flask import render_template
 
-from aleph.core import db, settings, cache
+from aleph.core import db, kv, settings, cache
 from aleph.authz import Authz
+from aleph.cache import LocalCache
 from aleph.mail import email_role
 from aleph.model import Role
 from aleph.logic.notifications import get_role_channels
 
 log = logging.getLogger(__name__)
+ROLES = LocalCache(kv, expires=settings.CACHE_LOCAL_EXPIRE, scope='roles')
 
 
 def get_role(role_id):
     if role_id is None:
         return
-    key = cache.object_key(Role, role_id)
-    data = cache.get_complex(key)
-    if data is None:
-        role = Role.by_id(role_id)
-        if role is None:
-            return
-        log.debug("Role cache refresh: %r", role)
-        data = role.to_dict()
-        cache.set_complex(key, data, expires=cache.EXPIRE)
-    return data
+    return get_roles([role_id]).get(role_id)
+
+
+def get_roles(role_ids):
+    """Load a set of roles, using one cache lookup and one database query
+    for all of them. Returns a dict keyed by the given IDs."""
+    roles = {}
+    keys = {}
+    for role_id in role_ids:
+        key = cache.object_key(Role, role_id)
+        data = ROLES.get(key)
+        if data is not None:
+            roles[role_id] = data
+        else:
+            keys[key] = role_id
+    missing = {}
+    for key, data in cache.get_many_complex(list(keys.keys())):
+        role_id = keys[key]
+        if data is None:
+            missing[str(role_id)] = role_id
+            continue
+        ROLES.set(key, data)
+        roles[role_id] = data
+    if len(missing):
+        items = []
+        for role in Role.all_by_ids(list(missing.keys())):
+            log.debug("Role cache refresh: %r", role)
+            role_id = missing[str(role.id)]
+            key = cache.object_key(Role, role_id)
+            data = role.to_dict()
+            items.append((key, data))
+            ROLES.set(key, data)
+            roles[role_id] = data
+        cache.set_many_complex(items, expires=cache.EXPIRE)
+    return roles
 
 
 def challenge_role(data):
@@ -70,8 +97,9 @@ def update_role(role):
 
 
 def refresh_role(role, sync=False):
-    cache.kv.delete(cache.object_key(Role, role.id),
-                    cache.object_key(Role, role.id, 'channels'))
+    cache.delete(cache.object_key(Role, role.id),
+                 cache.object_key(Role, role.id, 'channels'))
+    LocalCache.bump(cache.kv, ROLES.scope)
     Authz.flush_role(role.id)
 
 
@@ -0,0 +1,162 @@
+import logging
+import itertools
+from functools import lru_cache
+from Levenshtein import jaro
+from normality import normalize
+from followthemoney import model
+from followthemoney.util import dampen
+from followthemoney.types.common import PropertyType
+from followthemoney.compare import MATCH_WEIGHTS
+from followthemoney.compare import NAMES_WEIGHT, COUNTRIES_WEIGHT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+# Feature columns are names, countries and then one per property type that
+# has a weight in followthemoney.compare, which all weights are taken from:
+TYPES = [t for (t, w) in MATCH_WEIGHTS.items() if w > 0]
+WEIGHTS = [NAMES_WEIGHT, COUNTRIES_WEIGHT] + [MATCH_WEIGHTS[t] for t in TYPES]
+TYPE_COLUMNS = {t: i + 2 for (i, t) in enumerate(TYPES)}
+MEMO_SIZE = 2 ** 16
+
+
+def _compares_exactly(type_):
+    # The default comparison is a case-insensitive match of two values,
+    # scored by the specificity of the left one:
+    clazz = type(type_)
+    return clazz.compare is PropertyType.compare and \
+        clazz.compare_sets is PropertyType.compare_sets
+
+
+EXACT_TYPES = set(t for t in TYPES if _compares_exactly(t))
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _normalize_name(name):
+    return normalize(name, latinize=True)
+
+
+@lru_cache(maxsize=None)
+def _name_damping(length):
+    return dampen(2, 20, 'x' * length)
+
+
+@lru_cache(maxsize=None)
+def _weighted_properties(schema):
+    """Properties of a schema which contribute to the score, with their
+    feature column."""
+    props = {}
+    for name, prop in schema.properties.items():
+        if prop.matchable and prop.type in TYPE_COLUMNS:
+            props[name] = (prop, TYPE_COLUMNS[prop.type])
+    return props
+
+
+class EntityFeatures(object):
+    """Values of an entity that are used in comparisons, computed once no
+    matter how many candidates the entity is compared to."""
+
+    def __init__(self, proxy):
+        self.schema = proxy.schema
+        self.names = set(_normalize_name(n) for n in proxy.names)
+        self.names.discard(None)
+        self.countries = proxy.country_hints
+        self.values = {}
+        self.exact = {}
+        for name, (prop, _) in _weighted_properties(self.schema).items():
+            values = proxy.get(name)
+            if not len(values):
+                continue
+            self.values[name] = values
+            if prop.type in EXACT_TYPES:
+                # The best specificity of the values, by lowercase form:
+                exact = {}
+                for value in values:
+                    key = value.lower()
+                    specificity = prop.type.specificity(value)
+                    exact[key] = max(exact.get(key, 0), specificity)
+                self.exact[name] = exact
+
+
+def _property_features(left, right, features):
+    schema = model.common_schema(left.schema, right.schema)
+    props = _weighted_properties(schema)
+    for name in left.values.keys() & right.values.keys():
+        if name not in props:
+            continue
+        prop, column = props[name]
+        if name in left.exact:
+            exact = left.exact[name]
+            common = exact.keys() & right.exact[name].keys()
+            score = max((exact[k] for k in common), default=0)
+        else:
+            score = prop.type.compare_sets(left.values[name],
+                                           right.values[name])
+        features[column] += score
+
+
+def _name_features(rows, similarities, lengths, size):
+    """Best damped name similarity for each pair, given the similarity
+    and the length of the shorter name of all name combinations."""
+    if numpy is not None:
+        features = numpy.zeros(size)
+        if len(rows):
+            damping = [_name_damping(n) for n in range(max(lengths) + 1)]
+            scores = numpy.array(similarities)
+            scores *= numpy.array(damping)[numpy.array(lengths)]
+            numpy.maximum.at(features, numpy.array(rows), scores)
+        return features
+    features = [0.0] * size
+    for row, similarity, length in zip(rows, similarities, lengths):
+        score = similarity * _name_damping(length)
+        features[row] = max(features[row], score)
+    return features
+
+
+def score_pairs(pairs):
+    """Score a batch of (entity, candidate) proxy pairs. The scores are the
+    same as the ones from `followthemoney.compare.compare`, but the values
+    of each entity are prepared once for the whole batch, the similarity
+    of each combination of names is computed once, and the features of all
+    pairs are weighted at once (using numpy if it is installed)."""
+    entities = {}
+
+    def _features(proxy):
+        key = id(proxy)
+        if key not in entities:
+            entities[key] = EntityFeatures(proxy)
+        return entities[key]
+
+    matrix = []
+    similarity = {}
+    rows, similarities, lengths = [], [], []
+    for row, (left, right) in enumerate(pairs):
+        features = [0.0] * len(WEIGHTS)
+        matrix.append(features)
+        left, right = _features(left), _features(right)
+        if right.schema not in left.schema.matchable_schemata:
+            continue
+        for names in itertools.product(left.names, right.names):
+            if names not in similarity:
+                similarity[names] = jaro(*names)
+            rows.append(row)
+            similarities.append(similarity[names])
+            lengths.append(min(len(n) for n in names))
+        features[1] = min(2.0, len(left.countries & right.countries))
+        _property_features(left, right, features)
+
+    names = _name_features(rows, similarities, lengths, len(matrix))
+    if not len(matrix):
+        return []
+    if numpy is not None:
+        matrix = numpy.array(matrix)
+        matrix[:, 0] = names
+        return matrix.dot(numpy.array(WEIGHTS)).tolist()
+    scores = []
+    for features, name in zip(matrix, names):
+        features[0] = name
+        scores.append(sum(f * w for (f, w) in zip(features, WEIGHTS)))
+    return scores
@@ -26,12 +26,20 @@ def entity_url(entity_id=None, **query):
     return ui_url('entities', id=entity_id, **query)
 
 
+def archive_claim_token(role_id, content_hash, file_name=None,
+                        mime_type=None):
+    """Sign the parameters of an archive download for the given role."""
+    payload = dict(r=role_id, h=content_hash, f=file_name, t=mime_type)
+    return jwt.encode(payload, settings.SECRET_KEY).decode('utf-8')
+
+
 def archive_url(role_id, content_hash, file_name=None, mime_type=None):
     """Create an access authorization link for an archive blob."""
     if content_hash is None:
         return None
-    payload = dict(r=role_id, h=content_hash, f=file_name, t=mime_type)
-    claim = jwt.encode(payload, settings.SECRET_KEY).decode('utf-8')
+    claim = archive_claim_token(role_id, content_hash,
+                                file_name=file_name,
+                                mime_type=mime_type)
     return url_for('archive_api.retrieve', _authorize=True,
                    _query=[('claim', claim)])
 
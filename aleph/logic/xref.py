@@ -1,81 +1,300 @@
 import logging
+from time import time
+from itertools import chain
+from datetime import datetime, timedelta
 from pprint import pprint  # noqa
+from banal import ensure_list
 from followthemoney import model
 from followthemoney.types import registry
-from followthemoney.compare import compare
 from followthemoney.export.excel import ExcelWriter
 
-from aleph.core import es
-from aleph.model import Collection
-from aleph.logic import resolver
+from aleph.core import es, settings
+from aleph.model import Linkage
 from aleph.queues import queue_task, OP_XREF_ITEM
 from aleph.index import xref as index
 from aleph.index.entities import iter_entities, entities_by_ids
+from aleph.index.entities import entities_by_keys
 from aleph.index.indexes import entities_read_index
-from aleph.index.util import unpack_result, none_query
-from aleph.index.util import BULK_PAGE
+from aleph.index.util import unpack_result, none_query, collection_routing
+from aleph.index.collections import get_entity_counts_many, get_collections
+from aleph.index.util import BULK_PAGE, bulk_load_started
 from aleph.logic.matching import match_query
+from aleph.logic.scoring import score_pairs
+from aleph.logic.blocking import xref_blocking
 from aleph.logic.util import entity_url
 
 log = logging.getLogger(__name__)
 SCORE_CUTOFF = 0.3
+ENGINE_SEARCH = 'search'
+ENGINE_BLOCKING = 'blocking'
+ENGINES = (ENGINE_SEARCH, ENGINE_BLOCKING)
+MATCH_CANDIDATES = 100
+MIN_REQUEST_TIMEOUT = 60
+# Entities written shortly before a run may not be searchable yet:
+REFRESH_MARGIN = timedelta(seconds=10)
 INCLUDES = ['schema', 'properties', 'collection_id']
+EXPORT_HEADERS = [
+    'Score',
+    'Entity Name',
+    'Entity Date',
+    'Entity Countries',
+    'Candidate Collection',
+    'Candidate Name',
+    'Candidate Date',
+    'Candidate Countries',
+    'Entity Link',
+    'Candidate Link',
+]
 
 
-def _query_item(collection, entity):
-    """Cross-reference an entity or document, given as an indexed document."""
-    query = match_query(entity)
+def _target_schemata(collection_ids):
+    """Names of the schemata used in the given target collections, or None
+    if matches are not limited to specific collections."""
+    if not len(collection_ids):
+        return None
+    schemata = set()
+    for counts in get_entity_counts_many(collection_ids).values():
+        schemata.update(counts.keys())
+    return schemata
+
+
+def _match_search(entity, collection_ids=None, schemata=None):
+    """Make the multi-search header and body for the match query of an
+    entity, or None if there's nothing to match on. Candidates can be
+    limited to a set of collections, and to the indexes of the schemata
+    that occur in them."""
+    query = match_query(entity, collection_ids=collection_ids)
     if query == none_query():
         return
-
-    query = {
+    matchable = [s for s in entity.schema.matchable_schemata
+                 if schemata is None or s.name in schemata]
+    if not len(matchable):
+        return
+    header = {'index': entities_read_index(schema=matchable, expand=False)}
+    routing = collection_routing(collection_ids)
+    if routing is not None:
+        header['routing'] = routing
+    body = {
         'query': query,
-        'size': 100,
-        '_source': {'includes': INCLUDES}
+        'size': MATCH_CANDIDATES,
+        '_source': {'includes': INCLUDES},
+        'timeout': '%ss' % settings.XREF_TIMEOUT
     }
-    matchable = list(entity.schema.matchable_schemata)
-    index = entities_read_index(schema=matchable)
-    result = es.search(index=index, body=query)
-    for result in result.get('hits').get('hits'):
-        result = unpack_result(result)
-        if result is None:
+    return header, body
+
+
+def _query_entities(collection, entities, against_collection_ids=None,
+                    reverse=False):
+    """Cross-reference a batch of entities, sending all of their match
+    queries to the index in one multi-search. In reverse, the entities
+    are from other collections and are matched against this one."""
+    against = ensure_list(against_collection_ids)
+    if reverse:
+        against = [collection.id]
+    schemata = _target_schemata(against)
+    body = []
+    queried = []
+    for entity in entities:
+        search = _match_search(entity, collection_ids=against,
+                               schemata=schemata)
+        if search is not None:
+            body.extend(search)
+            queried.append(entity)
+    if not len(queried):
+        return
+
+    begin = time()
+    # Queries return what they found once they run into their timeout,
+    # so a batch is bounded by a few rounds of concurrent queries, no
+    # matter how many entities it has:
+    timeout = settings.XREF_TIMEOUT * settings.XREF_CONCURRENCY
+    result = es.msearch(body=body,
+                        max_concurrent_searches=settings.XREF_CONCURRENCY,
+                        request_timeout=max(timeout, MIN_REQUEST_TIMEOUT))
+    candidates = []
+    for entity, res in zip(queried, result.get('responses', [])):
+        if 'error' in res:
+            log.warning("Xref query error [%s]: %r",
+                        entity.id, res.get('error'))
             continue
-        match = model.get_proxy(result)
-        score = compare(model, entity, match)
+        for result in res.get('hits', {}).get('hits', []):
+            result = unpack_result(result)
+            if result is None:
+                continue
+            match = model.get_proxy(result)
+            if reverse:
+                collection_id = entity.context.get('collection_id')
+                candidates.append((match, entity, collection_id))
+            else:
+                collection_id = result.get('collection_id')
+                candidates.append((entity, match, collection_id))
+
+    # Score all candidates of the batch at once:
+    scores = score_pairs([(e, m) for (e, m, _) in candidates])
+    for (entity, match, collection_id), score in zip(candidates, scores):
         if score >= SCORE_CUTOFF:
             # log.debug('Match: %r <-[%.3f]-> %r',
             #           entity.caption, score, match.caption)
-            yield score, entity, result.get('collection_id'), match
+            yield score, entity, collection_id, match
+    took = max(time() - begin, 0.001)
+    log.info("Xref [%s]: %d entities, %d candidates (%.1f candidates/s)",
+             collection.foreign_id, len(queried), len(candidates),
+             len(candidates) / took)
 
 
-def _query_matches(collection, entity_ids):
+def _query_matches(collection, entity_ids, against_collection_ids=None):
     """Generate matches for indexing."""
-    for data in entities_by_ids(entity_ids, includes=INCLUDES):
-        entity = model.get_proxy(data)
-        yield from _query_item(collection, entity)
+    entities = entities_by_ids(entity_ids, includes=INCLUDES,
+                               collection_id=collection.id)
+    entities = [model.get_proxy(data) for data in entities]
+    yield from _query_entities(collection, entities,
+                               against_collection_ids=against_collection_ids)
 
 
-def xref_item(stage, collection, entity_id=None, batch=50):
-    "Cross-reference an entity against others to generate potential matches."
-    entity_ids = [entity_id]
+def _query_reverse(collection, entity_ids):
+    """Generate matches of this collection with entities from others."""
+    entities = entities_by_ids(entity_ids, includes=INCLUDES)
+    entities = [model.get_proxy(data) for data in entities]
+    yield from _query_entities(collection, entities, reverse=True)
+
+
+def _skip_decided(matches, decided):
+    for match in matches:
+        (score, entity, collection_id, candidate) = match
+        if (entity.id, candidate.id) not in decided:
+            yield match
+
+
+def xref_item(stage, collection, entity_id=None, against_collection_ids=None,
+              incremental=False, reverse=False, batch=50):
+    """Cross-reference an entity against others to generate potential
+    matches. Entities from other collections (`reverse`) are matched
+    against this collection instead."""
+    entity_ids = []
+    reverse_ids = []
+    (reverse_ids if reverse else entity_ids).append(entity_id)
     # This is running as a background job. In order to avoid running each
     # entity one by one, we do it 101 at a time. This avoids sending redudant
     # queries to the database and elasticsearch, making cross-ref much faster.
+    # All tasks in the stage belong to the same run, with the same targets.
     for task in stage.get_tasks(limit=batch):
-        entity_ids.append(task.payload.get('entity_id'))
-    matches = _query_matches(collection, entity_ids)
-    index.index_matches(collection, matches, sync=False)
-    stage.mark_done(len(entity_ids) - 1)
+        ids = reverse_ids if task.payload.get('reverse') else entity_ids
+        ids.append(task.payload.get('entity_id'))
+    matches = _query_matches(collection, entity_ids,
+                             against_collection_ids=against_collection_ids)
+    if len(reverse_ids):
+        matches = chain(matches, _query_reverse(collection, reverse_ids))
+    if incremental:
+        # Replace the previous matches of changed entities, but leave
+        # the ones that users have already made a decision on alone:
+        decided = Linkage.decided_pairs(entity_ids + reverse_ids,
+                                        collection.id)
+        keep = [index.xref_id(collection.id, e, m) for (e, m) in decided]
+        index.delete_stale_xref(collection, entity_ids=entity_ids,
+                                match_ids=reverse_ids, keep=keep, sync=True)
+        matches = _skip_decided(matches, decided)
+    index.index_matches(collection, matches, sync=False,
+                        against_collection_ids=against_collection_ids)
+    stage.mark_done(len(entity_ids) + len(reverse_ids) - 1)
+
+
+def _xref_blocking(collection, against, schemata):
+    matches = xref_blocking(collection, against, schemata, SCORE_CUTOFF)
+    batch = []
+    for match in matches:
+        batch.append(match)
+        if len(batch) >= BULK_PAGE:
+            index.index_matches(collection, batch,
+                                against_collection_ids=against)
+            batch = []
+    index.index_matches(collection, batch, against_collection_ids=against)
+
+
+def _visible_since():
+    """A time before which all entities written to the index are visible
+    to searches, to be used as the watermark of a run starting now."""
+    visible = datetime.utcnow() - REFRESH_MARGIN
+    started = bulk_load_started()
+    if started is not None:
+        # Writes are not refreshed while a bulk load window is open:
+        visible = min(visible, datetime.utcfromtimestamp(started))
+    return visible
 
 
-def xref_collection(stage, collection):
-    """Cross-reference all the entities and documents in a collection."""
-    index.delete_xref(collection, sync=True)
+def _xref_incremental(stage, collection, since):
+    """Queue the entities of the collection which changed since the last
+    run, and the entities of other collections which did, to be matched
+    against it."""
+    index.set_pending_watermark(stage.job.id, _visible_since())
     matchable = [s.name for s in model if s.matchable]
+    changed = {'range': {'indexed_at': {'gt': since}}}
+    entities = iter_entities(collection_id=collection.id, schemata=matchable,
+                             filters=[changed], includes=['schema'])
+    for entity in entities:
+        payload = {'entity_id': entity.get('id'), 'incremental': True}
+        queue_task(collection, OP_XREF_ITEM, job_id=stage.job.id,
+                   payload=payload)
+    other = {'bool': {'must_not': {'term': {'collection_id': collection.id}}}}
+    entities = iter_entities(schemata=matchable, filters=[changed, other],
+                             includes=['schema'])
+    for entity in entities:
+        payload = {
+            'entity_id': entity.get('id'),
+            'incremental': True,
+            'reverse': True
+        }
+        queue_task(collection, OP_XREF_ITEM, job_id=stage.job.id,
+                   payload=payload)
+
+
+def xref_collection(stage, collection, against_collection_ids=None,
+                    engine=ENGINE_SEARCH, incremental=False):
+    """Cross-reference all the entities and documents in a collection,
+    either with all other collections or only the given ones. With the
+    blocking engine, the comparison with the given collections is run
+    as one batch job instead of a match query for each entity.
+
+    An incremental run only re-matches what has changed since the last
+    run with all other collections, and falls back to a full run if
+    there hasn't been one."""
+    against = ensure_list(against_collection_ids)
+    if engine == ENGINE_BLOCKING and not len(against):
+        log.warning("Blocking xref needs target collections, "
+                    "using search: %r", collection)
+        engine = ENGINE_SEARCH
+    if incremental and not len(against):
+        since = index.get_watermark(collection.id)
+        if since is not None:
+            log.info("Xref [%s]: changes since %s",
+                     collection.foreign_id, since)
+            _xref_incremental(stage, collection, since)
+            return
+    started = _visible_since()
+    index.delete_xref(collection, against_collection_ids=against, sync=True)
+    matchable = [s for s in model if s.matchable]
+    schemata = _target_schemata(against)
+    if schemata is not None:
+        # Skip entities which cannot match anything in the targets:
+        matchable = [s for s in matchable
+                     if any(m.name in schemata
+                            for m in s.matchable_schemata)]
+    if not len(matchable):
+        return
+    matchable = [s.name for s in matchable]
+    if engine == ENGINE_BLOCKING:
+        _xref_blocking(collection, against, matchable)
+        return
+    if not len(against):
+        # The watermark is advanced when all of the job's tasks are done:
+        index.set_pending_watermark(stage.job.id, started)
     entities = iter_entities(collection_id=collection.id, schemata=matchable)
     for entity in entities:
+        payload = {
+            'entity_id': entity.get('id'),
+            'against_collection_ids': against
+        }
         queue_task(collection, OP_XREF_ITEM, job_id=stage.job.id,
-                   payload={'entity_id': entity.get('id')})
+                   payload=payload)
 
 
 def _format_date(proxy):
@@ -90,28 +309,34 @@ def _format_country(proxy):
     return ', '.join(countries)
 
 
-def _iter_match_batch(stub, sheet, batch):
-    matchable = [s.name for s in model if s.matchable]
-    entities = set()
-    for match in batch:
-        entities.add(match.get('entity_id'))
-        entities.add(match.get('match_id'))
-        resolver.queue(stub, Collection, match.get('match_collection_id'))
-
-    resolver.resolve(stub)
-    entities = entities_by_ids(list(entities), schemata=matchable)
-    entities = {e.get('id'): e for e in entities}
+def _match_rows(batch):
+    """Spreadsheet rows for a batch of matches. Both sides of all matches
+    are fetched in one multi-get, and their collections in one lookup."""
+    keys = []
+    for obj in batch:
+        keys.append((obj.get('entity_id'), obj.get('entity_schema'),
+                     obj.get('collection_id')))
+        keys.append((obj.get('match_id'), obj.get('schema'),
+                     obj.get('match_collection_id')))
+    entities = entities_by_keys(keys, includes=['schema', 'properties'])
+    # Matches indexed before the schema of the entity was stored:
+    missing = [k[0] for k in keys if k[0] not in entities]
+    if len(missing):
+        matchable = [s.name for s in model if s.matchable]
+        for entity in entities_by_ids(list(set(missing)), schemata=matchable):
+            entities[entity.get('id')] = entity
+    collection_ids = {obj.get('match_collection_id') for obj in batch}
+    collections = get_collections(list(collection_ids))
 
     for obj in batch:
         entity = entities.get(str(obj.get('entity_id')))
         match = entities.get(str(obj.get('match_id')))
-        collection_id = obj.get('match_collection_id')
-        collection = resolver.get(stub, Collection, collection_id)
+        collection = collections.get(obj.get('match_collection_id'))
         if entity is None or match is None or collection is None:
             continue
         eproxy = model.get_proxy(entity)
         mproxy = model.get_proxy(match)
-        sheet.append([
+        yield [
             obj.get('score'),
             eproxy.caption,
             _format_date(eproxy),
@@ -122,32 +347,28 @@ def _iter_match_batch(stub, sheet, batch):
             _format_country(mproxy),
             entity_url(eproxy.id),
             entity_url(mproxy.id),
-        ])
+        ]
 
 
-def export_matches(collection, authz):
-    """Export the top N matches of cross-referencing for the given collection
-    to an Excel formatted export."""
-    excel = ExcelWriter()
-    headers = [
-        'Score',
-        'Entity Name',
-        'Entity Date',
-        'Entity Countries',
-        'Candidate Collection',
-        'Candidate Name',
-        'Candidate Date',
-        'Candidate Countries',
-        'Entity Link',
-        'Candidate Link',
-    ]
-    sheet = excel.make_sheet('Cross-reference', headers)
+def iter_match_rows(collection, authz):
+    """Generate the rows of the cross-referencing export, a batch of
+    matches at a time."""
     batch = []
     for match in index.iter_matches(collection, authz):
         batch.append(match)
         if len(batch) >= BULK_PAGE:
-            _iter_match_batch(excel, sheet, batch)
+            yield from _match_rows(batch)
             batch = []
     if len(batch):
-        _iter_match_batch(excel, sheet, batch)
-    return excel.get_bytesio()
+        yield from _match_rows(batch)
+
+
+def export_matches(collection, authz, file_path):
+    """Export the matches of cross-referencing for the given collection
+    to an Excel file. The workbook is write-only, so rows are written to
+    disk as they are added rather than kept in memory."""
+    excel = ExcelWriter()
+    sheet = excel.make_sheet('Cross-reference', EXPORT_HEADERS)
+    for row in iter_match_rows(collection, authz):
+        sheet.append(row)
+    excel.workbook.save(str(file_path))
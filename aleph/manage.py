@@ -19,18 +19,20 @@ from aleph.migration import upgrade_system, destroy_db, cleanup_deleted
 from aleph.worker import get_worker
 from aleph.queues import get_status, queue_task, cancel_queue
 from aleph.queues import get_active_collection_status, get_stage
-from aleph.queues import OP_PROCESS, OP_XREF
+from aleph.queues import OP_PROCESS, OP_XREF, OP_REINDEX
 from aleph.index.admin import delete_index
 from aleph.index.entities import iter_proxies
+from aleph.index.util import acl_mark_pending
 from aleph.logic.names import compute_name_frequencies
 from aleph.logic.collections import create_collection, update_collection
 from aleph.logic.collections import reset_collection, delete_collection
 from aleph.logic.collections import upgrade_collections, process_collection
-from aleph.logic.processing import index_aggregate
+from aleph.logic.collections import reindex_collection
 from aleph.logic.processing import bulk_write
 from aleph.logic.documents import crawl_directory
 from aleph.logic.roles import create_user, update_roles
 from aleph.logic.permissions import update_permission
+from aleph.logic.xref import ENGINES, ENGINE_SEARCH
 
 log = logging.getLogger('aleph')
 
@@ -114,14 +116,29 @@ def reset(foreign_id, sync=False):
 
 @cli.command()
 @click.argument('foreign_id')
-def reindex(foreign_id):
-    """Index all the aggregator contents for a collection."""
+@click.option('--flush', is_flag=True, default=False, help='Delete existing index entries first (e.g. after changing ALEPH_INDEX_ROUTING).')  # noqa
+def reindex(foreign_id, flush=False):
+    """Index all the database and aggregator contents for a collection."""
     collection = get_collection(foreign_id)
     stage = get_stage(collection, OP_PROCESS)
-    index_aggregate(stage, collection)
+    reindex_collection(stage, collection, flush=flush)
     update_collection(collection)
 
 
+@cli.command()
+@click.argument('foreign_id', required=False)
+def restamp(foreign_id=None):
+    """Queue a re-index of one or all collections to update the roles
+    stamped on their entities and xref matches (see ALEPH_INDEX_ACL)."""
+    if foreign_id is not None:
+        collections = [get_collection(foreign_id)]
+    else:
+        collections = Collection.all()
+    for collection in collections:
+        acl_mark_pending(collection.id)
+        queue_task(collection, OP_REINDEX)
+
+
 @cli.command()
 @click.argument('foreign_id')
 @click.option('--sync', is_flag=True, default=False)
@@ -146,9 +163,10 @@ def update():
 
 
 @cli.command('namefreq')
-def namefreq():
+@click.option('-p', '--parallel', type=int, default=None, help='Number of slices to scan the index with.')  # noqa
+def namefreq(parallel=None):
     """Compute frequency distribution of name tokens."""
-    compute_name_frequencies()
+    compute_name_frequencies(slices=parallel)
     # from aleph.logic.names import name_frequency
     # name_frequency("John Smith")
     # name_frequency("Friedrich Lindenberg")
@@ -158,12 +176,19 @@ def namefreq():
 @cli.command()
 @click.argument('foreign_id')
 @click.option('-a', '--against', multiple=True, help='foreign IDs of collections to xref against')  # noqa
-def xref(foreign_id, against=None):
-    """Cross-reference all entities and documents in a collection."""
+@click.option('-e', '--engine', type=click.Choice(ENGINES), default=ENGINE_SEARCH, help='run a match query per entity, or join blocking keys with the --against collections')  # noqa
+@click.option('--full', is_flag=True, default=False, help='re-match all entities, not only those changed since the last run')  # noqa
+def xref(foreign_id, against=None, engine=ENGINE_SEARCH, full=False):
+    """Cross-reference all entities and documents in a collection. Unless
+    --full is given, only the changes since the last run are matched."""
     collection = get_collection(foreign_id)
     against = [get_collection(c).id for c in ensure_list(against)]
-    against = {'against_collection_ids': against}
-    queue_task(collection, OP_XREF, payload=against)
+    payload = {
+        'against_collection_ids': against,
+        'engine': engine,
+        'incremental': not full
+    }
+    queue_task(collection, OP_XREF, payload=payload)
 
 
 @cli.command('load-entities')
@@ -193,11 +218,13 @@ def load_entities(foreign_id, infile, unsafe=False):
 @cli.command('dump-entities')
 @click.argument('foreign_id')
 @click.option('-o', '--outfile', type=click.File('w'), default='-')  # noqa
-def dump_entities(foreign_id, outfile):
+@click.option('-p', '--parallel', type=int, default=None, help='Number of slices to scan the index with.')  # noqa
+def dump_entities(foreign_id, outfile, parallel=None):
     """Export FtM entities for the given collection."""
     collection = get_collection(foreign_id)
     for entity in iter_proxies(collection_id=collection.id,
-                               excludes=['text']):
+                               excludes=['text'],
+                               slices=parallel):
         entity.context = {}
         write_object(outfile, entity)
 
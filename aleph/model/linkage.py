@@ -163,6 +163,34 @@ class Linkage(db.Model, DatedModel):
                 decisions[(entity_id, match_id)] = False
         return decisions
 
+    @classmethod
+    def decided_pairs(cls, entity_ids, collection_id):
+        """All pairs of entities, one of them in `entity_ids` and one of
+        them in the given collection, that have been decided to be the
+        same or not the same in any context. Each pair is included in
+        both orders."""
+        pairs = set()
+        entity_ids = ensure_list(entity_ids)
+        if not len(entity_ids):
+            return pairs
+        entity = aliased(cls)
+        match = aliased(cls)
+        q = db.session.query(entity.entity_id, match.entity_id)
+        q = q.filter(entity.profile_id == match.profile_id)
+        q = q.filter(entity.context_id == match.context_id)
+        q = q.filter(entity.entity_id.in_(entity_ids))
+        q = q.filter(or_(entity.collection_id == collection_id,
+                         match.collection_id == collection_id))
+        q = q.filter(entity.entity_id != match.entity_id)
+        q = q.filter(entity.decision != None)  # noqa
+        q = q.filter(match.decision != None)  # noqa
+        q = q.filter(or_(entity.decision == True,  # noqa
+                         match.decision == True))  # noqa
+        for (entity_id, match_id) in q.all():
+            pairs.add((entity_id, match_id))
+            pairs.add((match_id, entity_id))
+        return pairs
+
     # def __repr__(self):
     #     return '<Linkage(%r, %r, %s)>' % \
     #         (self.profile_id, self.entity_id, self.decision)
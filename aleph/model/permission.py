@@ -42,6 +42,15 @@ class Permission(db.Model, IdModel, SoftDeleteModel):
         db.session.flush()
         return permission
 
+    @classmethod
+    def read_roles(cls, collection_id):
+        """IDs of all roles which can read the given collection."""
+        q = db.session.query(cls.role_id)
+        q = q.filter(cls.collection_id == collection_id)
+        q = q.filter(cls.read == True)  # noqa
+        q = q.filter(cls.deleted_at == None)  # noqa
+        return sorted(set(role_id for (role_id,) in q.all()))
+
     @classmethod
     def by_collection_role(cls, collection, role):
         q = cls.all()
@@ -14,10 +14,16 @@ OP_XREF_ITEM = 'xitem'
 OP_PROCESS = 'process'
 OP_LOAD_MAPPING = 'loadmapping'
 OP_FLUSH_MAPPING = 'flushmapping'
+OP_REINDEX = 'reindex'
+OP_EXPORT = 'export'
 
 # All stages that aleph should listen for. Does not include ingest,
 # which is received and processed by the ingest-file service.
-OPERATIONS = (OP_INDEX, OP_XREF, OP_PROCESS, OP_XREF_ITEM, OP_LOAD_MAPPING, OP_FLUSH_MAPPING)  # noqa
+OPERATIONS = (OP_INDEX, OP_XREF, OP_PROCESS, OP_XREF_ITEM, OP_LOAD_MAPPING, OP_FLUSH_MAPPING, OP_REINDEX, OP_EXPORT)  # noqa
+
+# Search exports span collections, so they are queued as a dataset of
+# their own rather than under a collection's foreign ID.
+EXPORT_DATASET = 'aleph-exports'
 
 
 def get_rate_limit(resource, limit=100, interval=60, unit=1):
@@ -30,15 +36,27 @@ def get_stage(collection, stage, job_id=None):
     return job.get_stage(stage)
 
 
-def queue_task(collection, stage, job_id=None, payload=None, context=None):
-    stage = get_stage(collection, stage, job_id=job_id)
-    stage.queue(payload or {}, context or {})
+def _sync_testing():
     if settings.TESTING:
         from aleph.worker import get_worker
         worker = get_worker()
         worker.sync()
 
 
+def queue_task(collection, stage, job_id=None, payload=None, context=None):
+    stage = get_stage(collection, stage, job_id=job_id)
+    stage.queue(payload or {}, context or {})
+    _sync_testing()
+
+
+def queue_export(payload):
+    """Run a search export in the worker."""
+    job = Job(kv, EXPORT_DATASET, Job.random_id())
+    stage = job.get_stage(OP_EXPORT)
+    stage.queue(payload, {})
+    _sync_testing()
+
+
 def get_status(collection):
     return Dataset(kv, collection.foreign_id).get_status()
 
@@ -49,7 +67,11 @@ def get_active_collection_status():
 
 
 def cancel_queue(collection):
-    Dataset(kv, collection.foreign_id).cancel()
+    dataset = Dataset(kv, collection.foreign_id)
+    from aleph.index.xref import discard_watermark
+    for job_id in dataset.get_job_ids():
+        discard_watermark(job_id)
+    dataset.cancel()
 
 
 def ingest_entity(collection, proxy, job_id=None, sync=False):
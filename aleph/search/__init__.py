@@ -6,6 +6,7 @@ from aleph.index.indexes import entities_read_index
 from aleph.index.collections import collections_index
 from aleph.index.xref import xref_index
 from aleph.index.entities import EXCLUDE_DEFAULT
+from aleph.index.util import collection_routing, entities_authz_query
 from aleph.logic.matching import match_query
 from aleph.search.parser import QueryParser, SearchQueryParser  # noqa
 from aleph.search.result import QueryResult, DatabaseQueryResult  # noqa
@@ -20,6 +21,7 @@ class CollectionsQuery(Query):
     SORT_DEFAULT = ['_score', {'label.kw': 'asc'}]
     SKIP_FILTERS = ['writeable']
     PREFIX_FIELD = 'label'
+    CACHE = True
 
     def get_filters(self):
         filters = super(CollectionsQuery, self).get_filters()
@@ -38,6 +40,8 @@ class EntitiesQuery(Query):
     SKIP_FILTERS = ['schema', 'schemata']
     EXCLUDE_FIELDS = EXCLUDE_DEFAULT
     SORT_DEFAULT = []
+    SORT_TIEBREAK = [{'id': 'asc'}]
+    CACHE = True
 
     def get_index(self):
         schemata = self.parser.getlist('filter:schema')
@@ -48,6 +52,17 @@ class EntitiesQuery(Query):
             raise BadRequest(gettext("No schema is specified for the query."))
         return entities_read_index(schema=schemata)
 
+    def get_authz_query(self):
+        return entities_authz_query(self.parser.authz)
+
+    def get_routing(self):
+        # Facet counts for other collections would be incomplete if the
+        # query was limited to the shards of the filtered collections.
+        if 'collection_id' in self.parser.facet_names:
+            return None
+        collection_ids = self.parser.filters.get('collection_id')
+        return collection_routing(collection_ids)
+
 
 class MatchQuery(EntitiesQuery):
     """Given an entity, find the most similar other entities."""
@@ -64,8 +79,16 @@ class MatchQuery(EntitiesQuery):
         # Real estate is "unmatchable", i.e. even if two plots of land
         # have almost the same name and criteria, it does not make
         # sense to suggest they are the same.
+        # The matchable set is already closed over descendants, so it
+        # must not be expanded again: a Person can match a LegalEntity,
+        # but a Company index has no business being queried for it.
         schemata = list(self.entity.schema.matchable_schemata)
-        return entities_read_index(schema=schemata)
+        return entities_read_index(schema=schemata, expand=False)
+
+    def get_routing(self):
+        if self.collection_ids:
+            return collection_routing(self.collection_ids)
+        return super(MatchQuery, self).get_routing()
 
     def get_query(self):
         query = super(MatchQuery, self).get_query()
@@ -77,6 +100,7 @@ class MatchQuery(EntitiesQuery):
 class XrefQuery(Query):
     TEXT_FIELDS = ['text']
     SORT_DEFAULT = [{'score': 'desc'}]
+    SORT_TIEBREAK = [{'entity_id': 'asc'}, {'match_id': 'asc'}]
     AUTHZ_FIELD = 'match_collection_id'
 
     def __init__(self, parser, collection_id=None):
@@ -89,5 +113,8 @@ class XrefQuery(Query):
         filters.append({'term': {'collection_id': self.collection_id}})
         return filters
 
+    def get_authz_query(self):
+        return entities_authz_query(self.parser.authz, field=self.AUTHZ_FIELD)
+
     def get_index(self):
         return xref_index()
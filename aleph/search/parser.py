@@ -1,12 +1,39 @@
+import json
+import base64
 import logging
 from banal import as_bool
 from normality import stringify
+from flask_babel import gettext
+from werkzeug.exceptions import BadRequest
 from werkzeug.datastructures import MultiDict, OrderedMultiDict
 
 from aleph.core import settings
 from aleph.index.util import MAX_PAGE
 
 log = logging.getLogger(__name__)
+CURSOR_TYPES = (str, int, float, bool)
+
+
+def encode_cursor(values):
+    """Make an opaque token from the sort values of the last result."""
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('utf-8')
+
+
+def decode_cursor(token, length=None):
+    """Read the sort values from a cursor token. These have to be a list
+    of scalars, of the given length if one is known. Null values are not
+    accepted: as a bound, they would match everything."""
+    try:
+        data = base64.urlsafe_b64decode(token.encode('utf-8'))
+        values = json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or not len(values) or \
+            not all(isinstance(v, CURSOR_TYPES) for v in values) or \
+            (length is not None and len(values) != length):
+        raise BadRequest(gettext("Invalid search cursor."))
+    return values
 
 
 class QueryParser(object):
@@ -72,7 +99,7 @@ class QueryParser(object):
     @property
     def items(self):
         for (key, value) in self.args.items(multi=True):
-            if key == 'offset':
+            if key in ('offset', 'after'):
                 continue
             value = stringify(value, encoding='utf-8')
             if value is not None:
@@ -127,6 +154,17 @@ class SearchQueryParser(QueryParser):
 
     def __init__(self, args, authz, limit=None):
         super(SearchQueryParser, self).__init__(args, authz, limit=limit)
+        # Cursor-based pagination: instead of an offset, each page holds
+        # a token for the position after its last result. This is not
+        # limited by MAX_PAGE. Start with `cursor=true`, then follow the
+        # `next` links.
+        self.after = None
+        token = self.get('after')
+        if token is not None:
+            self.after = decode_cursor(token)
+        self.cursor = self.getbool('cursor', False) or token is not None
+        if self.cursor:
+            self.offset = 0
         self.offset = min(MAX_PAGE, self.offset)
         if (self.limit + self.offset) > MAX_PAGE:
             self.limit = max(0, MAX_PAGE - self.offset)
@@ -164,4 +202,5 @@ class SearchQueryParser(QueryParser):
     def to_dict(self):
         parser = super(SearchQueryParser, self).to_dict()
         parser['facet_filters'] = list(self.facet_filters)
+        parser['cursor'] = self.cursor
         return parser
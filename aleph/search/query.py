@@ -1,12 +1,19 @@
+import json
 import logging
+from time import time
+from hashlib import sha1
 from pprint import pprint, pformat  # noqa
+from flask_babel import gettext
+from werkzeug.exceptions import BadRequest
 from followthemoney.types import registry
 
-from aleph.core import es
+from aleph.core import es, cache, settings
 from aleph.index.util import NUMERIC_TYPES, authz_query, field_filter_query
 from aleph.search.result import SearchQueryResult
 from aleph.search.parser import SearchQueryParser
 from aleph.index.entities import get_field_type
+from aleph.index.collections import updated_key
+from aleph.index.util import bulk_load_refreshed_key
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +39,10 @@ class Query(object):
         'score': '_score',
     }
     SORT_DEFAULT = ['_score']
+    # Unique sort order used to break ties when paging with a cursor:
+    SORT_TIEBREAK = []
+    # Results can be cached until a collection changes:
+    CACHE = False
 
     def __init__(self, parser):
         self.parser = parser
@@ -66,8 +77,7 @@ class Query(object):
         # a particular query by comparing the collections a user is
         # authorized for with the one on the document.
         if self.parser.authz and not self.parser.authz.is_admin:
-            authz = authz_query(self.parser.authz, field=self.AUTHZ_FIELD)
-            filters.append(authz)
+            filters.append(self.get_authz_query())
 
         for field, values in self.parser.filters.items():
             if field in self.SKIP_FILTERS:
@@ -76,6 +86,9 @@ class Query(object):
                 filters.append(field_filter_query(field, values))
         return filters
 
+    def get_authz_query(self):
+        return authz_query(self.parser.authz, field=self.AUTHZ_FIELD)
+
     def get_negative_filters(self):
         """Apply negative filters."""
         filters = []
@@ -167,6 +180,10 @@ class Query(object):
             sort_fields.append({field: config})
         return list(reversed(sort_fields))
 
+    @property
+    def cursor(self):
+        return self.parser.cursor and len(self.SORT_TIEBREAK) > 0
+
     def get_highlight(self):
         if not self.parser.highlight:
             return {}
@@ -200,24 +217,84 @@ class Query(object):
             'highlight': self.get_highlight(),
             '_source': self.get_source()
         }
+        if self.cursor:
+            body.pop('from')
+            body['sort'] = (body['sort'] or ['_score']) + self.SORT_TIEBREAK
+            if self.parser.after is not None:
+                if len(self.parser.after) != len(body['sort']):
+                    raise BadRequest(gettext("Invalid search cursor."))
+                body['search_after'] = self.parser.after
         # log.info("Query: %s", pformat(body))
         return body
 
     def get_index(self):
         raise NotImplementedError
 
+    def get_routing(self):
+        """Shard routing to limit the query to, if any."""
+        return None
+
+    def get_cache_key(self, index, routing, body):
+        # The authz filter is part of the body, so users with access to
+        # the same collections share cached results.
+        key = json.dumps([index, routing, body], sort_keys=True)
+        key = sha1(key.encode('utf-8')).hexdigest()
+        return cache.key('search', key)
+
+    def get_cache_collections(self):
+        """Collections the result depends on, None meaning any."""
+        return self.parser.filters.get('collection_id')
+
+    def _cache_updated(self, collection_ids):
+        keys = [updated_key(c) for c in collection_ids]
+        keys.append(bulk_load_refreshed_key())
+        updated = [float(u) for u in cache.kv.mget(keys) if u is not None]
+        return max(updated, default=0)
+
+    def _cache_metric(self, metric):
+        cache.kv.incr(cache.state_key('search', metric))
+
     def search(self):
         """Execute the query as assmbled."""
         # log.info("Search index: %s", self.get_index())
-        result = es.search(index=self.get_index(),
-                           body=self.get_body())
-        log.info("Took: %sms", result.get('took'))
+        index = self.get_index()
+        routing = self.get_routing()
+        body = self.get_body()
+        use_cache = self.CACHE and self.parser.cache and settings.SEARCH_CACHE
+        # Only queries limited to some collections are cached: anything
+        # else would be invalidated by every change to any collection.
+        collection_ids = self.get_cache_collections()
+        use_cache = use_cache and bool(collection_ids)
+        if use_cache:
+            key = self.get_cache_key(index, routing, body)
+            # Results can be large, keep them out of the local tier:
+            data = cache.get_complex(key, local=False)
+            # Changes are stamped once they have been written, but only
+            # become visible with the next refresh of the index:
+            updated = self._cache_updated(collection_ids)
+            updated += settings.SEARCH_CACHE_REFRESH
+            if data is not None and data['at'] > updated:
+                self._cache_metric('hits')
+                return data['result']
+            self._cache_metric('misses')
+            cached_at = time()
+
+        result = es.search(index=index, routing=routing, body=body)
+        shards = result.get('_shards', {})
+        log.info("Took: %sms, shards: %s", result.get('took'),
+                 shards.get('total'))
         # log.info("%s", pformat(result.get('profile')))
+        if use_cache and not result.get('timed_out'):
+            data = json.dumps({'at': cached_at, 'result': result})
+            if len(data) <= settings.SEARCH_CACHE_SIZE:
+                cache.set(key, data, expires=settings.SEARCH_CACHE_EXPIRE)
         return result
 
     @classmethod
     def handle(cls, request, parser=None, **kwargs):
         if parser is None:
             parser = SearchQueryParser(request.args, request.authz)
-        result = cls(parser, **kwargs).search()
-        return cls.RESULT_CLASS(request, parser, result)
+        query = cls(parser, **kwargs)
+        result = query.search()
+        return cls.RESULT_CLASS(request, parser, result,
+                                cursor=query.cursor)
@@ -4,7 +4,7 @@ from pprint import pprint, pformat  # noqa
 
 from aleph.core import url_external
 from aleph.index.util import unpack_result
-from aleph.search.parser import QueryParser
+from aleph.search.parser import QueryParser, encode_cursor
 from aleph.search.facet import CategoryFacet, CollectionFacet, CountryFacet
 from aleph.search.facet import LanguageFacet, SchemaFacet, Facet
 
@@ -74,14 +74,26 @@ class SearchQueryResult(QueryResult):
         'schemata': SchemaFacet
     }
 
-    def __init__(self, request, parser, result):
+    def __init__(self, request, parser, result, cursor=False):
         super(SearchQueryResult, self).__init__(request, parser=parser)
         self.result = result
+        self.paged_by_cursor = cursor
+        self.cursor = None
         hits = self.result.get('hits', {})
         total = hits.get('total', {})
         self.total = total.get('value')
         self.total_type = total.get('relation')
-        for doc in hits.get('hits', []):
+        docs = hits.get('hits', [])
+        if cursor and len(docs) and len(docs) >= self.parser.limit:
+            sort = docs[-1].get('sort')
+            if None in sort:
+                # A field to sort on is missing, e.g. the `id` of entities
+                # which have not been re-indexed since it was added. Fall
+                # back to paging by offset:
+                self.paged_by_cursor = False
+            else:
+                self.cursor = encode_cursor(sort)
+        for doc in docs:
             # log.info("Res: %s", pformat(doc))
             doc = unpack_result(doc)
             if doc is not None:
@@ -98,4 +110,15 @@ class SearchQueryResult(QueryResult):
     def to_dict(self, serializer=None):
         data = super(SearchQueryResult, self).to_dict(serializer=serializer)
         data['facets'] = self.get_facets()
+        if self.paged_by_cursor:
+            data['cursor'] = self.cursor
+            data['next'] = self.cursor_url()
+            data['previous'] = None
         return data
+
+    def cursor_url(self):
+        if self.cursor is None:
+            return None
+        args = [('after', self.cursor)]
+        args.extend(self.parser.items)
+        return url_external(self.request.path, args)
@@ -13,6 +13,14 @@ from flask_babel import lazy_gettext
 DEBUG = env.to_bool('ALEPH_DEBUG', False)
 # Propose HTTP caching to the user agents.
 CACHE = env.to_bool('ALEPH_CACHE', not DEBUG)
+# In-process tier of the object cache: number of entries, total size of
+# the encoded values in bytes, and seconds for which a cached object may
+# be used without checking redis.
+CACHE_LOCAL_SIZE = env.to_int('ALEPH_CACHE_LOCAL_SIZE', 4096)
+CACHE_LOCAL_BYTES = env.to_int('ALEPH_CACHE_LOCAL_BYTES', 32 * 1024 * 1024)
+CACHE_LOCAL_EXPIRE = env.to_int('ALEPH_CACHE_LOCAL_EXPIRE', 5)
+# Compress cached objects larger than this many bytes.
+CACHE_COMPRESS = env.to_int('ALEPH_CACHE_COMPRESS', 4096)
 # Puts the system into read-only mode and displays a warning.
 MAINTENANCE = env.to_bool('ALEPH_MAINTENANCE', False)
 # Unit test context.
@@ -99,12 +107,27 @@ UI_LANGUAGES = [l.lower().strip() for l in UI_LANGUAGES]
 # Result high-lighting
 RESULT_HIGHLIGHT = env.to_bool('ALEPH_RESULT_HIGHLIGHT', True)
 
+# Cache search results in redis until the collections they cover change.
+# This only applies to searches filtered by collection. Results larger
+# than the given number of bytes are not cached.
+SEARCH_CACHE = env.to_bool('ALEPH_SEARCH_CACHE', False)
+SEARCH_CACHE_EXPIRE = env.to_int('ALEPH_SEARCH_CACHE_EXPIRE', 3600)
+SEARCH_CACHE_SIZE = env.to_int('ALEPH_SEARCH_CACHE_SIZE', 512 * 1024)
+# Results cached up to this many seconds after a change are not used, as
+# they may predate the next refresh of the index (default: 1s):
+SEARCH_CACHE_REFRESH = env.to_int('ALEPH_SEARCH_CACHE_REFRESH', 2)
+
 # Minimum update date for sitemap.xml
 SITEMAP_FLOOR = '2019-06-22'
 
 # Maximum number of entities to return per property when expanding entities
 MAX_EXPAND_ENTITIES = env.to_int('ALEPH_MAX_EXPAND_ENTITIES', 200)
 
+# Search exports run in the worker: the maximum number of results in an
+# export, and how many archive files are downloaded at the same time.
+EXPORT_MAX_RESULTS = env.to_int('ALEPH_EXPORT_MAX_RESULTS', 10000)
+EXPORT_FETCH_THREADS = env.to_int('ALEPH_EXPORT_FETCH_THREADS', 8)
+
 # API rate limiting (req/min for anonymous users)
 API_RATE_LIMIT = env.to_int('ALEPH_API_RATE_LIMIT', 30)
 API_RATE_WINDOW = 15  # minutes
@@ -137,3 +160,33 @@ ELASTICSEARCH_TIMEOUT = env.to_int('ELASTICSEARCH_TIMEOUT', 30)
 INDEX_PREFIX = env.get('ALEPH_INDEX_PREFIX', APP_NAME)
 INDEX_WRITE = env.get('ALEPH_INDEX_WRITE', 'v1')
 INDEX_READ = env.to_list('ALEPH_INDEX_READ', [INDEX_WRITE])
+
+# Store all entities of a collection on the same shard of each index, so
+# that collection-scoped queries don't fan out to every shard. Toggling
+# this requires re-indexing all collections (`aleph reindex --flush`).
+INDEX_ROUTING = env.to_bool('ALEPH_INDEX_ROUTING', False)
+
+# Filter entity and xref searches by the role IDs stamped onto them, rather
+# than by the list of all collections a user can read. Enable this after
+# all collections have been re-stamped (`aleph restamp`).
+INDEX_ACL = env.to_bool('ALEPH_INDEX_ACL', False)
+
+# Bulk indexing: number of concurrent bulk requests per process, and the
+# maximum size of a single request body in bytes.
+INDEX_BULK_THREADS = env.to_int('ALEPH_INDEX_BULK_THREADS', 1)
+INDEX_BULK_BYTES = env.to_int('ALEPH_INDEX_BULK_BYTES', 10 * 1024 * 1024)
+
+# While collections are processed or mappings loaded, switch off index
+# refreshes and reduce the number of replicas on the entity indexes.
+INDEX_BULK_LOAD = env.to_bool('ALEPH_INDEX_BULK_LOAD', False)
+INDEX_BULK_REPLICAS = env.to_int('ALEPH_INDEX_BULK_REPLICAS', 0)
+
+# Number of parallel slices used when scrolling through all entities,
+# e.g. in the stream API or when cross-referencing a collection.
+INDEX_SCAN_SLICES = env.to_int('ALEPH_INDEX_SCAN_SLICES', 1)
+
+# Cross-referencing sends the match queries of a batch of entities as one
+# multi-search: the number of those queries run at the same time, and the
+# time limit (in seconds) for each of them.
+XREF_CONCURRENCY = env.to_int('ALEPH_XREF_CONCURRENCY', 5)
+XREF_TIMEOUT = env.to_int('ALEPH_XREF_TIMEOUT', 30)
@@ -0,0 +1,109 @@
+from time import time, sleep
+from aleph.core import kv
+from aleph.model import Collection
+from aleph.cache import Cache, LocalCache
+from aleph.tests.util import TestCase
+
+
+class LocalCacheTestCase(TestCase):
+
+    def test_local_cache(self):
+        local = LocalCache(kv, size=2)
+        local.set('a', {'name': 'a'})
+        local.set('b', {'name': 'b'})
+        self.assertEqual(local.get('a'), {'name': 'a'})
+        local.set('c', {'name': 'c'})
+        self.assertIsNone(local.get('b'))
+        self.assertIsNotNone(local.get('a'))
+
+    def test_local_cache_bytes(self):
+        local = LocalCache(kv, size=100, max_bytes=640)
+        local.set('a', 'x' * 5)
+        local.set('b', 'x' * 5)
+        # Values above the share of the budget are not kept:
+        local.set('c', 'x' * 11)
+        self.assertIsNone(local.get('c'))
+        for i in range(70):
+            local.set('k%s' % i, 'x' * 10)
+        self.assertLessEqual(local.bytes, 640)
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(local.get('k69'), 'x' * 10)
+
+    def test_local_cache_copies(self):
+        local = LocalCache(kv)
+        local.set('a', {'name': 'a'})
+        local.get('a').pop('name')
+        self.assertEqual(local.get('a'), {'name': 'a'})
+
+    def test_local_cache_bump(self):
+        local = LocalCache(kv)
+        local.set('a', {'name': 'a'})
+        LocalCache.bump(kv)
+        self.assertIsNone(local.get('a'))
+
+    def test_local_cache_busy(self):
+        # Outside of a request, e.g. in a worker:
+        self._ctx.pop()
+        try:
+            local = LocalCache(kv)
+            local.set('a', {'name': 'a'})
+            LocalCache.bump(kv)
+            # Using the cache doesn't postpone reading the generation:
+            local.checked_at = time() - 0.9
+            local.get('a')
+            sleep(0.2)
+            self.assertIsNone(local.get('a'))
+        finally:
+            self._ctx.push()
+
+    def test_local_cache_scope(self):
+        local = LocalCache(kv, scope='a')
+        local.set('a', {'name': 'a'})
+        LocalCache.bump(kv, 'b')
+        self.assertIsNotNone(local.get('a'))
+        LocalCache.bump(kv, 'a')
+        self.assertIsNone(local.get('a'))
+        local.set('a', {'name': 'a'})
+        LocalCache.bump(kv)
+        self.assertIsNone(local.get('a'))
+
+    def test_codec(self):
+        cache = Cache(kv, prefix='test', compress=100)
+        small = {'id': 'a', 'names': ['Jane']}
+        data = cache.encode(small)
+        self.assertFalse(data.startswith(Cache.COMPRESSED))
+        self.assertEqual(cache.decode(data), small)
+        large = {'id': 'b', 'names': ['Jane Doe'] * 100}
+        data = cache.encode(large)
+        self.assertTrue(data.startswith(Cache.COMPRESSED))
+        self.assertEqual(cache.decode(data), large)
+
+    def test_two_tiers(self):
+        cache = Cache(kv, prefix='test', local_size=10)
+        key = cache.key('Entity', 'a')
+        cache.set_many_complex([(key, {'id': 'a'})])
+        self.assertEqual(cache.get_complex(key), {'id': 'a'})
+        self.assertEqual(cache.stats['Entity']['local_hits'], 1)
+        cache.delete(key)
+        self.assertIsNone(cache.get_complex(key))
+        self.assertEqual(cache.stats['Entity']['misses'], 1)
+
+    def test_generations(self):
+        cache = Cache(kv, prefix='test')
+        key = cache.key('Entity', 'a')
+        scoped = cache.object_key(Collection, 5, 'facets')
+        state = cache.state_key('counter')
+        cache.bump(Collection.__name__, 5)
+        self.assertEqual(key, cache.key('Entity', 'a'))
+        self.assertNotEqual(scoped, cache.object_key(Collection, 5, 'facets'))
+        cache.flush()
+        self.assertNotEqual(key, cache.key('Entity', 'a'))
+        self.assertEqual(state, cache.state_key('counter'))
+
+    def test_object_keys(self):
+        cache = Cache(kv, prefix='test')
+        cache.bump(Collection.__name__, 5)
+        keys = cache.object_keys(Collection, [4, 5])
+        self.assertEqual(keys, [cache.object_key(Collection, 4),
+                                cache.object_key(Collection, 5)])
+        self.assertNotEqual(keys[0].split(':')[-1], keys[1].split(':')[-1])
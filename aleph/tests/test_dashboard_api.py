@@ -15,9 +15,11 @@ class DashboardApiTestCase(TestCase):
                               headers=headers)
         assert res.status_code == 200, res
         assert res.json.get('total') == 0, res.json
+        assert 'indexing' not in res.json, res.json
         _, headers = self.login(is_admin=True)
         res = self.client.get('/api/2/status',
                               headers=headers)
         assert res.status_code == 200, res
         assert res.json.get('total') == 0, res.json
+        assert 'entities' in res.json['indexing'], res.json
         validate(res.json, 'SystemStatusResponse')
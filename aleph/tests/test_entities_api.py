@@ -86,8 +86,10 @@ class EntitiesApiTestCase(TestCase):
 
         _, headers = self.login(is_admin=True)
         res = self.client.get(url, headers=headers)
-        assert res.status_code == 200, res
-        assert 'application/zip' in res.headers.get('Content-Type')
+        assert res.status_code == 202, res
+        assert res.json['status'] == 'accepted', res.json
+        res = self.client.get(url + '&format=pdf', headers=headers)
+        assert res.status_code == 400, res
 
     def test_view(self):
         url = '/api/2/entities/%s' % self.id
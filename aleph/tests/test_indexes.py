@@ -0,0 +1,84 @@
+from unittest import TestCase
+from followthemoney import model
+
+from aleph.core import settings
+from aleph.index.indexes import entities_read_index, entities_index_list
+from aleph.index.indexes import group_alias, schema_index
+from aleph.index.util import BulkIndexer
+from aleph.index.entities import _numeric_props, _numeric_values
+from aleph.index.collections import _stats_query, _stats_result
+from aleph.index.collections import STATS_FACETS
+
+
+class IndexesTestCase(TestCase):
+
+    def setUp(self):
+        self.version = settings.INDEX_WRITE
+        self._read = settings.INDEX_READ
+        settings.INDEX_READ = [self.version]
+
+    def tearDown(self):
+        settings.INDEX_READ = self._read
+
+    def test_read_index_all(self):
+        indexes = entities_read_index().split(',')
+        assert group_alias('Thing', self.version) in indexes, indexes
+        assert group_alias('Record', self.version) in indexes, indexes
+        assert len(indexes) < len(list(entities_index_list())), indexes
+
+    def test_read_index_group(self):
+        index = entities_read_index(schema='LegalEntity')
+        self.assertEqual(index, group_alias('LegalEntity', self.version))
+
+    def test_read_index_partial(self):
+        index = entities_read_index(schema=['Person', 'Company'])
+        indexes = index.split(',')
+        assert schema_index(model.get('Person'), self.version) in indexes
+        assert schema_index(model.get('Company'), self.version) in indexes
+        self.assertEqual(len(indexes), 2)
+
+    def test_read_index_matchable(self):
+        schemata = list(model.get('Person').matchable_schemata)
+        index = entities_read_index(schema=schemata, expand=False)
+        indexes = index.split(',')
+        company = schema_index(model.get('Company'), self.version)
+        assert company not in indexes, indexes
+        self.assertEqual(len(indexes), 2)
+
+    def test_bulk_chunks(self):
+        actions = [{'_id': str(i), '_index': 'test', '_source': {'a': i}}
+                   for i in range(10)]
+        indexer = BulkIndexer(chunk_size=4)
+        chunks = list(indexer.chunks(actions))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+        size = len(indexer.serialize(actions[0]))
+        indexer = BulkIndexer(chunk_size=4, max_bytes=size * 3)
+        chunks = list(indexer.chunks(actions))
+        self.assertEqual([len(c) for c in chunks], [3, 3, 3, 1])
+
+    def test_bulk_throttle(self):
+        indexer = BulkIndexer(chunk_size=100)
+        indexer.throttle()
+        self.assertEqual(indexer.chunk_size, 50)
+        indexer.recover()
+        self.assertEqual(indexer.chunk_size, 55)
+
+    def test_numeric_props(self):
+        props = _numeric_props(model.get('Payment'))
+        assert 'amount' in props, props
+        assert 'date' in props, props
+        assert 'summary' not in props, props
+        values = _numeric_values(props['amount'], ['1,000.5', 'foo'])
+        self.assertEqual(values, [1000.5])
+
+    def test_stats_aggregations(self):
+        query = _stats_query(5)
+        self.assertEqual(len(query['aggs']), len(STATS_FACETS) * 2)
+        result = {'aggregations': {
+            'schema.values': {'buckets': [{'key': 'Person', 'doc_count': 3}]},
+            'schema.total': {'value': 1}
+        }}
+        stats = _stats_result(result)
+        self.assertEqual(stats['schema']['values'], {'Person': 3})
+        self.assertEqual(stats['schema']['total'], 1)
+        self.assertEqual(stats['emails'], {'values': {}, 'total': 0})
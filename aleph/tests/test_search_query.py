@@ -1,5 +1,8 @@
 from unittest import TestCase
-from aleph.search.parser import SearchQueryParser
+from werkzeug.exceptions import BadRequest
+from aleph.core import settings
+from aleph.search import EntitiesQuery
+from aleph.search.parser import SearchQueryParser, encode_cursor
 from aleph.search.query import Query
 
 
@@ -118,3 +121,52 @@ class QueryTestCase(TestCase):
                 ]
             }
         })
+
+    def test_routing(self):
+        routing = settings.INDEX_ROUTING
+        try:
+            settings.INDEX_ROUTING = False
+            parser = SearchQueryParser([('filter:collection_id', '5')], None)
+            self.assertIsNone(EntitiesQuery(parser).get_routing())
+            settings.INDEX_ROUTING = True
+            self.assertEqual(EntitiesQuery(parser).get_routing(), '5')
+            parser = SearchQueryParser([('filter:collection_id', '5'),
+                                        ('facet', 'collection_id')], None)
+            self.assertIsNone(EntitiesQuery(parser).get_routing())
+        finally:
+            settings.INDEX_ROUTING = routing
+
+    def test_cursor(self):
+        args = [('offset', 20), ('limit', 10), ('cursor', 'true')]
+        body = EntitiesQuery(SearchQueryParser(args, None)).get_body()
+        self.assertNotIn('from', body)
+        self.assertNotIn('search_after', body)
+        self.assertEqual(body['sort'], ['_score', {'id': 'asc'}])
+        token = encode_cursor([1.5, 'abc'])
+        parser = SearchQueryParser([('after', token)], None)
+        self.assertTrue(parser.cursor)
+        body = EntitiesQuery(parser).get_body()
+        self.assertEqual(body['search_after'], [1.5, 'abc'])
+        body = query([('after', token)]).get_body()
+        self.assertNotIn('search_after', body)
+
+    def test_invalid_cursor(self):
+        for token in ('nope', encode_cursor({'a': 1}), encode_cursor([]),
+                      encode_cursor([[1], 'abc']), encode_cursor([None])):
+            with self.assertRaises(BadRequest):
+                SearchQueryParser([('after', token)], None)
+        # The cursor has to match the sort of the query:
+        parser = SearchQueryParser([('after', encode_cursor([1.5]))], None)
+        with self.assertRaises(BadRequest):
+            EntitiesQuery(parser).get_body()
+
+    def test_cache_key(self):
+        q = query([('q', 'foo'), ('filter:collection_id', '5')])
+        key = q.get_cache_key('index', None, q.get_body())
+        self.assertEqual(key, q.get_cache_key('index', None, q.get_body()))
+        self.assertNotEqual(key, q.get_cache_key('index', '5', q.get_body()))
+        other = query([('q', 'bar')])
+        self.assertNotEqual(key, q.get_cache_key('index', None,
+                                                 other.get_body()))
+        self.assertEqual(q.get_cache_collections(), set(['5']))
+        self.assertIsNone(other.get_cache_collections())
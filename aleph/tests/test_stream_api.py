@@ -1,3 +1,6 @@
+import gzip
+import json
+
 from aleph.tests.util import TestCase
 
 
@@ -16,3 +19,36 @@ class StreamApiTestCase(TestCase):
         assert res.status_code == 200, res
         lines = len(res.data.split(b'\n'))
         assert 19 == lines, lines
+
+    def test_entities_resume(self):
+        self.load_fixtures()
+        _, headers = self.login(is_admin=True)
+        url = '/api/2/entities/_stream?cursor=true'
+        res = self.client.get(url, headers=headers)
+        assert res.status_code == 200, res
+        entities = [json.loads(line) for line in res.data.splitlines()]
+        assert 18 == len(entities), len(entities)
+        ids = [e['id'] for e in entities]
+        assert ids == sorted(ids), ids
+
+        after = entities[9]['cursor']
+        res = self.client.get(url + '&after=' + after, headers=headers)
+        rest = [json.loads(line)['id'] for line in res.data.splitlines()]
+        assert rest == ids[10:], rest
+
+        res = self.client.get(url + '&after=foo', headers=headers)
+        assert res.status_code == 400, res
+
+    def test_entities_gzip(self):
+        self.load_fixtures()
+        _, headers = self.login(is_admin=True)
+        headers['Accept-Encoding'] = 'gzip'
+        url = '/api/2/entities/_stream?property=name'
+        res = self.client.get(url, headers=headers)
+        assert res.status_code == 200, res
+        assert res.headers.get('Content-Encoding') == 'gzip', res.headers
+        lines = gzip.decompress(res.data).splitlines()
+        assert 18 == len(lines), len(lines)
+        for line in lines:
+            props = json.loads(line).get('properties', {})
+            assert set(props.keys()) <= set(['name']), props
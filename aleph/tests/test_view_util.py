@@ -1,6 +1,10 @@
 from lxml.html import document_fromstring
 
+from datetime import datetime
+
+from aleph.util import dump_json
 from aleph.views.util import get_url_path, sanitize_html
+from aleph.views.serializers import clean_response
 from aleph.tests.util import TestCase
 
 
@@ -32,3 +36,23 @@ class ViewUtilTest(TestCase):
         assert attr == 'https://example.org/blockchain', html
         assert html.find('.//a').get('target') == '_blank', html
         assert 'nofollow' in html.find('.//a').get('rel'), html
+
+    def test_clean_response(self):
+        data = {
+            'a': '',
+            'b': [None, '', {'c': []}, 0],
+            'd': {'e': {'f': ''}},
+            'g': ('h',),
+            'i': False,
+        }
+        cleaned = clean_response(data)
+        assert cleaned == {'b': [0], 'g': ['h'], 'i': False}, cleaned
+        assert data['a'] == '', data
+        assert clean_response({'a': [{}]}) is None
+        assert clean_response('') is None
+        assert clean_response(5) == 5
+
+    def test_dump_json(self):
+        data = {'a': datetime(2020, 1, 2, 3, 4, 5), 'b': set(['x']), 1: 2}
+        out = dump_json(data)
+        assert out == '{"a":"2020-01-02T03:04:05","b":["x"],"1":2}', out
@@ -1,11 +1,16 @@
 import json
 from unittest import skip  # noqa
+from followthemoney import model
+from followthemoney.compare import compare
 
 from aleph.core import db
 from aleph.authz import Authz
 from aleph.tests.util import TestCase
-from aleph.logic.xref import xref_collection
-from aleph.index.xref import iter_matches
+from aleph.logic.xref import xref_collection, _match_search
+from aleph.logic.xref import ENGINE_BLOCKING
+from aleph.logic.scoring import score_pairs
+from aleph.logic.blocking import blocking_keys
+from aleph.index.xref import iter_matches, get_watermark
 from aleph.queues import get_stage, OP_XREF
 
 
@@ -87,3 +92,113 @@ class XrefTestCase(TestCase):
         xref_collection(self.stage, self.coll_a)
         matches = list(iter_matches(self.coll_a, self.authz))
         assert 3 == len(matches), len(matches)
+
+    def test_xref_against(self):
+        against = [self.coll_c.id]
+        xref_collection(self.stage, self.coll_a,
+                        against_collection_ids=against)
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 1 == len(matches), len(matches)
+        match = matches[0]
+        assert str(match['match_collection_id']) == str(self.coll_c.id)
+        assert match['against_collection_ids'] == [str(self.coll_c.id)]
+
+        # Re-running against some targets keeps the other matches:
+        xref_collection(self.stage, self.coll_a)
+        xref_collection(self.stage, self.coll_a,
+                        against_collection_ids=against)
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 3 == len(matches), len(matches)
+
+    def test_xref_incremental(self):
+        # Without a previous run, everything is matched:
+        assert get_watermark(self.coll_a.id) is None
+        xref_collection(self.stage, self.coll_a, incremental=True)
+        assert get_watermark(self.coll_a.id) is not None
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 3 == len(matches), len(matches)
+
+        # Nothing has changed since, so the matches are left as they are:
+        xref_collection(self.stage, self.coll_a, incremental=True)
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 3 == len(matches), len(matches)
+
+        # Entities loaded in bulk into other collections are matched:
+        _, headers = self.login(is_admin=True)
+        url = '/api/2/collections/%s/_bulk' % self.coll_b.id
+        entities = [{
+            'id': 'incremental-danger',
+            'schema': 'Person',
+            'properties': {
+                'name': 'Carlos Danger',
+                'nationality': 'US'
+            }
+        }]
+        res = self.client.post(url, headers=headers,
+                               data=json.dumps(entities))
+        assert res.status_code == 204, res
+        xref_collection(self.stage, self.coll_a, incremental=True)
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 4 == len(matches), len(matches)
+        match_ids = [m['match_id'] for m in matches]
+        assert 'incremental-danger' in str(match_ids), match_ids
+
+    def test_xref_blocking(self):
+        xref_collection(self.stage, self.coll_a,
+                        against_collection_ids=[self.coll_b.id],
+                        engine=ENGINE_BLOCKING)
+        matches = list(iter_matches(self.coll_a, self.authz))
+        assert 2 == len(matches), len(matches)
+        for match in matches:
+            assert 'Carlos Danger' in match['text'], match
+
+    def test_blocking_keys(self):
+        entity = model.make_entity('Company')
+        entity.add('name', 'Pure Risk')
+        entity.add('email', 'Info@Risk.com')
+        keys = blocking_keys(entity)
+        assert 'name:pure' in keys, keys
+        assert 'name:risk' in keys, keys
+        assert 'email:inforiskcom' in keys, keys
+
+    def test_match_search(self):
+        entity = model.make_entity('Person')
+        entity.id = 'test'
+        assert _match_search(entity) is None
+        entity.add('name', 'Carlos Danger')
+        header, body = _match_search(entity)
+        assert 'person' in header['index'], header
+        assert body['size'] == 100, body
+        assert body['timeout'].endswith('s'), body
+
+    def test_score_pairs(self):
+        fixtures = [
+            ('Person', {'name': 'Carlos Danger', 'nationality': 'US',
+                        'birthDate': '1970-01-01',
+                        'email': 'carlos@example.com'}),
+            ('LegalEntity', {'name': 'Carlos Dangerous', 'country': 'US',
+                             'email': 'carlos@example.com'}),
+            ('Company', {'name': 'Pure Risk Ltd', 'country': 'GB',
+                         'registrationNumber': '01234567'}),
+            ('Company', {'name': 'Pure Risk Limited', 'country': 'GB',
+                         'registrationNumber': '01234567',
+                         'phone': '+442071234567'}),
+            ('Person', {'name': ['Jane Doe', 'Jane Müller'],
+                        'nationality': 'DE', 'birthDate': '1980'}),
+            ('Vessel', {'name': 'Pure Risk', 'flag': 'PA'}),
+        ]
+        entities = []
+        for idx, (schema, props) in enumerate(fixtures):
+            entity = model.make_entity(schema)
+            entity.id = 'e%d' % idx
+            for prop, values in props.items():
+                entity.add(prop, values)
+            entities.append(entity)
+        pairs = [(a, b) for a in entities for b in entities]
+        pairs.append(pairs[1])
+        scores = score_pairs(pairs)
+        assert len(scores) == len(pairs), scores
+        assert max(scores) > 0, scores
+        for (a, b), score in zip(pairs, scores):
+            expected = compare(model, a, b)
+            assert abs(expected - score) < 1e-9, (a, b, score, expected)
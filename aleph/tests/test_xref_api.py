@@ -106,6 +106,17 @@ class XrefApiTestCase(TestCase):
         res = self.client.get(url, headers=headers)
         assert res.status_code == 200, res
 
+    def test_export_csv(self):
+        xref.xref_collection(self.stage, self.residents)
+        url = '/api/2/collections/%s/xref.csv' % self.residents.id
+        _, headers = self.login(foreign_id='creator')
+        res = self.client.get(url, headers=headers)
+        assert res.status_code == 200, res
+        assert 'attachment' in res.headers['Content-Disposition'], res.headers
+        lines = res.data.decode('utf-8').splitlines()
+        assert lines[0].startswith('Score,Entity Name'), lines
+        assert len(lines) > 1, lines
+
     def test_matches(self):
         xref.xref_collection(self.stage, self.residents)
         url = '/api/2/collections/%s/xref' % self.residents.id
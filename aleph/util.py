@@ -5,6 +5,10 @@ from normality import stringify
 from datetime import datetime, date
 from flask_babel.speaklater import LazyString
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger(__name__)
 
@@ -33,19 +37,51 @@ def anonymize_email(name, email):
     return '%s <%s>' % (name, email)
 
 
+def json_default(obj):
+    """Serialize the types JSON doesn't know about: dates, bytes, lazy
+    translations, sets and anything that has a to_dict method."""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    if isinstance(obj, LazyString):
+        return str(obj)
+    if isinstance(obj, set):
+        return [o for o in obj]
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    raise TypeError('Object of type %s is not JSON serializable' %
+                    obj.__class__.__name__)
+
+
 class JSONEncoder(json.JSONEncoder):
     """ This encoder will serialize all entities that have a to_dict
     method by calling that method and serializing the result. """
 
     def default(self, obj):
-        if isinstance(obj, (datetime, date)):
-            return obj.isoformat()
-        if isinstance(obj, bytes):
-            return obj.decode('utf-8')
-        if isinstance(obj, LazyString):
-            return str(obj)
-        if isinstance(obj, set):
-            return [o for o in obj]
-        if hasattr(obj, 'to_dict'):
-            return obj.to_dict()
-        return json.JSONEncoder.default(self, obj)
+        return json_default(obj)
+
+
+# The encoder keeps no state between calls, so one instance is shared. It
+# uses the C speedups of the json module, only the default hook is Python.
+ENCODER = JSONEncoder(separators=(',', ':'))
+if orjson is not None:
+    # Hand dates and str subclasses to json_default so the output matches
+    # the standard library encoder.
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | \
+        orjson.OPT_PASSTHROUGH_DATETIME | \
+        orjson.OPT_PASSTHROUGH_SUBCLASS
+
+
+def dump_json(obj):
+    """Serialize `obj` to a compact JSON string. This uses orjson if it
+    is installed and falls back to the standard library encoder for the
+    few values orjson rejects (e.g. integers wider than 64 bits)."""
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, default=json_default,
+                                option=ORJSON_OPTIONS)
+            return data.decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass
+    return ENCODER.encode(obj)
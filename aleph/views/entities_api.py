@@ -1,6 +1,7 @@
 import logging
-from flask import Blueprint, request, Response
-from werkzeug.exceptions import NotFound
+from flask import Blueprint, request
+from flask_babel import gettext
+from werkzeug.exceptions import BadRequest, NotFound
 from followthemoney import model
 from followthemoney.types import registry
 from urllib.parse import quote
@@ -12,7 +13,7 @@ from aleph.search import EntitiesQuery, MatchQuery
 from aleph.search.parser import SearchQueryParser, QueryParser
 from aleph.logic.entities import upsert_entity, delete_entity
 from aleph.logic.entities import entity_references, entity_tags, entity_expand
-from aleph.logic.export import export_entities
+from aleph.logic.export import queue_search_export, FORMATS
 from aleph.index.util import MAX_PAGE
 from aleph.views.util import get_index_entity, get_db_collection
 from aleph.views.util import jsonify, parse_request, get_flag, sanitize_html
@@ -149,35 +150,37 @@ def export():
     """
     ---
     get:
-      summary: Download the results of a search
+      summary: Export the results of a search
       description: >-
-        Downloads all the results of a search as a zip archive; upto a max of
-        10,000 results. The returned file will contain an Excel document with
-        structured data as well as the binary files from all matching
-        documents.
+        Schedules an export of all the results of a search as a zip
+        archive; up to a configured maximum of results. Once complete, a
+        download link is sent to the user by email. The archive will
+        contain an Excel document (or CSV files) with structured data as
+        well as the binary files from all matching documents.
 
         Supports the same query parameters as the search API.
+      parameters:
+      - description: Table format, `xlsx` (default) or `csv`.
+        in: query
+        name: format
+        schema:
+          type: string
       responses:
-        '200':
-          content:
-            application/zip:
-              schema:
-                format: binary
-                type: string
-          description: OK
+        '202':
+          description: Accepted
       tags:
       - Entity
     """
     require(request.authz.logged_in)
+    format = request.args.get('format', FORMATS[0])
+    if format not in FORMATS:
+        raise BadRequest(gettext('Invalid export format.'))
     parser = SearchQueryParser(request.args, request.authz)
-    parser.limit = MAX_PAGE
+    # Check that the query is valid before queueing it:
+    EntitiesQuery(parser).get_index()
     tag_request(query=parser.text, prefix=parser.prefix)
-    result = EntitiesQuery.handle(request, parser=parser)
-    stream = export_entities(request, result)
-    response = Response(stream, mimetype='application/zip')
-    disposition = 'attachment; filename={}'.format('Query_export.zip')
-    response.headers['Content-Disposition'] = disposition
-    return response
+    queue_search_export(request.authz, request.args, format=format)
+    return jsonify({'status': 'accepted'}, status=202)
 
 
 @blueprint.route('/api/2/match', methods=['POST'])
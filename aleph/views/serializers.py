@@ -18,6 +18,63 @@ from aleph.views.util import jsonify
 log = logging.getLogger(__name__)
 
 
+SCALARS = (str, int, float, bool, type(None))
+
+
+def _open(value):
+    """Return an item iterator and an empty copy if `value` is a mapping
+    or a list, otherwise None."""
+    type_ = type(value)
+    if type_ is dict:
+        return iter(value.items()), {}
+    if type_ is list:
+        return enumerate(value), []
+    if type_ in SCALARS:
+        return None
+    if is_mapping(value):
+        return iter(value.items()), {}
+    if is_listish(value):
+        return enumerate(value), []
+
+
+def clean_response(data):
+    """Drop empty strings, lists and dicts from a nested structure. This
+    walks the structure with an explicit stack instead of recursing, and
+    builds a new copy rather than modifying `data`."""
+    opened = _open(data)
+    if opened is None:
+        if isinstance(data, str) and not len(data):
+            return None
+        return data
+    items, out = opened
+    stack = [(items, out, None, None)]
+    while True:
+        items, out, parent, key = stack[-1]
+        is_dict = type(out) is dict
+        for key_, value in items:
+            if value is None or (isinstance(value, str) and not value):
+                continue
+            opened = _open(value)
+            if opened is not None:
+                stack.append((opened[0], opened[1], out, key_))
+                break
+            if is_dict:
+                out[key_] = value
+            else:
+                out.append(value)
+        else:
+            stack.pop()
+            value = out if len(out) else None
+            if not len(stack):
+                return value
+            if value is None:
+                continue
+            if type(parent) is dict:
+                parent[key] = value
+            else:
+                parent.append(value)
+
+
 class Serializer(object):
 
     def __init__(self, reference=False):
@@ -83,20 +140,7 @@ class Serializer(object):
 
     def _clean_response(self, data):
         """Remove unset values from the response to save some bandwidth."""
-        if is_mapping(data):
-            out = {}
-            for k, v in data.items():
-                v = self._clean_response(v)
-                if v is not None:
-                    out[k] = v
-            return out if len(out) else None
-        elif is_listish(data):
-            data = [self._clean_response(d) for d in data]
-            data = [d for d in data if d is not None]
-            return data if len(data) else None
-        elif isinstance(data, str):
-            return data if len(data) else None
-        return data
+        return clean_response(data)
 
     @classmethod
     def jsonify(cls, obj, **kwargs):
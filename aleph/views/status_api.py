@@ -3,6 +3,7 @@ from flask import Blueprint, request
 
 from aleph.model import Collection
 from aleph.queues import get_active_collection_status
+from aleph.index.entities import format_stats
 from aleph.views.serializers import CollectionSerializer
 from aleph.views.util import jsonify, require
 
@@ -45,7 +46,10 @@ def status():
             result['collection'] = serializer.serialize(collection.to_dict())
             result['id'] = fid
             results.append(result)
-    return jsonify({
+    data = {
         'results': results,
         'total': len(results)
-    })
+    }
+    if request.authz.is_admin:
+        data['indexing'] = format_stats()
+    return jsonify(data)
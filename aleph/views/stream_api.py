@@ -1,10 +1,15 @@
 import logging
 from banal import ensure_list
 from flask import Blueprint, request
+from flask_babel import gettext
+from werkzeug.exceptions import BadRequest
 
-from aleph.index.entities import iter_entities, PROXY_INCLUDES
-from aleph.views.util import get_db_collection
-from aleph.views.util import require, stream_ijson
+from aleph.index.entities import iter_entities, iter_entities_sorted
+from aleph.index.entities import has_unsorted_entities
+from aleph.index.entities import PROXY_INCLUDES
+from aleph.search.parser import encode_cursor, decode_cursor
+from aleph.views.util import get_db_collection, get_flag
+from aleph.views.util import require, stream_ijson, stream_encoding
 
 log = logging.getLogger(__name__)
 blueprint = Blueprint('bulk_api', __name__)
@@ -19,7 +24,11 @@ def entities(collection_id=None):
       summary: Stream collection entities.
       description: >
         Stream a JSON form of each entity in the given collection, or
-        throughout the entire database.
+        throughout the entire database. With `cursor=true`, entities are
+        sent in a stable order and each carries a `cursor` token; pass
+        the last token received as `after` to resume an interrupted
+        stream. The response is compressed if the client accepts gzip
+        (or zstd, where the server supports it).
       parameters:
       - description: The collection ID.
         in: path
@@ -28,6 +37,26 @@ def entities(collection_id=None):
         schema:
           minimum: 1
           type: integer
+      - description: Only stream entities of the given schema.
+        in: query
+        name: schema
+        schema:
+          type: string
+      - description: Only include the given properties of each entity.
+        in: query
+        name: property
+        schema:
+          type: string
+      - description: Send a resume token with each entity.
+        in: query
+        name: cursor
+        schema:
+          type: boolean
+      - description: Resume the stream after the given token.
+        in: query
+        name: after
+        schema:
+          type: string
       responses:
         '200':
           description: OK
@@ -46,10 +75,44 @@ def entities(collection_id=None):
     schemata = ensure_list(request.args.getlist('schema'))
     includes = ensure_list(request.args.getlist('include'))
     includes = includes or PROXY_INCLUDES
+    props = ensure_list(request.args.getlist('property'))
+    if len(props) and 'properties' in includes:
+        includes = [i for i in includes if i != 'properties']
+        includes.extend('properties.%s' % p for p in props)
     if collection_id is not None:
         get_db_collection(collection_id, request.authz.READ)
-    entities = iter_entities(authz=request.authz,
-                             collection_id=collection_id,
-                             schemata=schemata,
-                             includes=includes)
-    return stream_ijson(entities)
+    encoding = stream_encoding()
+    after = request.args.get('after')
+    cursor = get_flag('cursor') or after is not None
+    if cursor and has_unsorted_entities(authz=request.authz,
+                                        collection_id=collection_id,
+                                        schemata=schemata):
+        # Entities indexed before the `id` field was added can't be put
+        # in order, until the collection has been re-indexed:
+        if after is not None:
+            raise BadRequest(gettext("This collection needs to be "
+                                     "re-indexed before a stream can "
+                                     "be resumed."))
+        log.warning("Stream without cursors, re-index needed: %s",
+                    collection_id)
+        cursor = False
+    if not cursor:
+        entities = iter_entities(authz=request.authz,
+                                 collection_id=collection_id,
+                                 schemata=schemata,
+                                 includes=includes)
+        return stream_ijson(entities, encoding=encoding)
+    if after is not None:
+        after = decode_cursor(after, length=1)
+    entities = iter_entities_sorted(authz=request.authz,
+                                    collection_id=collection_id,
+                                    schemata=schemata,
+                                    includes=includes,
+                                    after=after)
+    return stream_ijson(_with_cursor(entities), encoding=encoding)
+
+
+def _with_cursor(entities):
+    for sort, entity in entities:
+        entity['cursor'] = encode_cursor(sort)
+        yield entity
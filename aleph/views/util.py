@@ -1,11 +1,12 @@
 import io
 import csv
+import zlib
 import logging
 from banal import as_bool, ensure_dict
 from normality import stringify
 from flask import Response, request, render_template
 from flask_babel import gettext
-from werkzeug.urls import url_parse, url_join
+from werkzeug.urls import url_parse, url_join, url_quote
 from werkzeug.exceptions import Forbidden
 from werkzeug.exceptions import BadRequest, NotFound
 from lxml.etree import tostring
@@ -18,9 +19,17 @@ from aleph.model import Collection
 from aleph.validation import get_validator
 from aleph.index.entities import get_entity as _get_index_entity
 from aleph.index.collections import get_collection as _get_index_collection
-from aleph.util import JSONEncoder
+from aleph.util import dump_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger(__name__)
+# Compressed streams are flushed every so many rows, so that a client
+# always receives complete lines it can decode:
+STREAM_FLUSH_ROWS = 1000
 
 
 def require(*predicates):
@@ -163,9 +172,15 @@ def normalize_href(href, base_url):
         return None
 
 
-def jsonify(obj, status=200, headers=None, encoder=JSONEncoder):
+def _encode(encoder):
+    if encoder is None:
+        return dump_json
+    return encoder().encode
+
+
+def jsonify(obj, status=200, headers=None, encoder=None):
     """Serialize to JSON and also dump from the given schema."""
-    data = encoder().encode(obj)
+    data = _encode(encoder)(obj)
     mimetype = 'application/json'
     if 'callback' in request.args:
         cb = request.args.get('callback')
@@ -178,28 +193,74 @@ def jsonify(obj, status=200, headers=None, encoder=JSONEncoder):
                     mimetype=mimetype)
 
 
-def stream_ijson(iterable, encoder=JSONEncoder):
-    """Stream JSON line-based data."""
+def stream_encoding():
+    """Pick a compression for a streamed response from the request's
+    Accept-Encoding header, or None to send it uncompressed."""
+    encodings = ['gzip']
+    if zstandard is not None:
+        encodings.insert(0, 'zstd')
+    return request.accept_encodings.best_match(encodings)
+
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+        return compressor, zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    # wbits 16 + 15 writes a gzip header and trailer:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor, zlib.Z_SYNC_FLUSH
+
+
+def stream_ijson(iterable, encoder=None, encoding=None):
+    """Stream JSON line-based data, compressed with `encoding` (`gzip`
+    or `zstd`) if given."""
+    encode = _encode(encoder)
+
     def _generate_stream():
         for row in iterable:
             row.pop('_index', None)
-            yield encoder().encode(row)
-            yield '\n'
-    return Response(_generate_stream(), mimetype='application/json+stream')
+            yield encode(row) + '\n'
+
+    def _generate_compressed():
+        compressor, flush = _compressor(encoding)
+        lines = []
+        for line in _generate_stream():
+            lines.append(line)
+            if len(lines) >= STREAM_FLUSH_ROWS:
+                data = ''.join(lines).encode('utf-8')
+                yield compressor.compress(data) + compressor.flush(flush)
+                lines = []
+        data = ''.join(lines).encode('utf-8')
+        yield compressor.compress(data) + compressor.flush()
+
+    if encoding is None:
+        return Response(_generate_stream(),
+                        mimetype='application/json+stream')
+    headers = {'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}
+    return Response(_generate_compressed(),
+                    headers=headers,
+                    mimetype='application/json+stream')
 
 
-def stream_csv(iterable):
-    """Stream JSON line-based data."""
+def stream_csv(iterable, file_name=None):
+    """Stream rows as CSV, written in chunks of `STREAM_FLUSH_ROWS`."""
     def _generate_stream():
-        for row in iterable:
-            values = []
-            for value in row:
-                values.append(stringify(value) or '')
-            buffer = io.StringIO()
-            writer = csv.writer(buffer, dialect='excel', delimiter=',')
-            writer.writerow(values)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, dialect='excel', delimiter=',')
+        for idx, row in enumerate(iterable, 1):
+            writer.writerow([stringify(value) or '' for value in row])
+            if idx % STREAM_FLUSH_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
             yield buffer.getvalue()
-    return Response(_generate_stream(), mimetype='text_csv')
+
+    headers = {}
+    if file_name is not None:
+        disposition = "attachment; filename*=UTF-8''%s" % url_quote(file_name)
+        headers['Content-Disposition'] = disposition
+    return Response(_generate_stream(), headers=headers, mimetype='text/csv')
 
 
 def render_xml(template, **kwargs):
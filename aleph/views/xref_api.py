@@ -1,15 +1,21 @@
+import shutil
 import logging
-from flask import Blueprint, request, send_file
+from itertools import chain
+from tempfile import mkdtemp
+from flask import Blueprint, request, send_file, stream_with_context
+from servicelayer.archive.util import ensure_path
 
 from aleph.model import Linkage
 from aleph.search import XrefQuery
 from aleph.index.xref import get_xref
-from aleph.logic.xref import export_matches
+from aleph.logic.xref import export_matches, iter_match_rows
+from aleph.logic.xref import EXPORT_HEADERS
 from aleph.logic.linkages import decide_xref
 from aleph.views.serializers import XrefSerializer
 from aleph.queues import queue_task, OP_XREF
 from aleph.views.util import get_db_collection, get_index_collection
 from aleph.views.util import parse_request, require, jsonify, obj_or_404
+from aleph.views.util import stream_csv
 
 XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'  # noqa
 blueprint = Blueprint('xref_api', __name__)
@@ -78,6 +84,14 @@ def generate(collection_id):
         required: true
         schema:
           type: integer
+      - description: >-
+          Only look for matches in the given collections.
+        in: query
+        name: against_collection_ids
+        schema:
+          type: array
+          items:
+            type: integer
       responses:
         '202':
           content:
@@ -94,7 +108,10 @@ def generate(collection_id):
       - Collection
     """
     collection = get_db_collection(collection_id, request.authz.WRITE)
-    queue_task(collection, OP_XREF)
+    against = request.args.getlist('against_collection_ids')
+    against = [get_db_collection(c, request.authz.READ).id for c in against]
+    payload = {'against_collection_ids': against}
+    queue_task(collection, OP_XREF, payload=payload)
     return jsonify({'status': 'accepted'}, status=202)
 
 
@@ -123,12 +140,53 @@ def export(collection_id):
       - Collection
     """
     collection = get_db_collection(collection_id, request.authz.READ)
-    buffer = export_matches(collection, request.authz)
-    file_name = '%s - Crossreference.xlsx' % collection.label
-    return send_file(buffer,
-                     mimetype=XLSX_MIME,
-                     as_attachment=True,
-                     attachment_filename=file_name)
+    work_path = ensure_path(mkdtemp(prefix='aleph.xref.'))
+    try:
+        file_path = work_path.joinpath('xref.xlsx')
+        export_matches(collection, request.authz, file_path)
+        file_name = '%s - Crossreference.xlsx' % collection.label
+        response = send_file(str(file_path),
+                             mimetype=XLSX_MIME,
+                             as_attachment=True,
+                             attachment_filename=file_name)
+    except Exception:
+        shutil.rmtree(work_path)
+        raise
+    response.call_on_close(lambda: shutil.rmtree(work_path))
+    return response
+
+
+@blueprint.route('/api/2/collections/<int:collection_id>/xref.csv')
+def export_csv(collection_id):
+    """
+    ---
+    get:
+      summary: Stream cross-reference results
+      description: >-
+        Download results of cross-referencing as a CSV file, which is
+        streamed while it is generated
+      parameters:
+      - in: path
+        name: collection_id
+        required: true
+        schema:
+          type: integer
+      responses:
+        '200':
+          description: OK
+          content:
+            text/csv:
+              schema:
+                type: string
+      tags:
+      - Xref
+      - Collection
+    """
+    collection = get_db_collection(collection_id, request.authz.READ)
+    rows = iter_match_rows(collection, request.authz)
+    rows = stream_with_context(chain([EXPORT_HEADERS], rows))
+    file_name = '%s - Crossreference.csv' % collection.label
+    return stream_csv(rows, file_name=file_name)
 
 
 @blueprint.route('/api/2/collections/<int:collection_id>/xref/<xref_id>', methods=['POST'])  # noqa
@@ -6,19 +6,25 @@ from aleph.model import Collection
 from aleph.queues import get_rate_limit
 from aleph.queues import (
     OP_INDEX, OP_PROCESS, OP_XREF, OP_XREF_ITEM,
-    OP_LOAD_MAPPING, OP_FLUSH_MAPPING
+    OP_LOAD_MAPPING, OP_FLUSH_MAPPING, OP_REINDEX, OP_EXPORT
 )
 from aleph.queues import OPERATIONS
 from aleph.logic.alerts import check_alerts
 from aleph.logic.collections import compute_collections, refresh_collection
 from aleph.logic.collections import reset_collection, process_collection
+from aleph.logic.collections import reindex_collection
 from aleph.logic.notifications import generate_digest
 from aleph.logic.mapping import load_mapping, flush_mapping
 from aleph.logic.roles import update_roles
+from aleph.logic.export import export_entities
 from aleph.logic.xref import xref_collection, xref_item
+from aleph.index.xref import commit_watermark, discard_watermark
 from aleph.logic.processing import index_aggregate
+from aleph.index.indexes import entities_write_list
+from aleph.index.util import bulk_load_open, bulk_load_close
 
 log = logging.getLogger(__name__)
+BULK_LOAD_STAGES = (OP_PROCESS, OP_LOAD_MAPPING)
 
 
 class AlephWorker(Worker):
@@ -34,21 +40,30 @@ class AlephWorker(Worker):
             log.info("Running hourly tasks...")
             compute_collections()
             check_alerts()
+            # Release bulk load windows of jobs that were never completed:
+            bulk_load_close(None, entities_write_list())
 
         if self.daily.check():
             self.daily.update()
             log.info("Running daily tasks...")
             generate_digest()
             update_roles()
+            compute_collections(reconcile=True)
 
     def handle(self, task):
         stage = task.stage
         payload = task.payload
+        if stage.stage == OP_EXPORT:
+            export_entities(**payload)
+            log.info("Task [%s]: %s (done)", task.job.dataset, stage.stage)
+            return
         collection = Collection.by_foreign_id(task.job.dataset.name)
         if collection is None:
             log.error("Collection not found: %s", task.job.dataset)
             return
         sync = task.context.get('sync', False)
+        if stage.stage in BULK_LOAD_STAGES:
+            bulk_load_open(task.job.id, entities_write_list())
         if stage.stage == OP_INDEX:
             index_aggregate(stage, collection, sync=sync, **payload)
         if stage.stage == OP_LOAD_MAPPING:
@@ -59,16 +74,27 @@ class AlephWorker(Worker):
             if payload.pop('reset', False):
                 reset_collection(collection, sync=True)
             process_collection(stage, collection, sync=sync, **payload)
+        if stage.stage == OP_REINDEX:
+            reindex_collection(stage, collection, sync=sync, **payload)
         if stage.stage == OP_XREF:
-            xref_collection(stage, collection)
+            xref_collection(stage, collection, **payload)
         if stage.stage == OP_XREF_ITEM:
             xref_item(stage, collection, **payload)
         log.info("Task [%s]: %s (done)", task.job.dataset, stage.stage)
 
+    def retry(self, task):
+        # Changes handled by a failed xref task must be matched again on
+        # the next incremental run:
+        if task.stage.stage in (OP_XREF, OP_XREF_ITEM):
+            discard_watermark(task.job.id)
+        super(AlephWorker, self).retry(task)
+
     def after_task(self, task):
         if task.job.is_done():
+            bulk_load_close(task.job.id, entities_write_list())
             collection = Collection.by_foreign_id(task.job.dataset.name)
             if collection is not None:
+                commit_watermark(collection.id, task.job.id)
                 refresh_collection(collection.id)
             task.job.remove()
 
@@ -0,0 +1,94 @@
+# Benchmark the JSON serialization path of the API on synthetic data: a
+# page of 200 search results and a stream of entities. Compares the old
+# per-row encoder and recursive cleaner with the current ones.
+#
+# python contrib/bench_json.py [rounds]
+import sys
+import time
+from datetime import datetime
+from banal import is_mapping, is_listish
+
+from aleph.util import JSONEncoder, dump_json, orjson
+from aleph.views.serializers import clean_response
+
+
+def make_entity(i):
+    return {
+        'id': 'entity-%d' % i,
+        'schema': 'Person',
+        'properties': {
+            'name': ['John Doe %d' % i, ''],
+            'nationality': ['de', 'fr'],
+            'birthDate': [],
+            'notes': ['Lorem ipsum dolor sit amet ' * 10],
+        },
+        'collection': {
+            'id': '23',
+            'label': 'Test collection',
+            'links': {'self': 'http://localhost/api/2/collections/23'},
+            'count': 1000,
+            'creator': None,
+        },
+        'created_at': datetime.utcnow(),
+        'links': {'self': 'http://localhost/api/2/entities/%d' % i,
+                  'ui': ''},
+        'highlight': [],
+        'writeable': False,
+    }
+
+
+def old_clean(data):
+    if is_mapping(data):
+        out = {}
+        for k, v in data.items():
+            v = old_clean(v)
+            if v is not None:
+                out[k] = v
+        return out if len(out) else None
+    elif is_listish(data):
+        data = [old_clean(d) for d in data]
+        data = [d for d in data if d is not None]
+        return data if len(data) else None
+    elif isinstance(data, str):
+        return data if len(data) else None
+    return data
+
+
+def timed(label, rounds, func):
+    begin = time.time()
+    for _ in range(rounds):
+        func()
+    took = (time.time() - begin) / rounds
+    print('%-40s %8.2fms' % (label, took * 1000))
+
+
+def main(rounds):
+    print('orjson available: %s' % (orjson is not None))
+    results = [make_entity(i) for i in range(200)]
+    page = {'results': results, 'total': 10000, 'page': 1, 'facets': {}}
+    timed('page: clean (recursive)', rounds, lambda: old_clean(page))
+    timed('page: clean (stack)', rounds, lambda: clean_response(page))
+    cleaned = clean_response(page)
+    timed('page: JSONEncoder().encode', rounds,
+          lambda: JSONEncoder().encode(cleaned))
+    timed('page: dump_json', rounds, lambda: dump_json(cleaned))
+
+    stream = [make_entity(i) for i in range(5000)]
+
+    def old_stream():
+        for row in stream:
+            JSONEncoder().encode(row)
+            '\n'
+
+    def new_stream():
+        for row in stream:
+            dump_json(row) + '\n'
+
+    timed('stream of 5000: encoder per row', max(1, rounds // 10),
+          old_stream)
+    timed('stream of 5000: dump_json', max(1, rounds // 10), new_stream)
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    main(rounds)
@@ -0,0 +1,69 @@
+# Benchmark the batch scorer used by cross-referencing against pairwise
+# followthemoney.compare on synthetic candidates, and check that both
+# give the same scores.
+#
+# python contrib/bench_scoring.py [entities] [candidates]
+import sys
+import time
+import random
+from followthemoney import model
+from followthemoney.compare import compare
+
+from aleph.logic.scoring import score_pairs, numpy
+
+FIRST = ['John', 'Jane', 'Carlos', 'Maria', 'Ivan', 'Olga', 'Ahmed', 'Li']
+LAST = ['Smith', 'Danger', 'Petrov', 'Garcia', 'Müller', 'Wang', 'Khan']
+COUNTRIES = ['us', 'gb', 'de', 'ru', 'cn', 'pk', 'es']
+SCHEMATA = ['Person', 'LegalEntity', 'Company']
+TOLERANCE = 1e-9
+
+
+def make_entity(i):
+    schema = random.choice(SCHEMATA)
+    proxy = model.make_entity(schema)
+    proxy.id = 'e%d' % i
+    name = '%s %s' % (random.choice(FIRST), random.choice(LAST))
+    if schema != 'Person':
+        name = '%s Holdings Ltd' % name
+    proxy.add('name', name)
+    proxy.add('country', random.choice(COUNTRIES))
+    if schema == 'Person':
+        proxy.add('birthDate', '19%02d-0%d-1%d' % (random.randint(40, 99),
+                                                   random.randint(1, 9),
+                                                   random.randint(0, 9)))
+        proxy.add('nationality', random.choice(COUNTRIES))
+    else:
+        proxy.add('registrationNumber', str(random.randint(1000, 1100)))
+    proxy.add('email', 'info%d@example.com' % random.randint(0, 20))
+    return proxy
+
+
+def main(entities, candidates):
+    random.seed(42)
+    pool = [make_entity(i) for i in range(entities + candidates)]
+    pairs = []
+    for left in pool[:entities]:
+        for right in random.sample(pool, candidates):
+            pairs.append((left, right))
+    print('numpy available: %s, pairs: %d' % (numpy is not None, len(pairs)))
+
+    begin = time.time()
+    expected = [compare(model, left, right) for (left, right) in pairs]
+    took_compare = time.time() - begin
+    print('%-30s %8.2fs' % ('compare, pair by pair', took_compare))
+
+    begin = time.time()
+    scores = score_pairs(pairs)
+    took_batch = time.time() - begin
+    print('%-30s %8.2fs' % ('score_pairs, one batch', took_batch))
+    print('speedup: %.1fx' % (took_compare / max(took_batch, 0.0001)))
+
+    diff = max(abs(a - b) for (a, b) in zip(expected, scores))
+    print('largest difference: %g' % diff)
+    assert diff < TOLERANCE, diff
+
+
+if __name__ == '__main__':
+    entities = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    candidates = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    main(entities, candidates)